@@ -6,6 +6,7 @@ from typing import Dict
 
 from auth.base import AuthStrategy, AuthType
 from fetcher.base import Fetcher
+from fetcher.executor import FetchExecutor
 from lake.s3 import S3Lake
 from shared.model import Integration
 from state.dynamo import KeyNamespaces, LibraryConnectionItem, ParentChildDB
@@ -45,25 +46,39 @@ def main():
         auth_strategy: AuthStrategy = integration.auth_strategies.get(auth_type)
         auth_strategy.auth(**auth_dict)
 
+    checkpoints = item.connection.checkpoints or {}
+    last_ingested_at = item.connection.sync.ingested_at if item.connection.sync else None
     fetcher: Fetcher = Fetcher.create(
         integration=integration.id,
         auth_strategy=auth_strategy, 
         config=item.connection.config,
-        last_ingested_at=0, 
-        limit=1000
+        last_ingested_at=last_ingested_at or 0, 
+        # only the first, full sync is capped. later syncs list changes and must see all of them
+        limit=None if (checkpoints or last_ingested_at) else 1000,
+        connection=connection,
+        checkpoints=checkpoints
     )
     s3_lake = S3Lake(
         bucket_name=lake_bucket_name,
         prefix=f'v1/{library}/{connection}'
     )
 
-    for stream in fetcher.discover():
-        fetcher.fetch(stream)
+    for stream in FetchExecutor(fetcher).run():
         stream.add_structured_data('id', stream._id)
         stream._name = f'{fetcher._INTEGRATION}-{stream._name}'
         s3_lake.add(stream)
 
-    s3_lake.flush()
+    s3_lake.close(
+        delta_tables={f'{fetcher._INTEGRATION}-{name}' for name in fetcher.delta_streams()},
+        failed_tables={f'{fetcher._INTEGRATION}-{name}' for name in fetcher.failed_streams()}
+    )
+    # checkpoints only move once the changes they cover are in the lake
+    db.update(
+        f'{KeyNamespaces.LIBRARY.value}{library}',
+        f'{KeyNamespaces.CONNECTION.value}{connection}',
+        {'checkpoints': fetcher.checkpoints()}
+    )
+    print(f'[main] rate limit metrics: {fetcher.rate_limit_metrics().as_dict()}')
     
 if __name__ == '__main__':
     try:
@@ -1,18 +1,40 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Generator, List
+from random import uniform
+from threading import Lock
+from typing import Dict, Generator, List, Set, Tuple
 
 from auth.base import AuthStrategy, AuthType
-from fetcher.model import Filter, StreamData
+from fetcher.model import CHECKPOINT_OVERLAP_SECONDS, Filter, StreamData
+from fetcher.rate_limit import (AdaptiveRateLimiter, RateLimitMetrics,
+                                get_rate_limiter, parse_retry_after)
+
+_RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
 class Fetcher(ABC):
     _INTEGRATION = 'base'
+    # upper bound on concurrent fetch calls for the integration, see FetchExecutor
+    _MAX_CONCURRENCY = 4
+    # provider quota as (requests per second, burst). the limiter adapts below this on throttling
+    _RATE_LIMIT: Tuple[float, int] = (10., 20)
+    _MAX_RETRIES = 5
+    _BACKOFF_SECONDS = 1.
 
     subclasses = {}
     _filter: Filter = None
     _auth_strategy: AuthStrategy = None
     _config: Dict = None
     _requester = None
+    _requester_lock = Lock()
+    _connection: str = None
+    # stream name -> change cursor. _checkpoints are the ones the sync starts from, _next_checkpoints are recorded by
+    # discover once a stream has been listed completely and only persisted after the sync lands in the lake
+    _checkpoints: Dict[str, str] = None
+    _next_checkpoints: Dict[str, str] = None
+    _delta_streams: Set[str] = None
+    # names of streams with at least one stream that could not be fetched
+    _failed_streams: Set[str] = None
+    _failed_lock = Lock()
 
     @classmethod
     def create(cls, 
@@ -20,7 +42,9 @@ class Fetcher(ABC):
                auth_strategy: AuthStrategy,
                config: Dict = None,
                last_ingested_at: int = None, 
-               limit: int = None) -> 'Fetcher':    
+               limit: int = None,
+               connection: str = None,
+               checkpoints: Dict[str, str] = None) -> 'Fetcher':    
         if not cls.subclasses:
             cls.subclasses = {
                 subclass._INTEGRATION: subclass for subclass in cls.__subclasses__()
@@ -36,6 +60,11 @@ class Fetcher(ABC):
                 raise Exception(f'Fetcher.create() invalid auth_strategy.. {auth_strategy}')
         fetcher._auth_strategy = auth_strategy
         fetcher._config = config
+        fetcher._connection = connection
+        fetcher._checkpoints = dict(checkpoints) if checkpoints else {}
+        fetcher._next_checkpoints = {}
+        fetcher._delta_streams = set()
+        fetcher._failed_streams = set()
         fetcher._filter = Filter(
             start_timestamp=last_ingested_at,
             limit=limit
@@ -44,38 +73,134 @@ class Fetcher(ABC):
         return fetcher
     
     def request(self, url: str, method: str = 'get', **kwargs) -> Dict:
-        from time import time
+        response = self.send(url, method=method, **kwargs)
+        return response.json() if response else None
+
+    def send(self, url: str, method: str = 'get', cost: int = 1, **kwargs):
+        # the raw response after rate limiting and retries. cost is the number of provider requests it stands for,
+        # e.g. the parts of a batch request
+        from time import sleep, time
 
         import requests
         from auth.basic import Basic
         from auth.direct_token import TokenDirect
         from auth.oauth2_token import TokenOAuth2
 
-        if not self._requester:
-            self._requester = requests.Session()
-            authorization: str = None
-            if self._auth_strategy.get_type() == AuthType.TOKEN_DIRECT:
-                auth: TokenDirect = self._auth_strategy._auth
-                authorization = f'Bearer {auth.access_token}'
-            elif self._auth_strategy.get_type() == AuthType.TOKEN_OAUTH2:
-                auth: TokenOAuth2 = self._auth_strategy._auth
-                print(auth)
-                authorization = f'Bearer {auth.access_token}'
-            elif self._auth_strategy.get_type() == AuthType.BASIC:
-                auth: Basic = self._auth_strategy._auth
-                authorization = f'Basic {auth.key}'
-            self._requester.headers.update({
-                'Authorization': authorization
-            })
-        if self._auth_strategy.get_type() == AuthType.TOKEN_OAUTH2:
-            auth: TokenOAuth2 = self._auth_strategy._auth
-            if auth.refresh_token and auth.expiry_timestamp < int(time()) + 300:
-                auth = self._auth_strategy.auth()
+        # the session is shared by the FetchExecutor workers, so set up and token refresh happen once
+        with self._requester_lock:
+            if not self._requester:
+                self._requester = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(10, self._MAX_CONCURRENCY))
+                self._requester.mount('https://', adapter)
+                authorization: str = None
+                if self._auth_strategy.get_type() == AuthType.TOKEN_DIRECT:
+                    auth: TokenDirect = self._auth_strategy._auth
+                    authorization = f'Bearer {auth.access_token}'
+                elif self._auth_strategy.get_type() == AuthType.TOKEN_OAUTH2:
+                    auth: TokenOAuth2 = self._auth_strategy._auth
+                    print(auth)
+                    authorization = f'Bearer {auth.access_token}'
+                elif self._auth_strategy.get_type() == AuthType.BASIC:
+                    auth: Basic = self._auth_strategy._auth
+                    authorization = f'Basic {auth.key}'
                 self._requester.headers.update({
-                    'Authorization': f'Bearer {auth.access_token}'
+                    'Authorization': authorization
                 })
-        response = self._requester.request(url=url, method=method, **kwargs)
-        return response.json() if response else None
+            if self._auth_strategy.get_type() == AuthType.TOKEN_OAUTH2:
+                auth: TokenOAuth2 = self._auth_strategy._auth
+                if auth.refresh_token and auth.expiry_timestamp < int(time()) + 300:
+                    auth = self._auth_strategy.auth()
+                    self._requester.headers.update({
+                        'Authorization': f'Bearer {auth.access_token}'
+                    })
+
+        limiter = self._rate_limiter()
+        response = None
+        for attempt in range(self._MAX_RETRIES + 1):
+            limiter.acquire(cost=cost)
+            response = None
+            throttled = False
+            retry_after = None
+            try:
+                response = self._requester.request(url=url, method=method, **kwargs)
+                throttled = self._is_throttled(response)
+                retry_after = parse_retry_after(response.headers.get('Retry-After', None)) if throttled else None
+            except requests.RequestException as e:
+                print(f'Fetcher.request() {method} {url} failed: {str(e)}')
+                if attempt == self._MAX_RETRIES:
+                    raise
+            finally:
+                limiter.release(throttled=throttled, retry_after=retry_after)
+
+            if response is not None and not (throttled or response.status_code in _RETRYABLE_STATUS_CODES):
+                break
+            if attempt == self._MAX_RETRIES:
+                print(f'Fetcher.request() {method} {url} giving up after {attempt + 1} attempts')
+                break
+            # a Retry-After already pauses every request in the limiter, otherwise back off with full jitter
+            backoff = uniform(0, self._BACKOFF_SECONDS * 2 ** attempt) if retry_after is None else 0.
+            limiter.record_retry(backoff)
+            if backoff:
+                sleep(backoff)
+        return response
+
+    def _rate_limiter(self) -> AdaptiveRateLimiter:
+        rate, burst = self._RATE_LIMIT
+        return get_rate_limiter(self._INTEGRATION, self._connection, rate=rate, burst=burst, max_concurrency=self._MAX_CONCURRENCY)
+
+    def _checkpoint(self, stream_name: str) -> str:
+        checkpoint = self._checkpoints.get(stream_name, None) if self._checkpoints else None
+        if checkpoint:
+            self._delta_streams.add(stream_name)
+        return checkpoint
+
+    def _set_checkpoint(self, stream_name: str, checkpoint: str) -> None:
+        if checkpoint:
+            self._next_checkpoints[stream_name] = checkpoint
+
+    def _since_timestamp(self, stream_name: str) -> int:
+        # for providers with time based change filters: the stream's checkpoint (unix seconds) or, for streams that
+        # have none yet, the connection's last ingestion
+        checkpoint = self._checkpoint(stream_name)
+        if checkpoint:
+            return int(checkpoint)
+        start_timestamp = self._filter.start_timestamp if self._filter else None
+        if start_timestamp:
+            self._delta_streams.add(stream_name)
+            return start_timestamp
+        return None
+
+    def _listing_checkpoint(self) -> str:
+        # taken before a time based listing starts so that changes made during it are picked up next time
+        from time import time
+        return str(int(time()) - CHECKPOINT_OVERLAP_SECONDS)
+
+    def checkpoints(self) -> Dict[str, str]:
+        # streams with fetch failures keep their previous checkpoint, so the next sync lists their changes again
+        failed_streams = self.failed_streams()
+        next_checkpoints = {name: checkpoint for name, checkpoint in (self._next_checkpoints or {}).items() if name not in failed_streams}
+        if failed_streams:
+            print(f'[Fetcher.checkpoints] holding back checkpoints for {failed_streams}')
+        return {**(self._checkpoints or {}), **next_checkpoints}
+
+    def delta_streams(self) -> Set[str]:
+        # streams listed from a checkpoint, i.e. only their changes were fetched
+        return set(self._delta_streams or [])
+
+    def _mark_failed(self, stream: StreamData) -> None:
+        stream._failed = True
+        with self._failed_lock:
+            self._failed_streams.add(stream._name)
+
+    def failed_streams(self) -> Set[str]:
+        with self._failed_lock:
+            return set(self._failed_streams or [])
+
+    def rate_limit_metrics(self) -> RateLimitMetrics:
+        return self._rate_limiter().metrics()
+
+    def _is_throttled(self, response) -> bool:
+        return response.status_code in (429, 503)
     
     @abstractmethod
     def _get_supported_auth_types(self) -> List[AuthType]:
@@ -88,3 +213,10 @@ class Fetcher(ABC):
     @abstractmethod
     def fetch(self, stream: StreamData) -> None:
         raise NotImplementedError("fetch not implemented")
+
+    # streams handed to fetch_many at once by the FetchExecutor. fetchers with a batch api raise it and override fetch_many
+    _FETCH_BATCH_SIZE = 1
+
+    def fetch_many(self, streams: List[StreamData]) -> None:
+        for stream in streams:
+            self.fetch(stream)
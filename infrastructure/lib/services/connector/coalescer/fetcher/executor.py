@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Generator, List, Set
+
+from fetcher.base import Fetcher
+from fetcher.model import StreamData
+
+
+class FetchExecutor:
+    # runs fetcher.fetch_many for batches of discovered streams on a bounded pool while discover keeps paging on the
+    # calling thread. streams are yielded back on the calling thread as they complete, so callers like S3Lake.add stay
+    # single threaded
+    def __init__(self, fetcher: Fetcher, max_workers: int = None) -> None:
+        self._fetcher = fetcher
+        configured = int(os.getenv('FETCH_MAX_WORKERS', 0))
+        self._max_workers = max(1, min(max_workers or configured or fetcher._MAX_CONCURRENCY, fetcher._MAX_CONCURRENCY))
+        # enough queued work to keep every worker busy while discover waits on its next page
+        self._max_in_flight = self._max_workers * 2
+
+    def _fetch(self, streams: List[StreamData]) -> List[StreamData]:
+        # failed and empty streams are held back rather than written over what the lake already has
+        self._fetcher.fetch_many(streams)
+        fetched: List[StreamData] = []
+        for stream in streams:
+            if stream._deleted:
+                continue
+            if not (stream._failed or stream._data):
+                self._fetcher._mark_failed(stream)
+            if stream._failed:
+                print(f'[FetchExecutor._fetch] {stream._name} {stream._id} failed')
+                continue
+            fetched.append(stream)
+        return fetched
+
+    def _completed(self, in_flight: Set[Future], block: bool) -> Generator[StreamData, None, None]:
+        done, _ = wait(in_flight, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            in_flight.discard(future)
+            yield from future.result()
+
+    def run(self) -> Generator[StreamData, None, None]:
+        print(f'[FetchExecutor.run] {self._fetcher._INTEGRATION} with {self._max_workers} workers')
+        in_flight: Set[Future] = set()
+        executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix=f'fetch-{self._fetcher._INTEGRATION}')
+        try:
+            batch: List[StreamData] = []
+            for stream in self._fetcher.discover():
+                batch.append(stream)
+                if len(batch) < self._fetcher._FETCH_BATCH_SIZE:
+                    continue
+                in_flight.add(executor.submit(self._fetch, batch))
+                batch = []
+                yield from self._completed(in_flight, block=len(in_flight) >= self._max_in_flight)
+            if batch:
+                in_flight.add(executor.submit(self._fetch, batch))
+
+            while in_flight:
+                yield from self._completed(in_flight, block=True)
+        finally:
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
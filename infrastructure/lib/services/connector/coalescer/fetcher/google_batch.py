@@ -0,0 +1,77 @@
+import json
+from dataclasses import dataclass
+from email import message_from_bytes
+from email.message import Message
+from typing import Any, Dict, List, Tuple
+from uuid import uuid4
+
+# google's batch endpoints take a multipart/mixed body of application/http parts, each one a plain http request, and
+# answer with a multipart/mixed body of http responses matched up by Content-ID
+MAX_BATCH_SIZE = 100
+
+
+@dataclass
+class BatchPart:
+    content_id: str
+    status_code: int
+    headers: Dict[str, str]
+    body: Any
+
+
+def encode_batch(requests: List[Tuple[str, str]]) -> Tuple[str, bytes]:
+    # requests are (content id, 'GET /path?query') pairs. returns the content type header and the body
+    if len(requests) > MAX_BATCH_SIZE:
+        raise ValueError(f'[encode_batch] {len(requests)} requests exceeds the batch limit of {MAX_BATCH_SIZE}')
+
+    boundary = f'batch_{uuid4().hex}'
+    lines: List[str] = []
+    for content_id, request_line in requests:
+        lines.extend([
+            f'--{boundary}',
+            'Content-Type: application/http',
+            f'Content-ID: <{content_id}>',
+            '',
+            request_line,
+            '',
+        ])
+    lines.append(f'--{boundary}--')
+    lines.append('')
+    return f'multipart/mixed; boundary={boundary}', '\r\n'.join(lines).encode('utf-8')
+
+
+def _decode_http(content_id: str, payload: bytes) -> BatchPart:
+    separator = b'\r\n\r\n' if b'\r\n\r\n' in payload else b'\n\n'
+    head, _, body = payload.partition(separator)
+    head_lines = head.decode('utf-8', errors='replace').splitlines()
+    status_line = head_lines[0].split(' ') if head_lines else []
+    status_code = int(status_line[1]) if len(status_line) > 1 and status_line[1].isdigit() else 0
+    headers: Dict[str, str] = {}
+    for line in head_lines[1:]:
+        name, colon, value = line.partition(':')
+        if colon:
+            headers[name.strip().lower()] = value.strip()
+
+    body = body.strip()
+    try:
+        decoded = json.loads(body) if body else None
+    except ValueError:
+        decoded = body.decode('utf-8', errors='replace')
+    return BatchPart(content_id=content_id, status_code=status_code, headers=headers, body=decoded)
+
+
+def decode_batch(content_type: str, body: bytes) -> Dict[str, BatchPart]:
+    # keyed by the request's content id. google prefixes response ids with 'response-'
+    message: Message = message_from_bytes(f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + body)
+    if not message.is_multipart():
+        raise ValueError(f'[decode_batch] expected a multipart response, got {content_type}')
+
+    parts: Dict[str, BatchPart] = {}
+    for part in message.get_payload():
+        content_id = (part.get('Content-ID', '') or '').strip().strip('<>')
+        if content_id.startswith('response-'):
+            content_id = content_id[len('response-'):]
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            payload = part.get_payload().encode('utf-8')
+        parts[content_id] = _decode_http(content_id, payload)
+    return parts
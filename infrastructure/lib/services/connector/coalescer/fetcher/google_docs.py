@@ -1,3 +1,4 @@
+from datetime import datetime, timezone
 from typing import Dict, Generator, List
 
 from auth.base import AuthType
@@ -13,12 +14,20 @@ GET_DOCUMENT_ENDPOINT = 'https://docs.googleapis.com/v1/documents/{id}'
 
 class GoogleDocs(Fetcher):
     _INTEGRATION = 'google_docs'
+    _MAX_CONCURRENCY = 8
+    # docs api reads are limited to 300 per minute per user
+    _RATE_LIMIT = (5., 10)
 
     def _get_supported_auth_types(self) -> List[AuthType]:
         return [AuthType.TOKEN_BEARER_OAUTH2]
     
     def discover(self) -> Generator[StreamData, None, None]:
         discover_filters = ['mimeType="application/vnd.google-apps.document"', 'trashed=false']
+        since = self._since_timestamp('document')
+        if since:
+            modified_after = datetime.fromtimestamp(since, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+            discover_filters.append(f'modifiedTime > "{modified_after}"')
+        checkpoint = self._listing_checkpoint()
         params = {
             'q': ' and '.join(discover_filters)
         }
@@ -31,8 +40,11 @@ class GoogleDocs(Fetcher):
                 })
             
             response = self.request(DISCOVERY_ENDPOINT, headers={'Authorization': f'Bearer {self._auth.token}'}, params=params)
-            next_token = response.get('nextPageToken', None) if response else None
-            files: List[Dict] = response.get('files', None) if response else None
+            # a failed page must not pass for the end of the listing, or the checkpoint would skip the rest
+            if response is None:
+                raise Exception(f'[GoogleDocs.discover] failed to list documents from page {next_token}')
+            next_token = response.get('nextPageToken', None)
+            files: List[Dict] = response.get('files', None) or []
             for file in files:
                 file_id = file.get('id', None) if file else None
                 if not file_id:
@@ -47,6 +59,7 @@ class GoogleDocs(Fetcher):
                         return []
 
             if not next_token:
+                self._set_checkpoint('document', checkpoint)
                 break
     
     def _get_owners(self, owners_dict: Dict) -> List[str]:
@@ -1,21 +1,119 @@
 import base64
+from random import uniform
+from time import sleep
 from typing import Dict, Generator, List
 
 from auth.base import AuthType
 from fetcher.base import Fetcher, StreamData
+from fetcher.google_batch import BatchPart, decode_batch, encode_batch
+from fetcher.rate_limit import parse_retry_after
 
 DISCOVERY_ENDPOINT = 'https://www.googleapis.com/gmail/v1/users/me/threads'
 GET_THREADS_ENDPOINT = 'https://www.googleapis.com/gmail/v1/users/me/threads/{id}'
+BATCH_ENDPOINT = 'https://www.googleapis.com/batch/gmail/v1'
+HISTORY_ENDPOINT = 'https://www.googleapis.com/gmail/v1/users/me/history'
+PROFILE_ENDPOINT = 'https://www.googleapis.com/gmail/v1/users/me/profile'
+GET_THREADS_PATH = '/gmail/v1/users/me/threads/{id}'
+METADATA_HEADERS = ['From', 'To', 'Subject']
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
 
 class GoogleMail(Fetcher):
     _INTEGRATION = 'google_mail'
+    _MAX_CONCURRENCY = 10
+    # 250 quota units per user per second, threads.get costs 10
+    _RATE_LIMIT = (25., 25)
+    # google allows 100 calls per batch but recommends 50 for gmail to stay clear of concurrency limits
+    _FETCH_BATCH_SIZE = 50
     
     def _get_supported_auth_types(self) -> List[AuthType]:
         return [AuthType.TOKEN_OAUTH2, AuthType.TOKEN_DIRECT, AuthType.BASIC]
+
+    def _is_rate_limit_error(self, status_code: int, body) -> bool:
+        # gmail reports quota exhaustion as 403 rateLimitExceeded / userRateLimitExceeded
+        if status_code in (429, 503):
+            return True
+        if status_code != 403 or not isinstance(body, dict):
+            return False
+        errors = (body.get('error', {}) or {}).get('errors', [])
+        return any(error.get('reason', None) in RATE_LIMIT_REASONS for error in errors)
+
+    def _is_throttled(self, response) -> bool:
+        if response.status_code == 403:
+            try:
+                return self._is_rate_limit_error(403, response.json())
+            except ValueError:
+                return False
+        return super()._is_throttled(response)
+
+    def _format_params(self) -> Dict:
+        # format=metadata skips bodies and attachments for syncs that only need headers
+        if self._config and self._config.get('format', None) == 'metadata':
+            return {'format': 'metadata', 'metadataHeaders': METADATA_HEADERS}
+        return {'format': 'full'}
+
+    def _thread_request_line(self, thread_id: str) -> str:
+        query = '&'.join(
+            '&'.join(f'{key}={item}' for item in value) if isinstance(value, list) else f'{key}={value}'
+            for key, value in self._format_params().items()
+        )
+        return f'GET {GET_THREADS_PATH.format(id=thread_id)}?{query}'
     
     def discover(self) -> Generator[StreamData, None, None]:
+        start_history_id = self._checkpoint('email_thread')
+        if start_history_id:
+            params = {
+                'startHistoryId': start_history_id,
+                'historyTypes': 'messageAdded',
+            }
+            response = self.request(HISTORY_ENDPOINT, params=params)
+            if response is not None:
+                yield from self._discover_history(response, params)
+                return
+            # history ids expire after about a week, or when the mailbox is reset
+            print(f'[GoogleMail.discover] history from {start_history_id} unavailable, listing threads')
+        yield from self._discover_threads()
+
+    def _discover_history(self, response: Dict, params: Dict) -> Generator[StreamData, None, None]:
+        seen_thread_ids = set()
+        while True:
+            for history in response.get('history', []) or []:
+                messages = [added.get('message', None) for added in history.get('messagesAdded', []) or []]
+                for message in messages + (history.get('messages', []) or []):
+                    thread_id = message.get('threadId', None) if message else None
+                    if not thread_id or thread_id in seen_thread_ids:
+                        continue
+                    seen_thread_ids.add(thread_id)
+                    yield StreamData(
+                        name='email_thread',
+                        id=thread_id,
+                    )
+
+            next_token = response.get('nextPageToken', None)
+            if not next_token:
+                self._set_checkpoint('email_thread', response.get('historyId', None))
+                return
+            params.update({
+                'pageToken': next_token
+            })
+            response = self.request(HISTORY_ENDPOINT, params=params)
+            if not response:
+                raise Exception(f'[GoogleMail._discover_history] failed to page history from {params.get("startHistoryId")}')
+
+    def _discover_threads(self) -> Generator[StreamData, None, None]:
+        # threads are listed newest first, so the history id from before the listing covers everything after it even
+        # when the limit cuts the listing short. it only becomes the checkpoint once no page has failed
+        profile = self.request(PROFILE_ENDPOINT)
+        history_id = profile.get('historyId', None) if profile else None
+
         next_token = None
         params = {}
+        # without a usable history id, fall back to threads with mail since the last ingestion
+        start_timestamp = self._filter.start_timestamp if self._filter else None
+        if start_timestamp:
+            params['q'] = f'after:{start_timestamp}'
+            self._delta_streams.add('email_thread')
+        else:
+            self._delta_streams.discard('email_thread')
         limit = self._filter.limit if self._filter else None
         while True:
             if next_token:
@@ -24,10 +122,13 @@ class GoogleMail(Fetcher):
                 })
             
             response = self.request(DISCOVERY_ENDPOINT, params=params)
-            next_token = response.get('nextPageToken', None) if response else None
-            threads: List[Dict] = response.get('threads', None) if response else None
+            if response is None:
+                print(f'[GoogleMail._discover_threads] failed to list threads, keeping the previous checkpoint')
+                return []
+            next_token = response.get('nextPageToken', None)
+            threads: List[Dict] = response.get('threads', None)
 
-            for thread in threads:
+            for thread in threads or []:
                 thread_id = thread.get('id', None) if thread else None
                 if not thread_id:
                     continue
@@ -38,10 +139,12 @@ class GoogleMail(Fetcher):
                 if limit:
                     limit -= 1
                     if limit < 1:
+                        self._set_checkpoint('email_thread', history_id)
                         return []
 
             if not next_token:
                 break
+        self._set_checkpoint('email_thread', history_id)
 
     def _get_author(self, headers: Dict) -> str:
         for header in headers:
@@ -92,7 +195,15 @@ class GoogleMail(Fetcher):
         return '\n\n'.join(body_list)
 
     def fetch_thread(self, stream: StreamData) -> None:
-        response = self.request(GET_THREADS_ENDPOINT.format(id=stream._id))
+        response = self.send(GET_THREADS_ENDPOINT.format(id=stream._id), params=self._format_params())
+        if response is not None and response.status_code == 404:
+            stream._deleted = True
+        elif not response:
+            self._mark_failed(stream)
+        else:
+            self._add_thread(stream, response.json())
+
+    def _add_thread(self, stream: StreamData, response: Dict) -> None:
         messages: List[Dict] = response.get('messages', None) if response else None
         if not messages:
             return
@@ -117,3 +228,44 @@ class GoogleMail(Fetcher):
     def fetch(self, stream: StreamData) -> None:
         if stream._name == 'email_thread':
             self.fetch_thread(stream)
+
+    def _fetch_threads_batch(self, pending: Dict[str, StreamData]) -> Dict[str, StreamData]:
+        # returns the threads to try again, i.e. a failed batch, rate limited or missing parts
+        content_type, body = encode_batch([(thread_id, self._thread_request_line(thread_id)) for thread_id in pending])
+        response = self.send(BATCH_ENDPOINT, method='post', cost=len(pending), data=body, headers={'Content-Type': content_type})
+        if not response:
+            print(f'[GoogleMail._fetch_threads_batch] batch of {len(pending)} failed: {response.status_code if response is not None else None}')
+            return pending
+
+        parts: Dict[str, BatchPart] = decode_batch(response.headers.get('Content-Type', ''), response.content)
+        retry: Dict[str, StreamData] = {}
+        for thread_id, stream in pending.items():
+            part = parts.get(thread_id, None)
+            if not part:
+                retry[thread_id] = stream
+            elif part.status_code == 200:
+                self._add_thread(stream, part.body)
+            elif part.status_code == 404:
+                stream._deleted = True
+            elif self._is_rate_limit_error(part.status_code, part.body):
+                retry[thread_id] = stream
+                self._rate_limiter().throttle(parse_retry_after(part.headers.get('retry-after', None)))
+            else:
+                print(f'[GoogleMail._fetch_threads_batch] thread {thread_id} failed with {part.status_code}: {part.body}')
+                self._mark_failed(stream)
+        return retry
+
+    def fetch_many(self, streams: List[StreamData]) -> None:
+        pending = {stream._id: stream for stream in streams if stream._name == 'email_thread'}
+        for attempt in range(self._MAX_RETRIES + 1):
+            if not pending:
+                return
+            if attempt:
+                backoff = uniform(0, self._BACKOFF_SECONDS * 2 ** attempt)
+                self._rate_limiter().record_retry(backoff)
+                sleep(backoff)
+            pending = self._fetch_threads_batch(pending)
+        if pending:
+            print(f'[GoogleMail.fetch_many] giving up on {len(pending)} threads')
+            for stream in pending.values():
+                self._mark_failed(stream)
@@ -1,120 +1,201 @@
 import json
-from typing import Any, Dict, Generator, List
+from datetime import datetime, timezone
+from typing import Dict, Generator, List, Tuple
 
-import requests
 from auth.base import AuthType
 from fetcher.base import Fetcher, StreamData
+from fetcher.rate_limit import get_rate_limiter
+
+GRAPHQL_ENDPOINT = 'https://api.linear.app/graphql'
+# linear rejects queries scoring above 10,000 points and allows 250,000 points per hour
+_MAX_QUERY_COMPLEXITY = 10000
+_COMPLEXITY_PER_SECOND = 250000 / 3600
+_MAX_PAGE_SIZE = 250
+
+# stream name -> (scalar fields, fields referencing other objects)
+_FIELDS: Dict[str, Tuple[List[str], List[str]]] = {
+    'ticket': ([
+        'id',
+        'completedAt',
+        'createdAt',
+        'description',
+        'dueDate',
+        'estimate',
+        'priority',
+        'updatedAt',
+    ], ['assignee', 'creator', 'parent', 'project']),
+    'user': ([
+        'id',
+        'active',
+        'admin',
+        'description',
+        'email',
+        'name',
+        'updatedAt',
+    ], []),
+    'comment': ([
+        'id',
+        'body',
+        'createdAt',
+        'updatedAt',
+    ], ['user', 'issue']),
+    'project': ([
+        'id',
+        'completedAt',
+        'progress',
+        'scope',
+        'state',
+        'description',
+        'name',
+        'updatedAt',
+    ], ['creator']),
+}
+# stream name -> listing connection and single node query
+_CONNECTIONS = {
+    'ticket': 'issues',
+    'user': 'users',
+    'comment': 'comments',
+    'project': 'projects',
+}
+_NODES = {
+    'ticket': 'issue',
+    'user': 'user',
+    'comment': 'comment',
+    'project': 'project',
+}
 
 
 class Linear(Fetcher):
     _INTEGRATION = 'linear'
+    _MAX_CONCURRENCY = 4
+    # 1500 requests per hour per user, with a burst allowance for short syncs
+    _RATE_LIMIT = (0.4, 60)
+    # ids per aliased lookup in fetch_many
+    _FETCH_BATCH_SIZE = 100
     
     def _get_supported_auth_types(self) -> List[AuthType]:
         return [AuthType.TOKEN_OAUTH2, AuthType.TOKEN_DIRECT, AuthType.BASIC]
+
+    def _is_throttled(self, response) -> bool:
+        # linear answers rate limited queries with a 400 and a RATELIMITED graphql error
+        if response.status_code == 400:
+            try:
+                errors = response.json().get('errors', [])
+            except ValueError:
+                return False
+            return any((error.get('extensions', {}) or {}).get('code', None) == 'RATELIMITED' for error in errors)
+        return super()._is_throttled(response)
     
+    def _selection(self, label: str) -> str:
+        # referenced objects come back as their id only, they are streams of their own
+        scalars, references = _FIELDS[label]
+        return ' '.join(scalars + [f'{reference} {{ id }}' for reference in references])
+
+    def _node_complexity(self, label: str) -> float:
+        # linear scores a query at 0.1 per scalar and 1 per object, and multiplies a connection's nodes by its page size
+        scalars, references = _FIELDS[label]
+        return 1 + 0.1 * len(scalars) + 1.1 * len(references)
+
+    def _page_size(self, label: str) -> int:
+        return max(1, min(_MAX_PAGE_SIZE, int(_MAX_QUERY_COMPLEXITY / self._node_complexity(label))))
+
+    def _spend_complexity(self, complexity: float) -> None:
+        # the hourly complexity budget is tracked separately from the request rate, by its own limiter
+        limiter = get_rate_limiter(f'{self._INTEGRATION}-complexity', self._connection, rate=_COMPLEXITY_PER_SECOND,
+                                   burst=_MAX_QUERY_COMPLEXITY, max_concurrency=self._MAX_CONCURRENCY)
+        limiter.acquire(cost=max(1, int(complexity)))
+        limiter.release()
+
+    def _graphql(self, query: str, variables: Dict = None, complexity: float = 0) -> Dict:
+        self._spend_complexity(complexity)
+        response = self.request(GRAPHQL_ENDPOINT, method='post', json={
+            'query': query,
+            'variables': variables or {},
+        })
+        errors = response.get('errors', None) if response else None
+        if errors:
+            print(f'[Linear._graphql] errors: {errors}')
+        return response
+
+    def _hydrate(self, stream: StreamData, node: Dict) -> None:
+        _, references = _FIELDS[stream._name]
+        for key, value in node.items():
+            if key in references:
+                value = value.get('id', None) if value else None
+            stream.add_structured_data(key, str(value) if value else None)
+
     def _discover_helper(self, model: str, label: str) -> Generator[StreamData, None, None]:
-        next_token = 0
+        # pages carry every field fetch needs, so listed streams are already hydrated
         limit = self._filter.limit if self._filter else None
+        since = self._since_timestamp(label)
+        checkpoint = self._listing_checkpoint()
+        # only objects changed since the last sync
+        updated_filter = f', filter: {{ updatedAt: {{ gt: "{datetime.fromtimestamp(since, timezone.utc).isoformat()}" }} }}' if since else ''
+        page_size = self._page_size(label)
+        query = (
+            'query($after: String) {'
+            f'  {model}(first: {page_size}, after: $after{updated_filter}) {{'
+            f'    nodes {{ {self._selection(label)} }}'
+            '    pageInfo { hasNextPage endCursor }'
+            '  }'
+            '}'
+        )
+        end_cursor = None
         while True:
-            pagination = 'first: 100' + (f', after: "{next_token}"' if next_token else '')
-            query = (
-                'query {'
-                f'  {model}({pagination}) '
-                '{    nodes {'
-                '      id'
-                '    }'
-                '  }'
-                '}'
-            )
-            response = self.request('https://api.linear.app/graphql', method='post', json={
-                'query': query
-            })
-            nodes = response.get('data', {}).get(model, {}).get('nodes', [])
-            if not nodes:
+            response = self._graphql(query, variables={'after': end_cursor}, complexity=page_size * self._node_complexity(label))
+            connection = ((response or {}).get('data', None) or {}).get(model, None)
+            if not connection:
+                # an errored query must not move the checkpoint
                 break
 
-            for node in nodes:
-                id = node.get('id', None)
+            for node in connection.get('nodes', []) or []:
+                id = node.get('id', None) if node else None
                 if not id:
                     continue
-                yield StreamData(name=label, id=id)
+                stream = StreamData(name=label, id=id)
+                self._hydrate(stream, node)
+                yield stream
                 if limit:
                     limit -= 1
                     if limit < 1:
                         return []
-            if len(nodes) < 100:
+
+            page_info = connection.get('pageInfo', None) or {}
+            end_cursor = page_info.get('endCursor', None)
+            if not (page_info.get('hasNextPage', False) and end_cursor):
+                self._set_checkpoint(label, checkpoint)
                 break
-            next_token += 100
 
     def discover(self) -> Generator[StreamData, None, None]:
-        yield from self._discover_helper('issues', 'ticket')
-        yield from self._discover_helper('users', 'user')
-        yield from self._discover_helper('comments', 'comment')
-        yield from self._discover_helper('projects', 'project')
+        for label, model in _CONNECTIONS.items():
+            yield from self._discover_helper(model, label)
+
+    def fetch_many(self, streams: List[StreamData]) -> None:
+        # streams that did not come from a listing are looked up together, one aliased query per batch
+        pending = [stream for stream in streams if not stream._data]
+        for stream in pending:
+            if stream._name not in _FIELDS:
+                raise ValueError(f'Unsupported stream: {stream._name}')
+        while pending:
+            batch: List[StreamData] = []
+            complexity = 0.
+            while pending and len(batch) < self._FETCH_BATCH_SIZE and \
+                    (not batch or complexity + self._node_complexity(pending[0]._name) <= _MAX_QUERY_COMPLEXITY):
+                complexity += self._node_complexity(pending[0]._name)
+                batch.append(pending.pop(0))
+
+            query = '{ ' + ' '.join(
+                f'n{index}: {_NODES[stream._name]}(id: {json.dumps(stream._id)}) {{ {self._selection(stream._name)} }}'
+                for index, stream in enumerate(batch)
+            ) + ' }'
+            response = self._graphql(query, complexity=complexity)
+            data = ((response or {}).get('data', None) or {})
+            for index, stream in enumerate(batch):
+                node = data.get(f'n{index}', None)
+                if not node:
+                    print(f'[Linear.fetch_many] {stream._name} {stream._id} not found')
+                    continue
+                self._hydrate(stream, node)
 
     def fetch(self, stream: StreamData) -> None:
-        model = stream._name
-        if stream._name == 'ticket':
-            model = 'issue'
-            fields = [
-                'id',
-                'assignee',
-                'completedAt',
-                'createdAt',
-                'creator',
-                'description',
-                'dueDate',
-                'estimate',
-                'parent',
-                'priority',
-                'project',
-                'updatedAt',
-            ]
-        elif stream._name == 'user':
-            fields = [
-                'id',
-                'active',
-                'admin',
-                'description',
-                'email',
-                'name',
-                'updatedAt',
-            ]
-        elif stream._name == 'comment':
-            fields = [
-                'id',
-                'body',
-                'createdAt',
-                'creator',
-                'issue',
-                'updatedAt',
-            ]
-        elif stream._name == 'project':
-            fields = [
-                'id',
-                'completedAt',
-                'creator',
-                'progress',
-                'scope',
-                'state',
-                'description',
-                'name',
-                'updatedAt',
-            ]
-        else:
-            raise ValueError(f'Unsupported stream: {stream._name}')
-        
-        query = f"""
-        {{
-            {model}(id: "{stream._id}") {{
-                {' '.join(fields)}
-            }}
-        }}
-        """
-
-        response = self.request('https://api.linear.app/graphql', method='post', json={
-            'query': query
-        })
-        data = response.get('data', {}).get(model, {}) if response else {}
-        for key, value in data.items():
-            stream.add_structured_data(key, str(value) if value else None)
+        self.fetch_many([stream])
@@ -3,6 +3,9 @@ from datetime import datetime
 from typing import Any, Dict
 
 MAX_UNSTRUCTURED_SIZE = 1000
+# time based checkpoints start this far before the listing began to absorb clock skew with the provider. the overlap
+# re-fetches a few objects, which graph_plot skips by fingerprint
+CHECKPOINT_OVERLAP_SECONDS = 300
 
 
 def get_timestamp_from_format(timestamp_str: str, format: str = None) -> int:
@@ -21,6 +24,9 @@ class StreamData:
         self._name = name
         self._id = id
         self._data: Dict[str, Any] = {}
+        # set by fetchers: failed streams could not be fetched, deleted ones no longer exist at the provider
+        self._failed = False
+        self._deleted = False
     
     def add_unstructured_data(self, key: str, value: str):
         if not (key and value):
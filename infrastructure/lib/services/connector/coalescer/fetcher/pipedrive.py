@@ -1,16 +1,34 @@
+from datetime import datetime, timezone
 from typing import Any, Dict, Generator, List
 
 from auth.base import AuthType
 from fetcher.base import Fetcher, StreamData
 
+RECENTS_ENDPOINT = 'https://api.pipedrive.com/v1/recents'
+
 
 class Pipedrive(Fetcher):
     _INTEGRATION = 'pipedrive'
+    _MAX_CONCURRENCY = 8
+    # 80 requests per 2 seconds per token on the lowest plan
+    _RATE_LIMIT = (40., 80)
     
     def _get_supported_auth_types(self) -> List[AuthType]:
         return [AuthType.TOKEN_OAUTH2, AuthType.TOKEN_DIRECT, AuthType.BASIC]
     
-    def _discover_helper(self, endpoint: str, label: str) -> Generator[StreamData, None, None]:
+    def _next_start(self, response: Dict) -> int:
+        pagination = (response.get('additional_data', {}) or {}).get('pagination', {}) or {}
+        return pagination.get('next_start', None) if pagination.get('more_items_in_collection', False) else None
+
+    def _discover_helper(self, endpoint: str, label: str, recents_item: str = None) -> Generator[StreamData, None, None]:
+        # recents_item is the type's name in /recents, which lists what changed since a timestamp. types without one
+        # are always listed in full
+        since = self._since_timestamp(label) if recents_item else None
+        if since:
+            yield from self._discover_recents(recents_item, label, since)
+            return
+
+        checkpoint = self._listing_checkpoint()
         next_token = 0
         params = {}
         limit = self._filter.limit if self._filter else None
@@ -20,7 +38,10 @@ class Pipedrive(Fetcher):
                 'limit': 100
             })
             response = self.request(endpoint, params=params)
-            data_list: List[Dict] = response.get('data', []) if response else []
+            # a failed page must not pass for the end of the listing, or the table is written without the rest
+            if not response:
+                raise Exception(f'[Pipedrive._discover_helper] failed to list {label} from {next_token}')
+            data_list: List[Dict] = response.get('data', [])
             if not data_list:
                 break
             for data in data_list:
@@ -32,17 +53,48 @@ class Pipedrive(Fetcher):
                     limit -= 1
                     if limit < 1:
                         return []
-            if len(data) < 100:
+            next_token = self._next_start(response)
+            if next_token is None:
+                break
+        if recents_item:
+            self._set_checkpoint(label, checkpoint)
+
+    def _discover_recents(self, recents_item: str, label: str, since: int) -> Generator[StreamData, None, None]:
+        checkpoint = self._listing_checkpoint()
+        params = {
+            'since_timestamp': datetime.fromtimestamp(since, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            'items': recents_item,
+            'limit': 100,
+        }
+        next_token = 0
+        seen_ids = set()
+        while True:
+            params.update({
+                'start': next_token
+            })
+            response = self.request(RECENTS_ENDPOINT, params=params)
+            if not response:
+                raise Exception(f'[Pipedrive._discover_recents] failed to list recent {recents_item} since {since}')
+            for recent in response.get('data', []) or []:
+                data = recent.get('data', None) or {}
+                id = recent.get('id', None) or data.get('id', None)
+                if not id or id in seen_ids:
+                    continue
+                seen_ids.add(id)
+                yield StreamData(name=label, id=id)
+            next_token = self._next_start(response)
+            if next_token is None:
                 break
+        self._set_checkpoint(label, checkpoint)
 
     def discover(self) -> Generator[StreamData, None, None]:
-        yield from self._discover_helper('https://api.pipedrive.com/v1/deals', 'deal')
-        yield from self._discover_helper('https://api.pipedrive.com/v1/organizations', 'organization')
-        yield from self._discover_helper('https://api.pipedrive.com/v1/activities', 'activity')
+        yield from self._discover_helper('https://api.pipedrive.com/v1/deals', 'deal', 'deal')
+        yield from self._discover_helper('https://api.pipedrive.com/v1/organizations', 'organization', 'organization')
+        yield from self._discover_helper('https://api.pipedrive.com/v1/activities', 'activity', 'activity')
         yield from self._discover_helper('https://api.pipedrive.com/v1/leads', 'lead')
-        yield from self._discover_helper('https://api.pipedrive.com/v1/notes', 'note')
-        yield from self._discover_helper('https://api.pipedrive.com/v1/files', 'document')
-        yield from self._discover_helper('https://api.pipedrive.com/v1/users', 'user')
+        yield from self._discover_helper('https://api.pipedrive.com/v1/notes', 'note', 'note')
+        yield from self._discover_helper('https://api.pipedrive.com/v1/files', 'document', 'file')
+        yield from self._discover_helper('https://api.pipedrive.com/v1/users', 'user', 'user')
     
     def _fetch_helper(self, endpoint: str, stream: StreamData) -> None:
         response = self.request(endpoint)
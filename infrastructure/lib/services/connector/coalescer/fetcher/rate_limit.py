@@ -0,0 +1,141 @@
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Condition, Lock
+from time import monotonic
+from typing import Dict, Tuple
+
+# throttles that land within this window of the last decrease are the same congestion event and only halve once
+_DECREASE_COOLDOWN_SECONDS = 1.0
+# the rate never drops below this fraction of the configured rate, so a burst of 429s cannot stall a sync
+_MIN_RATE_FRACTION = 1 / 16
+
+
+@dataclass
+class RateLimitMetrics:
+    requests: int = 0
+    throttled: int = 0
+    retries: int = 0
+    throttle_seconds: float = 0.
+    rate: float = 0.
+    window: float = 0.
+
+    def as_dict(self) -> Dict:
+        return asdict(self)
+
+
+def parse_retry_after(value: str) -> float:
+    # Retry-After is either delay seconds or an http date
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0., (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class AdaptiveRateLimiter:
+    # token bucket for the request rate plus an aimd window for concurrent requests. throttled responses halve both
+    # and a Retry-After pauses every caller, successes grow them back additively up to the configured limits
+    def __init__(self, name: str, rate: float, burst: int, max_concurrency: int) -> None:
+        self._name = name
+        self._max_rate = rate
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at = monotonic()
+        self._max_concurrency = max_concurrency
+        self._window = float(max_concurrency)
+        self._in_flight = 0
+        self._paused_until = 0.
+        self._last_decrease_at = 0.
+        self._condition = Condition()
+        self._metrics = RateLimitMetrics()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(float(self._burst), self._tokens + (now - self._updated_at) * self._rate)
+        self._updated_at = now
+
+    def acquire(self, cost: int = 1) -> None:
+        # a request costing more than one token waits for one and leaves the bucket in debt, so batches larger than
+        # the burst still go out and later requests pay for them
+        started_at = monotonic()
+        with self._condition:
+            while True:
+                now = monotonic()
+                self._refill(now)
+                if now < self._paused_until:
+                    timeout = self._paused_until - now
+                elif self._in_flight >= int(self._window):
+                    # woken by release
+                    timeout = None
+                elif self._tokens < 1:
+                    timeout = (1 - self._tokens) / self._rate
+                else:
+                    break
+                self._condition.wait(timeout)
+            self._tokens -= cost
+            self._in_flight += 1
+            self._metrics.requests += cost
+            self._metrics.throttle_seconds += monotonic() - started_at
+
+    def _decrease(self, retry_after: float) -> None:
+        now = monotonic()
+        self._metrics.throttled += 1
+        if now - self._last_decrease_at > _DECREASE_COOLDOWN_SECONDS:
+            self._last_decrease_at = now
+            self._window = max(1., self._window / 2)
+            self._rate = max(self._max_rate * _MIN_RATE_FRACTION, self._rate / 2)
+            self._tokens = min(self._tokens, 0.)
+            print(f'[AdaptiveRateLimiter._decrease] {self._name} throttled, rate: {self._rate:.2f}/s, window: {self._window:.1f}')
+        if retry_after:
+            self._paused_until = max(self._paused_until, now + retry_after)
+
+    def throttle(self, retry_after: float = None) -> None:
+        # for throttles reported inside an otherwise successful response, e.g. a part of a batch
+        with self._condition:
+            self._decrease(retry_after)
+            self._condition.notify_all()
+
+    def release(self, throttled: bool = False, retry_after: float = None) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            if throttled:
+                self._decrease(retry_after)
+            else:
+                self._window = min(float(self._max_concurrency), self._window + 1 / self._window)
+                self._rate = min(self._max_rate, self._rate + self._max_rate * _MIN_RATE_FRACTION / 4)
+            self._condition.notify_all()
+
+    def record_retry(self, backoff_seconds: float) -> None:
+        with self._condition:
+            self._metrics.retries += 1
+            self._metrics.throttle_seconds += backoff_seconds
+
+    def metrics(self) -> RateLimitMetrics:
+        with self._condition:
+            self._metrics.rate = self._rate
+            self._metrics.window = self._window
+            return RateLimitMetrics(**asdict(self._metrics))
+
+
+_limiters: Dict[Tuple[str, str], AdaptiveRateLimiter] = {}
+_limiters_lock = Lock()
+
+
+def get_rate_limiter(integration: str, connection: str, rate: float, burst: int, max_concurrency: int) -> AdaptiveRateLimiter:
+    # one limiter per integration and connection, shared by every fetcher and worker in the process
+    key = (integration, connection)
+    with _limiters_lock:
+        limiter = _limiters.get(key, None)
+        if not limiter:
+            limiter = AdaptiveRateLimiter(f'{integration}/{connection}', rate=rate, burst=burst, max_concurrency=max_concurrency)
+            _limiters[key] = limiter
+        return limiter
@@ -1,18 +1,113 @@
+import gzip
+import json
+import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from csv import writer
 from dataclasses import dataclass
 from io import StringIO
-from typing import List
+from time import time
+from typing import Any, Dict, Generator, List, Set
 
 import boto3
 from fetcher.model import StreamData
 
+# packed table objects: gzip of json lines. the first line is a header naming and typing the columns, every following
+# line is a record batch of column value lists aligned with the header. graph_plot reads them a batch at a time
+COLUMNAR_FORMAT = 'columnar'
+COLUMNAR_VERSION = 1
+COLUMNAR_SUFFIX = '.columnar.json.gz'
+DEFAULT_PART_SIZE = 5000
+DEFAULT_RECORD_BATCH_SIZE = 500
+# text heavy tables (docs, mail bodies) cut a batch early so that graph_plot, which rejects record batch lines over
+# LAKE_MAX_FIELD_SIZE (32mb by default), decodes each one in bounded memory
+DEFAULT_RECORD_BATCH_BYTES = 8 * 1024 * 1024
+# delta synced tables gain parts every run. past this many they are rewritten to the latest row per id
+DEFAULT_COMPACT_AFTER_PARTS = 16
+_DELETE_BATCH_SIZE = 1000
+
 
 @dataclass
 class FlushResult:
     succeeded: bool
     stream: StreamData
 
+@dataclass
+class PartResult:
+    succeeded: bool
+    table: str
+    key: str
+    streams: List[StreamData]
+
+def _column_type(value: Any) -> str:
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'integer'
+    if isinstance(value, float):
+        return 'number'
+    if isinstance(value, str):
+        return 'string'
+    if isinstance(value, list):
+        return 'list'
+    if isinstance(value, dict):
+        return 'object'
+    return 'string'
+
+def _record_batches(streams: List[StreamData], record_batch_size: int, record_batch_bytes: int) -> Generator[List[StreamData], None, None]:
+    batch: List[StreamData] = []
+    batch_bytes = 0
+    for stream in streams:
+        # approximate: the row's values serialized as they will be in the column lists
+        stream_bytes = len(json.dumps(stream._data, default=str).encode('utf-8'))
+        if batch and (len(batch) >= record_batch_size or batch_bytes + stream_bytes > record_batch_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(stream)
+        batch_bytes += stream_bytes
+    if batch:
+        yield batch
+
+def encode_columnar(table: str,
+                    streams: List[StreamData],
+                    record_batch_size: int = DEFAULT_RECORD_BATCH_SIZE,
+                    record_batch_bytes: int = DEFAULT_RECORD_BATCH_BYTES) -> bytes:
+    columns: Dict[str, Set[str]] = {}
+    for stream in streams:
+        for key, value in stream._data.items():
+            types = columns.setdefault(key, set())
+            if value is not None:
+                types.add(_column_type(value))
+    names = list(columns.keys())
+
+    lines = [json.dumps({
+        'format': COLUMNAR_FORMAT,
+        'version': COLUMNAR_VERSION,
+        'table': table,
+        'rows': len(streams),
+        'columns': [{
+            'name': name,
+            'type': columns[name].pop() if len(columns[name]) == 1 else 'mixed',
+        } for name in names],
+    })]
+    for batch in _record_batches(streams, record_batch_size, record_batch_bytes):
+        lines.append(json.dumps({
+            'rows': len(batch),
+            'columns': [[stream._data.get(name, None) for stream in batch] for name in names],
+        }, default=str))
+    return gzip.compress('\n'.join(lines).encode('utf-8'))
+
+def decode_columnar(body: bytes) -> Generator[Dict[str, Any], None, None]:
+    lines = gzip.decompress(body).decode('utf-8').splitlines()
+    if not lines:
+        return
+    names = [column['name'] for column in json.loads(lines[0]).get('columns', [])]
+    for line in lines[1:]:
+        batch = json.loads(line)
+        columns = batch.get('columns', [])
+        for row in range(batch.get('rows', 0)):
+            yield {name: columns[index][row] for index, name in enumerate(names) if columns[index][row] is not None}
+
 class S3Lake:
     _bucket_name: str
     _prefix: str
@@ -21,17 +116,39 @@ class S3Lake:
     _stream_data: List[StreamData]
     _failures: int
 
-    def __init__(self, bucket_name: str, prefix: str, batch_size: int = 100) -> None:
+    def __init__(self,
+                 bucket_name: str,
+                 prefix: str,
+                 batch_size: int = 100,
+                 part_size: int = DEFAULT_PART_SIZE,
+                 format: str = None,
+                 compact_after_parts: int = None) -> None:
         self._s3_client = boto3.client('s3')
         self._bucket_name = bucket_name
         self._prefix = prefix
         self._batch_size = batch_size
+        self._part_size = part_size
+        self._format = format if format else os.getenv('LAKE_FORMAT', COLUMNAR_FORMAT)
+        self._compact_after_parts = compact_after_parts if compact_after_parts else int(os.getenv('LAKE_COMPACT_AFTER_PARTS', DEFAULT_COMPACT_AFTER_PARTS))
+        # part keys sort by run, which compaction relies on to keep the latest row per id. readers process parts
+        # concurrently and must not rely on the order
+        self._run_id = f'{int(time() * 1000):013d}'
 
         self._stream_data = []
         self._failures = 0
+        self._tables: Dict[str, List[StreamData]] = {}
+        self._part_counts: Dict[str, int] = {}
+        self._written_keys: Dict[str, Set[str]] = {}
 
     def add(self, stream: StreamData):
         print('[add] name: ', stream._name, 'id: ', stream._id)
+        if self._format == COLUMNAR_FORMAT:
+            table = self._tables.setdefault(stream._name, [])
+            table.append(stream)
+            if len(table) >= self._part_size:
+                self._flush_parts([stream._name])
+            return
+
         self._stream_data.append(stream)
         if len(self._stream_data) >= self._batch_size:
             self.flush()
@@ -54,8 +171,65 @@ class S3Lake:
             stream=stream
         )
 
+    def _part_key(self, table: str) -> str:
+        part = self._part_counts.get(table, 0)
+        self._part_counts[table] = part + 1
+        return f'{self._prefix}/{table}/part-{self._run_id}-{part:05d}{COLUMNAR_SUFFIX}'
+
+    def _flush_part(self, table: str, key: str, streams: List[StreamData]) -> PartResult:
+        print('[_flush_part] table: ', table, 'rows: ', len(streams), 'into bucket: ', self._bucket_name, 'key: ', key)
+        try:
+            response = self._s3_client.put_object(
+                Bucket=self._bucket_name,
+                Key=key,
+                Body=encode_columnar(table, streams),
+                ContentType='application/gzip'
+            )
+            status_code = response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        except Exception as e:
+            print(f'[_flush_part] error: {str(e)}')
+            status_code = 0
+        return PartResult(
+            succeeded=status_code == 200,
+            table=table,
+            key=key,
+            streams=streams
+        )
+
+    def _flush_parts(self, tables: List[str]):
+        parts = []
+        for table in tables:
+            streams = self._tables.pop(table, [])
+            for start in range(0, len(streams), self._part_size):
+                parts.append((table, self._part_key(table), streams[start:start + self._part_size]))
+        if not parts:
+            return
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            futures = [executor.submit(self._flush_part, *part) for part in parts]
+
+        failed = False
+        for future in as_completed(futures):
+            result = future.result()
+            if not result.succeeded:
+                print(f'[_flush_parts] failed to flush part {result.key}')
+                # retried under a new key with the next flush
+                self._tables.setdefault(result.table, []).extend(result.streams)
+                failed = True
+                continue
+            self._written_keys.setdefault(result.table, set()).add(result.key)
+            print(f'[_flush_parts] succeeded for {result.key}!')
+
+        self._failures = self._failures + 1 if failed else 0
+        if self._failures > 3:
+            raise Exception('[_flush_parts] Too many failures')
+
     def flush(self):
         print('[flush] bucket: ', self._bucket_name)
+        if self._format == COLUMNAR_FORMAT:
+            self._flush_parts(list(self._tables.keys()))
+            return
+
         if not self._stream_data:
             return
 
@@ -73,11 +247,79 @@ class S3Lake:
 
         if len(failed_streams) / len(self._stream_data) > 0.7:
             self._stream_data = failed_streams
-            self._failures += 1        
+            self._failures += 1
         else:
             self._stream_data = []
             self._failures = 0
-        
+
         if self._failures > 3:
             raise Exception('[flush] Too many failures')
-        
\ No newline at end of file
+
+    def _list_keys(self, table: str) -> List[str]:
+        keys: List[str] = []
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket_name, Prefix=f'{self._prefix}/{table}/'):
+            keys.extend(content['Key'] for content in page.get('Contents', []))
+        return keys
+
+    def _delete_superseded(self, table: str, written_keys: Set[str], parts_only: bool = False):
+        # a complete run is a full snapshot of the table, so older parts and legacy per-stream csv objects only hold
+        # stale copies of the same records. compaction only replaces parts
+        superseded = [key for key in self._list_keys(table)
+                      if key not in written_keys and (key.endswith(COLUMNAR_SUFFIX) or not parts_only)]
+
+        for start in range(0, len(superseded), _DELETE_BATCH_SIZE):
+            batch = superseded[start:start + _DELETE_BATCH_SIZE]
+            response = self._s3_client.delete_objects(
+                Bucket=self._bucket_name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+            for error in response.get('Errors', []):
+                print(f'[_delete_superseded] failed to delete {error.get("Key")}: {error.get("Message")}')
+        print(f'[_delete_superseded] table: {table}, deleted: {len(superseded)}')
+
+    def _compact(self, table: str):
+        # rewrites a delta table's parts to the latest row per id. parts are read oldest run first, so later rows win
+        part_keys = sorted(key for key in self._list_keys(table) if key.endswith(COLUMNAR_SUFFIX))
+        if len(part_keys) <= self._compact_after_parts:
+            return
+
+        latest: Dict[str, StreamData] = {}
+        for key in part_keys:
+            body = self._s3_client.get_object(Bucket=self._bucket_name, Key=key)['Body'].read()
+            for row in decode_columnar(body):
+                id = row.get('id', None)
+                if id is None:
+                    continue
+                stream = StreamData(name=table, id=id)
+                stream._data = row
+                latest[id] = stream
+
+        streams = list(latest.values())
+        parts = [(table, self._part_key(table), streams[start:start + self._part_size]) for start in range(0, len(streams), self._part_size)]
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(lambda part: self._flush_part(*part), parts))
+        if not all(result.succeeded for result in results):
+            # the old parts still hold every row, the partial rewrite only adds duplicates
+            print(f'[_compact] failed to rewrite {table}, keeping its {len(part_keys)} parts')
+            return
+        self._delete_superseded(table, set(result.key for result in results), parts_only=True)
+        print(f'[_compact] table: {table}, parts: {len(part_keys)} -> {len(results)}, rows: {len(streams)}')
+
+    def close(self, replace_previous: bool = True, delta_tables: Set[str] = None, failed_tables: Set[str] = None):
+        # delta_tables only received their changes this run, their earlier parts still hold everything else. they are
+        # compacted once their parts pile up. failed_tables are missing the rows that failed to fetch, so they keep
+        # their earlier parts the same way
+        self.flush()
+        if self._format != COLUMNAR_FORMAT:
+            return
+
+        while self._tables:
+            self.flush()
+        if not replace_previous:
+            return
+        for table, written_keys in self._written_keys.items():
+            if table in (delta_tables or set()) | (failed_tables or set()):
+                self._compact(table)
+                continue
+            self._delete_superseded(table, written_keys)
@@ -87,6 +87,9 @@ class Connection:
     config: Dict = None
     created_at: int = None
     sync: Sync = None
+    # per stream change cursors of the last successful sync, e.g. a gmail historyId. kept apart from sync, which the
+    # sync state machine overwrites as a whole
+    checkpoints: Dict[str, str] = None
     
     def is_valid(self):
         return self.id and self.name and self.integration and self.created_at
@@ -112,6 +112,7 @@ class LibraryConnectionItem(ParentChildItem):
             'auth': self.connection.auth.as_dict() if self.connection.auth else None,
             'config': self.connection.config,
             'sync': self.connection.sync.as_dict() if self.connection.sync else None,
+            'checkpoints': self.connection.checkpoints,
             'created_at': self.connection.created_at,
         }
 
@@ -135,6 +136,7 @@ class LibraryConnectionItem(ParentChildItem):
         integration = item.get('integration', None)
         created_at = item.get('created_at', None)
         sync = item.get('sync', None)
+        checkpoints = item.get('checkpoints', None)
         connection = Connection(
             id=child.split('#')[-1],
             name=name,
@@ -143,6 +145,7 @@ class LibraryConnectionItem(ParentChildItem):
             config=config,
             created_at=int(created_at) if created_at else None,
             sync=Sync.from_dict(sync) if sync else None,
+            checkpoints=dict(checkpoints) if checkpoints else None,
         )
 
         return LibraryConnectionItem(
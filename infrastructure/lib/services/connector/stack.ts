@@ -141,6 +141,19 @@ export class ConnectorStack extends Stack {
         resources: ["*"],
       })
     );
+    // fingerprints and embeddings outlive the task's ephemeral storage as objects under state/
+    this.graphPlotDefinition.container.jobRole.addToPrincipalPolicy(
+      new PolicyStatement({
+        actions: ["s3:GetObject", "s3:PutObject"],
+        resources: [`arn:aws:s3:::mimo-${props.stageId}-data-lake/state/*`],
+      })
+    );
+    this.graphPlotDefinition.container.jobRole.addToPrincipalPolicy(
+      new PolicyStatement({
+        actions: ["s3:ListBucket"],
+        resources: [`arn:aws:s3:::mimo-${props.stageId}-data-lake`],
+      })
+    );
     this.graphPlotDefinition.applyRemovalPolicy(RemovalPolicy.RETAIN);
 
     const syncSfn = this.getSyncSfn(
@@ -515,6 +528,7 @@ export class ConnectorStack extends Stack {
         cpu: 2,
         environment: {
           LAKE_BUCKET_NAME: `mimo-${stage}-data-lake`,
+          STATE_BUCKET_NAME: `mimo-${stage}-data-lake`,
           APP_SECRETS_PATH: `/${stage}/app_secrets`,
           NEO4J_URI: "neo4j+s://67eff9a1.databases.neo4j.io",
         },
@@ -1,13 +1,36 @@
+from dataclasses import dataclass
 from logging import getLogger
-from typing import List
+from typing import Dict, Generator, List, Union
 
 from dstruct.model import Block, Chunk
 from external.openai_ import OpenAI
+from store.embedding_cache import EmbeddingCache
+
+# rough chars per token for english text. avoids pulling tiktoken into graph_plot
+CHARS_PER_TOKEN = 4
+MAX_BATCH_TOKENS = 100000
+MAX_BATCH_SIZE = 2048
+
+
+@dataclass
+class EmbeddingTarget:
+    text: str
+    target: Union[Block, Chunk]
 
 
 class Embedder:
-    def __init__(self, llm: OpenAI, log_level: int) -> None:
+    def __init__(
+        self,
+        llm: OpenAI,
+        log_level: int,
+        cache: EmbeddingCache = None,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        max_batch_size: int = MAX_BATCH_SIZE
+    ) -> None:
         self._llm = llm
+        self._cache = cache
+        self._max_batch_tokens = max_batch_tokens
+        self._max_batch_size = max_batch_size
 
         self._logger = getLogger('Embedder')
         self._logger.setLevel(log_level)
@@ -41,23 +64,96 @@ class Embedder:
 
         return embeddable
 
-    def block_with_embeddings(self, block: Block) -> None:
+    def _structured_embeddable(self, block: Block) -> str:
+        # sorted so that the same block content always produces the same text and cache key
+        return '\n'.join(sorted([f'{property.key}: {property.value}' for property in block.get_structured_properties()]))
+
+    def _estimate_tokens(self, text: str) -> int:
+        return len(text) // CHARS_PER_TOKEN + 1
+
+    def _targets(self, block: Block) -> List[EmbeddingTarget]:
         unstructured_properties = block.get_unstructured_properties()
         if not unstructured_properties:
-            block.embedding = self._llm.embed(str(block.properties))
-            self._logger.debug(f'[block_with_embeddings] embedded structured block for {block.id}')
-            return
+            return [EmbeddingTarget(text=self._structured_embeddable(block), target=block)]
 
         chunks = []
         for property in unstructured_properties:
             chunks.extend(property.chunks)
-        condensed_chunk_string = self._embeddable(chunks)
-        block.embedding = self._llm.embed(condensed_chunk_string)
-
+        targets = [EmbeddingTarget(text=self._embeddable(chunks), target=block)]
         for property in unstructured_properties:
             if len(property.chunks) == 1:
-                property.chunks[0].embedding = block.embedding
+                # single chunk properties share the block embedding, see _scatter
                 continue
             for chunk in property.chunks:
-                chunk.embedding = self._llm.embed(chunk.text)
-        self._logger.debug(f'[block_with_embeddings] embedded unstructured block for {block.id}')
+                targets.append(EmbeddingTarget(text=chunk.text, target=chunk))
+        return targets
+
+    def _batches(self, texts: List[str]) -> Generator[List[str], None, None]:
+        batch: List[str] = []
+        batch_tokens = 0
+        for text in texts:
+            tokens = self._estimate_tokens(text)
+            if batch and (batch_tokens + tokens > self._max_batch_tokens or len(batch) >= self._max_batch_size):
+                yield batch
+                batch = []
+                batch_tokens = 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch
+
+    def _embed_batch(self, batch: List[str]) -> Dict[str, List[float]]:
+        # a failed batch is split in half and retried, so one bad input only fails itself
+        try:
+            embeddings = self._llm.embed_batch(batch)
+        except Exception as e:
+            self._logger.error(f'[_embed_batch] error embedding batch of {len(batch)} texts: {str(e)}')
+            embeddings = None
+        if not embeddings:
+            if len(batch) == 1:
+                self._logger.error(f'[_embed_batch] no embedding for text of {len(batch[0])} chars')
+                return {}
+            self._logger.warning(f'[_embed_batch] splitting failed batch of {len(batch)} texts')
+            middle = len(batch) // 2
+            return {**self._embed_batch(batch[:middle]), **self._embed_batch(batch[middle:])}
+
+        batch_to_embedding = {text: embedding for text, embedding in zip(batch, embeddings) if embedding}
+        if self._cache:
+            self._cache.put_many(batch_to_embedding)
+        self._logger.debug(f'[_embed_batch] embedded batch of {len(batch)} texts')
+        return batch_to_embedding
+
+    def _embed_all(self, texts: List[str]) -> Dict[str, List[float]]:
+        unique_texts = list(dict.fromkeys([text for text in texts if text]))
+        text_to_embedding: Dict[str, List[float]] = self._cache.get_many(unique_texts) if self._cache else {}
+        uncached_texts = [text for text in unique_texts if text not in text_to_embedding]
+        self._logger.debug(f'[_embed_all] {len(unique_texts) - len(uncached_texts)} cached out of {len(unique_texts)} texts')
+        for batch in self._batches(uncached_texts):
+            text_to_embedding.update(self._embed_batch(batch))
+        return text_to_embedding
+
+    def _scatter(self, block: Block) -> None:
+        for property in block.get_unstructured_properties():
+            if len(property.chunks) == 1:
+                property.chunks[0].embedding = block.embedding
+
+    def blocks_with_embeddings(self, blocks: List[Block]) -> None:
+        if not blocks:
+            return
+
+        targets: List[EmbeddingTarget] = []
+        for block in blocks:
+            try:
+                targets.extend(self._targets(block))
+            except Exception as e:
+                self._logger.error(f'[blocks_with_embeddings] error preparing block {block.id}: {str(e)}')
+
+        text_to_embedding = self._embed_all([target.text for target in targets])
+        for target in targets:
+            target.target.embedding = text_to_embedding.get(target.text, None)
+        for block in blocks:
+            self._scatter(block)
+        self._logger.debug(f'[blocks_with_embeddings] embedded {len(blocks)} blocks with {len(targets)} texts in {len(text_to_embedding)} unique embeddings')
+
+    def block_with_embeddings(self, block: Block) -> None:
+        self.blocks_with_embeddings([block])
@@ -35,7 +35,8 @@ class Normalizer:
     
     def _casted(self, raw_dict: Dict[str, Any], key: str) -> None:
         value = raw_dict[key]
-        if not value:
+        # values from columnar lake objects already carry their types, only csv strings need inferring
+        if not (value and isinstance(value, str)):
             return
         
         try:  # bool
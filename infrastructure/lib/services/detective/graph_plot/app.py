@@ -3,8 +3,10 @@ import os
 import sys
 import traceback
 from argparse import ArgumentParser
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Any, Dict, List, Set
+from dataclasses import dataclass, field
+from functools import partial
+from threading import Lock
+from typing import Any, Dict, Generator, Iterator, List, Set
 
 from algos.classifier import Classifier
 from algos.embedder import Embedder
@@ -13,12 +15,17 @@ from algos.normalizer import Normalizer
 from dstruct.base import DStruct
 from dstruct.graphdb import GraphDB
 from dstruct.model import Block, Entity
+from dstruct.schema import GraphSchema
 from dstruct.vectordb import VectorDB
 from external.neo4j_ import Neo4j
-from external.openai_ import OpenAI
+from external.openai_ import EMBEDDING_DIMENSION, EMBEDDING_MODEL, OpenAI
 from external.pinecone_ import Pinecone
-from lake.s3 import S3Lake
+from lake.s3 import LakeObject, S3Lake
+from pipeline import Pipeline, Stage
+from store.embedding_cache import EmbeddingCache
+from store.fingerprints import Fingerprints, content_fingerprint
 from store.params import SSM
+from store.vector_index import LocalVectorIndex
 
 _logger = logging.getLogger('GraphPlot')
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +34,77 @@ _arg_parser: ArgumentParser = ArgumentParser()
 _arg_parser.add_argument('--integration', type=str, required=True)
 _arg_parser.add_argument('--connection', type=str, required=True)
 _arg_parser.add_argument('--library', type=str, required=True)
+_arg_parser.add_argument('--full_refresh', action='store_true')
+_arg_parser.add_argument('--fetch_workers', type=int, default=4)
+_arg_parser.add_argument('--prepare_workers', type=int, default=2)
+_arg_parser.add_argument('--embed_workers', type=int, default=2)
+_arg_parser.add_argument('--extract_workers', type=int, default=10)
+_arg_parser.add_argument('--write_workers', type=int, default=1)
+
+@dataclass
+class ObjectItem:
+    label: str
+    lake_object: LakeObject
+    rows: Iterator[Dict[str, Any]] = None
+    pending: int = 0
+    listed: bool = False
+    failed: bool = False
+    lock: Lock = field(default_factory=Lock, repr=False)
+
+    # rows are counted by the parse stage while earlier ones are already being completed downstream, so whichever
+    # side sees the last row settle reports the object as fully ingested
+    def add_pending(self) -> None:
+        with self.lock:
+            self.pending += 1
+
+    def finish_listing(self, failed: bool = False) -> bool:
+        with self.lock:
+            self.listed = True
+            self.failed = self.failed or failed
+            return self.pending == 0 and not self.failed
+
+    def complete(self, failed: bool = False) -> bool:
+        with self.lock:
+            self.pending -= 1
+            self.failed = self.failed or failed
+            return self.listed and self.pending == 0 and not self.failed
+
+@dataclass
+class BlockItem:
+    source: ObjectItem
+    block_dict: Dict[str, Any]
+    block: Block = None
+    fingerprint: str = None
+    entities: List[Entity] = None
+    adjacent_block_ids: Set[str] = None
+    skipped: bool = False
+    failed: bool = False
+    merged: bool = False
+
+    @property
+    def active(self) -> bool:
+        return not (self.skipped or self.failed)
+
+class LatestVersions:
+    # the newest last_updated_timestamp seen per block id in this run. a delta synced table holds one row per synced
+    # version of a record and objects are processed concurrently, so rows older than one already seen are skipped
+    # instead of overwriting it
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._timestamps: Dict[str, int] = {}
+
+    def offer(self, block_id: str, last_updated_timestamp: int) -> bool:
+        timestamp = last_updated_timestamp or 0
+        with self._lock:
+            latest = self._timestamps.get(block_id, None)
+            if latest is not None and latest > timestamp:
+                return False
+            self._timestamps[block_id] = timestamp
+            return True
+
+    def is_latest(self, block_id: str, last_updated_timestamp: int) -> bool:
+        with self._lock:
+            return self._timestamps.get(block_id, 0) <= (last_updated_timestamp or 0)
 
 def main():
     global _arg_parser, _logger
@@ -38,96 +116,226 @@ def main():
     log_level = logging.getLevelName(log_level) if log_level else logging.DEBUG
     if not (lake_bucket_name and app_secrets_path and neo4j_uri and log_level):
         raise Exception(f'[main] missing env vars! lake_bucket_name: {lake_bucket_name}, app_secrets_path: {app_secrets_path}, neo4j_uri: {neo4j_uri}')
-    
+
     _logger.setLevel(log_level)
     args = _arg_parser.parse_args()
     args = vars(args)
     integration = args.get('integration', None)
     connection = args.get('connection', None)
     library = args.get('library', None)
+    full_refresh = args.get('full_refresh', False)
     if not (integration and connection and library):
         raise Exception(f'[main] missing args! integration: {integration}, connection: {connection}, library: {library}')
-    
+
     secrets = SSM().load_params(app_secrets_path)
     openai_api_key = secrets.get('openai_api_key', None)
     pinecone_api_key = secrets.get('pinecone_api_key', None)
     neo4j_user = secrets.get('neo4j_user', None)
     neo4j_password = secrets.get('neo4j_password', None)
-    if not (openai_api_key and pinecone_api_key and neo4j_user and neo4j_password):
+    vector_backend = os.getenv('VECTOR_BACKEND', 'pinecone')
+    if not (openai_api_key and (pinecone_api_key or vector_backend == 'local') and neo4j_user and neo4j_password):
         raise Exception('[main] missing secrets!')
 
     neo4j = Neo4j(uri=neo4j_uri, user=neo4j_user, password=neo4j_password, log_level=log_level)
+    GraphSchema(log_level=log_level, db=neo4j).ensure()
     graphdb = GraphDB(db=neo4j)
-    pinecone = Pinecone(api_key=pinecone_api_key, environment='us-east1-gcp', index_name='beta', log_level=log_level)
-    vectordb = VectorDB(db=pinecone)
+    if vector_backend == 'local':
+        vectors = LocalVectorIndex(dimension=EMBEDDING_DIMENSION, log_level=log_level)
+    else:
+        vectors = Pinecone(api_key=pinecone_api_key, environment='us-east1-gcp', index_name='beta', log_level=log_level)
+    vectordb = VectorDB(db=vectors)
     dstruct = DStruct(graphdb=graphdb, vectordb=vectordb, library=library, log_level=log_level)
 
     llm = OpenAI(api_key=openai_api_key, log_level=log_level)
     classifier = Classifier(log_level=log_level)
     normalizer = Normalizer(max_chunk_len=1000, chunk_overlap=100, log_level=log_level)
     entity_extractor = EntityExtractor(llm=llm, log_level=log_level)
-    embedder = Embedder(llm=llm, log_level=log_level)
-    
+    # one object per library and connection, whose syncs never overlap
+    embedding_cache = EmbeddingCache(
+        model=EMBEDDING_MODEL,
+        log_level=log_level,
+        state_key=f'state/embedding_cache/{library}/{connection}.db'
+    )
+    embedder = Embedder(llm=llm, log_level=log_level, cache=embedding_cache)
+
+    fingerprints = Fingerprints(library=library, connection=connection, log_level=log_level)
     lake = S3Lake(lake_bucket_name, prefix=f'v1/{library}/{connection}/', log_level=log_level)
-    tables = lake.get_tables()
+    latest_versions = LatestVersions()
+
+    pipeline = Pipeline(stages=[
+        Stage(
+            name='fetch',
+            function=partial(fetch_object, lake=lake, fingerprints=fingerprints, full_refresh=full_refresh),
+            workers=args.get('fetch_workers'),
+            queue_size=50
+        ),
+        Stage(
+            name='parse',
+            function=partial(parse_object, lake=lake, fingerprints=fingerprints),
+            fan_out=True,
+            queue_size=50
+        ),
+        Stage(
+            name='prepare',
+            function=partial(
+                prepare_block,
+                classifier=classifier,
+                normalizer=normalizer,
+                fingerprints=fingerprints,
+                latest_versions=latest_versions,
+                integration=integration,
+                connection=connection,
+                full_refresh=full_refresh
+            ),
+            workers=args.get('prepare_workers'),
+            queue_size=1000,
+            on_error=mark_failed
+        ),
+        Stage(
+            name='embed',
+            function=partial(embed_blocks, embedder=embedder),
+            workers=args.get('embed_workers'),
+            queue_size=1000,
+            batch_size=256,
+            on_error=mark_failed
+        ),
+        Stage(
+            name='extract',
+            function=partial(extract_entities, entity_extractor=entity_extractor),
+            workers=args.get('extract_workers'),
+            queue_size=500,
+            on_error=mark_failed
+        ),
+        Stage(
+            name='write',
+            function=partial(write_blocks, dstruct=dstruct, latest_versions=latest_versions),
+            workers=args.get('write_workers'),
+            queue_size=1000,
+            batch_size=500,
+            on_error=mark_failed
+        ),
+    ], log_level=log_level)
+
+    def object_items() -> Generator[ObjectItem, None, None]:
+        table_labels: Dict[str, str] = {}
+        for table in lake.get_tables():
+            label = classifier.get_normalized_label(table)
+            if not label:
+                continue
+
+            _logger.info(f'[main] table: {table}, label: {label}')
+            table_labels[table] = label
+        for table, lake_object in lake.tables_block_iterator(list(table_labels.keys())):
+            yield ObjectItem(label=table_labels[table], lake_object=lake_object)
+
     max_sequential_failures = 200
+    try:
+        for item in pipeline.run(object_items()):
+            source = item.source
+            if item.merged:
+                fingerprints.put(item.block.id, item.fingerprint)
+            if source.complete(failed=item.failed):
+                put_object_fingerprint(source, fingerprints)
 
-    for table in tables:
-        label = classifier.get_normalized_label(table)
-        if not label:
-            continue
-
-        _logger.info(f'[main] table: {table}, label: {label}')
-        for block_key in lake.block_iterator(table):
-            block_dicts = lake.get_block_csv(block_key)
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = [executor.submit(
-                    ingest_block,
-                    dstruct=dstruct,
-                    classifier=classifier,
-                    normalizer=normalizer,
-                    entity_extractor=entity_extractor,
-                    embedder=embedder,
-                    label=label,
-                    integration=integration,
-                    connection=connection,
-                    block_dict=block_dict
-                ) for block_dict in block_dicts]
-
-            for future in as_completed(futures):
-                result = future.result()
-                if not result:
-                    max_sequential_failures -= 1
-                    if max_sequential_failures <= 0:
-                        dstruct.clean_adjacent_blocks(connection=connection)
-                        neo4j.close()
-                        raise Exception(f'[main] max_sequential_failures reached!')
-                else:
-                    max_sequential_failures = 200
-                _logger.info(f'[main] result: {result}')
+            if item.skipped:
+                continue
+            if item.failed:
+                max_sequential_failures -= 1
+                if max_sequential_failures <= 0:
+                    dstruct.clean_adjacent_blocks(connection=connection)
+                    raise Exception(f'[main] max_sequential_failures reached!')
+            else:
+                max_sequential_failures = 200
+            _logger.info(f'[main] result: {item.merged}')
+    except Exception:
+        lake.close()
+        embedding_cache.close()
+        fingerprints.close()
+        vectors.close()
+        neo4j.close()
+        raise
 
     # TODO: for each root block, find all adjacent blocks. for each cluster of data summarize and embed into the vector db
     dstruct.clean_adjacent_blocks(connection=connection)
+    # blocks merged before the adjacency summaries existed are skipped as unchanged, so they are backfilled here
+    if full_refresh or dstruct.needs_adjacency_backfill(connection=connection):
+        dstruct.backfill_adjacency(connection=connection)
+    lake.close()
+    embedding_cache.close()
+    fingerprints.close()
+    vectors.close()
     neo4j.close()
 
-def ingest_block(dstruct: DStruct,
-                 classifier: Classifier,
-                 normalizer: Normalizer,
-                 entity_extractor: EntityExtractor,
-                 embedder: Embedder,
-                 label: str,
-                 integration: str,
-                 connection: str,
-                 block_dict: Dict[str, Any]) -> bool:
+def mark_failed(item: BlockItem) -> BlockItem:
+    item.failed = True
+    return item
+
+def fetch_object(item: ObjectItem, lake: S3Lake, fingerprints: Fingerprints, full_refresh: bool) -> ObjectItem:
+    global _logger
+    lake_object = item.lake_object
+    if not full_refresh and lake_object.etag and fingerprints.get(lake_object.key, 'object') == lake_object.etag:
+        _logger.info(f'[fetch_object] skipping unchanged object: {lake_object.key}')
+        return None
+
+    try:
+        item.rows = lake.get_block_rows(lake_object.key)
+        return item
+    except Exception as e:
+        _logger.error(f'[fetch_object] error fetching {lake_object.key}: {str(e)}')
+        return None
+
+def put_object_fingerprint(item: ObjectItem, fingerprints: Fingerprints) -> None:
+    if item.lake_object.etag:
+        fingerprints.put(item.lake_object.key, item.lake_object.etag, 'object')
+
+def parse_object(item: ObjectItem, lake: S3Lake, fingerprints: Fingerprints) -> Generator[BlockItem, None, None]:
     global _logger
+    # only a listing read to the end counts, e.g. not one closed early by a stopped pipeline
+    failed = True
     try:
+        for block_dict in item.rows:
+            item.add_pending()
+            yield BlockItem(source=item, block_dict=block_dict)
+        failed = False
+    except Exception as e:
+        _logger.error(f'[parse_object] error parsing {item.lake_object.key}: {str(e)}')
+        failed = True
+    finally:
+        item.rows = None
+        if item.finish_listing(failed=failed):
+            put_object_fingerprint(item, fingerprints)
+
+def prepare_block(item: BlockItem,
+                  classifier: Classifier,
+                  normalizer: Normalizer,
+                  fingerprints: Fingerprints,
+                  latest_versions: LatestVersions,
+                  integration: str,
+                  connection: str,
+                  full_refresh: bool) -> BlockItem:
+    global _logger
+    try:
+        label = item.source.label
+        block_dict = item.block_dict
+        item.fingerprint = content_fingerprint(label, block_dict)
         block_id = classifier.find_id(raw_dict=block_dict, label=label)
         if not block_id:
-            _logger.error(f'[ingest_block] error invalid block_id for block: {block_dict}')
-            return False
+            _logger.error(f'[prepare_block] error invalid block_id for block: {block_dict}')
+            item.failed = True
+            return item
         normalizer.sanitize(block_dict)
         last_updated_timestamp = normalizer.find_last_updated_ts(block_dict)
-        dstruct_block = Block(
+        # offered before the fingerprint check, so an unchanged latest version still supersedes older rows of the block
+        if not latest_versions.offer(block_id, last_updated_timestamp):
+            _logger.debug(f'[prepare_block] skipping superseded version of block: {block_id}')
+            item.skipped = True
+            return item
+        if not full_refresh and fingerprints.get(block_id) == item.fingerprint:
+            _logger.debug(f'[prepare_block] skipping unchanged block: {block_id}')
+            item.skipped = True
+            return item
+
+        item.block = Block(
             id=block_id,
             label=label,
             integration=integration,
@@ -136,11 +344,37 @@ def ingest_block(dstruct: DStruct,
             last_updated_timestamp=last_updated_timestamp,
             embedding=None
         )
-        normalizer.with_properties(dstruct_block, block_dict)
-        embedder.block_with_embeddings(dstruct_block)
+        normalizer.with_properties(item.block, block_dict)
+    except Exception as e:
+        _logger.error(f'[prepare_block] error: {str(e)}')
+        _logger.error(traceback.format_exc())
+        item.failed = True
+    return item
+
+def embed_blocks(items: List[BlockItem], embedder: Embedder) -> List[BlockItem]:
+    global _logger
+    active_items = [item for item in items if item.active]
+    try:
+        embedder.blocks_with_embeddings([item.block for item in active_items])
+    except Exception as e:
+        _logger.error(f'[embed_blocks] error: {str(e)}')
+        _logger.error(traceback.format_exc())
+
+    for item in active_items:
+        if not item.block.embedding:
+            _logger.error(f'[embed_blocks] error missing embedding for block: {item.block.id}')
+            item.failed = True
+    return items
+
+def extract_entities(item: BlockItem, entity_extractor: EntityExtractor) -> BlockItem:
+    global _logger
+    if not item.active:
+        return item
+
+    try:
         entities: List[Entity] = []
-        entity_extractor.with_defined_entities(dictionary=block_dict, entities=entities)
-        entity_extractor.with_llm_reasoned_entities(block=dstruct_block, entities=entities)
+        entity_extractor.with_defined_entities(dictionary=item.block_dict, entities=entities)
+        entity_extractor.with_llm_reasoned_entities(block=item.block, entities=entities)
         entity_extractor.deduplicate(entities)
 
         adjacent_block_ids: Set[str] = set()
@@ -151,13 +385,41 @@ def ingest_block(dstruct: DStruct,
             if entity.identifiables and len(entity.identifiables) == 1:
                 adjacent_block_ids.add(entity.identifiables.pop())
 
-        _logger.info(f'[ingest_block] merging block: {block_id}, entities: {entities}, adjacent_block_ids: {adjacent_block_ids}')
-        dstruct.merge(block=dstruct_block, entities=entities, adjacent_block_ids=adjacent_block_ids)
-        return True
+        item.entities = entities
+        item.adjacent_block_ids = adjacent_block_ids
+        _logger.info(f'[extract_entities] block: {item.block.id}, entities: {entities}, adjacent_block_ids: {adjacent_block_ids}')
+    except Exception as e:
+        _logger.error(f'[extract_entities] error: {str(e)}')
+        _logger.error(traceback.format_exc())
+        item.failed = True
+    return item
+
+def write_blocks(items: List[BlockItem], dstruct: DStruct, latest_versions: LatestVersions) -> List[BlockItem]:
+    global _logger
+    # a newer version may have been prepared since this one was
+    for item in items:
+        if item.active and not latest_versions.is_latest(item.block.id, item.block.last_updated_timestamp):
+            _logger.debug(f'[write_blocks] skipping superseded version of block: {item.block.id}')
+            item.skipped = True
+    active_items = [item for item in items if item.active]
+    if not active_items:
+        return items
+
+    try:
+        dstruct.merge_many(
+            blocks=[item.block for item in active_items],
+            entities_by_block={item.block.id: item.entities for item in active_items if item.entities},
+            adjacency_by_block={item.block.id: item.adjacent_block_ids for item in active_items if item.adjacent_block_ids}
+        )
+        for item in active_items:
+            item.merged = True
+        _logger.info(f'[write_blocks] merged {len(active_items)} blocks')
     except Exception as e:
-        _logger.error(f'[ingest_block] error: {str(e)}')
+        _logger.error(f'[write_blocks] error merging {len(active_items)} blocks: {str(e)}')
         _logger.error(traceback.format_exc())
-        return False
+        for item in active_items:
+            item.failed = True
+    return items
 
 if __name__ == '__main__':
     try:
@@ -166,4 +428,4 @@ if __name__ == '__main__':
     except Exception as e:
         _logger.debug(f'error: {str(e)}')
         _logger.debug(traceback.format_exc())
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -1,80 +1,264 @@
 import csv
-import sys
+import gzip
+import io
+import json
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
 from logging import getLogger
-from typing import Dict, Generator, List
+from queue import Empty, Full, Queue
+from threading import Event, Lock
+from typing import Deque, Dict, Generator, Iterator, List, Tuple
 
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
 _logger = getLogger('S3Lake')
 
-max_int = sys.maxsize
-while True:
-    try:
-        csv.field_size_limit(max_int)
-        break
-    except OverflowError:
-        max_int = int(max_int / 10)
+# a single field above this (e.g. a runaway email thread) fails its object instead of growing memory unbounded
+DEFAULT_MAX_FIELD_SIZE = 32 * 1024 * 1024
+# objects are fetched in ranges of this many bytes. 0 streams the whole object over one connection instead
+DEFAULT_RANGE_SIZE = 8 * 1024 * 1024
+# ranges downloaded in the background ahead of the one being parsed, per object
+DEFAULT_READ_AHEAD = 2
+DEFAULT_LIST_WORKERS = 4
+DEFAULT_MAX_POOL_CONNECTIONS = 32
+_STREAM_CHUNK_SIZE = 1024 * 1024
+# packed table objects written by the coalescer: gzip of json lines, a header typing the columns followed by record
+# batches of column value lists. anything else under a table prefix is a legacy one-row csv
+COLUMNAR_FORMAT = 'columnar'
+COLUMNAR_VERSION = 1
+COLUMNAR_SUFFIX = '.columnar.json.gz'
+_LISTING_QUEUE_SIZE = 1000
+_POLL_SECONDS = 0.5
+
+# caps a csv field and a columnar record batch line alike, so one oversized object cannot exhaust the task's memory
+_MAX_FIELD_SIZE = int(os.getenv('LAKE_MAX_FIELD_SIZE', DEFAULT_MAX_FIELD_SIZE))
+csv.field_size_limit(_MAX_FIELD_SIZE)
+
+@dataclass
+class LakeObject:
+    key: str
+    etag: str
+
+class _ChunkReader(io.RawIOBase):
+    # file-like view over an iterator of byte chunks so that TextIOWrapper can decode it incrementally
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._chunk = memoryview(b'')
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+class _Done:
+    pass
+
+_DONE = _Done()
 
 class S3Lake:
     _bucket_name: str
     _prefix: str
+    # boto3 clients are thread safe, so every lake (and every listing and read-ahead thread) shares one connection pool
     _s3_client = None
+    _s3_client_lock = Lock()
 
-    def __init__(self, bucket_name: str, prefix: str, log_level: int) -> None:
-        if not self._s3_client:
-            self._s3_client = boto3.client('s3')
+    def __init__(self,
+                 bucket_name: str,
+                 prefix: str,
+                 log_level: int,
+                 range_size: int = None,
+                 read_ahead: int = DEFAULT_READ_AHEAD,
+                 list_workers: int = DEFAULT_LIST_WORKERS) -> None:
+        with S3Lake._s3_client_lock:
+            if not S3Lake._s3_client:
+                S3Lake._s3_client = boto3.client('s3', config=Config(
+                    max_pool_connections=int(os.getenv('LAKE_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+                    retries={'max_attempts': 5, 'mode': 'adaptive'}
+                ))
         self._bucket_name = bucket_name
         self._prefix = prefix
+        self._range_size = range_size if range_size is not None else int(os.getenv('LAKE_RANGE_SIZE', DEFAULT_RANGE_SIZE))
+        self._read_ahead = read_ahead
+        self._list_workers = list_workers
+        self._read_executor = ThreadPoolExecutor(max_workers=max(1, read_ahead) * 4, thread_name_prefix='lake-read')
         _logger.setLevel(log_level)
 
+    def close(self) -> None:
+        self._read_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _list_pages(self, prefix: str, delimiter: str = None) -> Generator[Dict, None, None]:
+        extra_args = {
+            'Delimiter': delimiter,
+        } if delimiter else {}
+        paginator = self._s3_client.get_paginator('list_objects_v2')
+        for page_number, page in enumerate(paginator.paginate(Bucket=self._bucket_name, Prefix=prefix, **extra_args)):
+            _logger.debug(f'[_list_pages] prefix: {prefix}, page: {page_number}, keys: {page.get("KeyCount", 0)}')
+            yield page
+
     def get_tables(self) -> List[str]:
         _logger.info(f'[get_tables] bucket_name: {self._bucket_name}, prefix: {self._prefix}')
-        response = self._s3_client.list_objects_v2(
-            Bucket=self._bucket_name,
-            Prefix=self._prefix,
-            Delimiter='/'
-        )
-
-        listed_tables = [common_prefix['Prefix'].split('/')[-2] for common_prefix in response.get('CommonPrefixes', [])]
+        listed_tables = []
+        for page in self._list_pages(self._prefix, delimiter='/'):
+            listed_tables.extend(common_prefix['Prefix'].split('/')[-2] for common_prefix in page.get('CommonPrefixes', []))
         _logger.info(f'[get_tables] listed_tables: {listed_tables}')
 
         return listed_tables
-        
-    def block_iterator(self, table: str) -> Generator[str, None, None]:
+
+    def block_iterator(self, table: str) -> Generator[LakeObject, None, None]:
         _logger.info(f'[block_iterator] bucket_name: {self._bucket_name}, prefix: {self._prefix}, table: {table}')
-        next_token = None
-        while True:
-            extra_args = {
-                'ContinuationToken': next_token,
-            } if next_token else {}
+        for page in self._list_pages(f'{self._prefix}{table}/'):
+            for content in page.get('Contents', []):
+                yield LakeObject(key=content['Key'], etag=content.get('ETag', None))
 
-            response = self._s3_client.list_objects_v2(
+    def tables_block_iterator(self, tables: List[str]) -> Generator[Tuple[str, LakeObject], None, None]:
+        # lists up to list_workers tables at once. objects of different tables interleave, each table stays in order
+        if not tables:
+            return
+
+        queue = Queue(maxsize=_LISTING_QUEUE_SIZE)
+        stop = Event()
+
+        def put(item) -> None:
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=_POLL_SECONDS)
+                    return
+                except Full:
+                    continue
+
+        def list_table(table: str) -> None:
+            try:
+                for lake_object in self.block_iterator(table):
+                    if stop.is_set():
+                        return
+                    put((table, lake_object))
+            except Exception as e:
+                _logger.error(f'[tables_block_iterator] failed to list table {table}: {str(e)}')
+            finally:
+                put(_DONE)
+
+        executor = ThreadPoolExecutor(max_workers=min(self._list_workers, len(tables)), thread_name_prefix='lake-list')
+        for table in tables:
+            executor.submit(list_table, table)
+        try:
+            remaining = len(tables)
+            while remaining:
+                try:
+                    item = queue.get(timeout=_POLL_SECONDS)
+                except Empty:
+                    continue
+                if item is _DONE:
+                    remaining -= 1
+                    continue
+                yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _get_range(self, block_key: str, start: int, etag: str = None) -> Tuple[bytes, int, str]:
+        extra_args = {
+            'IfMatch': etag,
+        } if etag else {}
+        try:
+            response = self._s3_client.get_object(
                 Bucket=self._bucket_name,
-                Prefix=f'{self._prefix}{table}/',
+                Key=block_key,
+                Range=f'bytes={start}-{start + self._range_size - 1}',
                 **extra_args
             )
-            _logger.info(f'[block_iterator] response: {response}')
-            next_token = response.get('NextContinuationToken', None)
-            for content in response.get('Contents', []):
-                yield content['Key']
+        except ClientError as e:
+            # ranges over an empty object are unsatisfiable
+            if start == 0 and e.response.get('Error', {}).get('Code', None) == 'InvalidRange':
+                return b'', 0, etag
+            raise
+        content_range = response.get('ContentRange', None)
+        size = int(content_range.split('/')[-1]) if content_range else response['ContentLength']
+        return response['Body'].read(), size, response.get('ETag', etag)
+
+    def _ranged_chunks(self, block_key: str, first: Tuple[bytes, int, str]) -> Generator[bytes, None, None]:
+        data, size, etag = first
+        next_offset = len(data)
+        pending: Deque[Tuple[int, Future]] = deque()
 
-            if not next_token:
-                break
+        def schedule() -> None:
+            nonlocal next_offset
+            while len(pending) < max(1, self._read_ahead) and next_offset < size:
+                # pinned to the etag of the first range so a concurrently replaced object fails instead of mixing versions
+                pending.append((next_offset, self._read_executor.submit(self._get_range, block_key, next_offset, etag)))
+                next_offset += self._range_size
+
+        try:
+            schedule()
+            yield data
+            while pending:
+                offset, future = pending.popleft()
+                data, _, _ = future.result()
+                if len(data) != min(self._range_size, size - offset):
+                    raise ValueError(f'[S3Lake._ranged_chunks] short range at {offset} of {size} for {block_key}')
+                schedule()
+                yield data
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def get_block_chunks(self, block_key: str) -> Iterator[bytes]:
+        # the first range (or the response headers when streaming) is fetched eagerly, the rest as the iterator is consumed
+        _logger.info(f'[get_block_chunks] bucket_name: {self._bucket_name}, block_key: {block_key}')
+        if self._range_size > 0:
+            return self._ranged_chunks(block_key, self._get_range(block_key, 0))
 
-    def _get_block(self, block_key: str) -> str:
-        _logger.info(f'[_get_block] bucket_name: {self._bucket_name}, block_key: {block_key}')
         response = self._s3_client.get_object(
             Bucket=self._bucket_name,
             Key=block_key
         )
-        return response['Body'].read().decode('utf-8')  
-    
-    def get_block_csv(self, block_key: str) -> List[Dict]:
-        _logger.info(f'[get_block_csv] bucket_name: {self._bucket_name}, block_key: {block_key}')
-        content = self._get_block(block_key)
-        dict_list = []
-
-        csv_reader = csv.DictReader(content.splitlines())
-        for row in csv_reader:
-            dict_list.append(row)
-        return dict_list
+        return response['Body'].iter_chunks(chunk_size=_STREAM_CHUNK_SIZE)
+
+    def parse_block_csv(self, chunks: Iterator[bytes]) -> Generator[Dict, None, None]:
+        text = io.TextIOWrapper(io.BufferedReader(_ChunkReader(chunks)), encoding='utf-8', newline='')
+        try:
+            yield from csv.DictReader(text)
+        finally:
+            text.close()
+
+    def get_block_csv(self, block_key: str) -> Generator[Dict, None, None]:
+        return self.parse_block_csv(self.get_block_chunks(block_key))
+
+    def parse_block_columnar(self, chunks: Iterator[bytes]) -> Generator[Dict, None, None]:
+        text = io.TextIOWrapper(gzip.GzipFile(fileobj=io.BufferedReader(_ChunkReader(chunks))), encoding='utf-8')
+        try:
+            header = json.loads(text.readline() or '{}')
+            if header.get('format') != COLUMNAR_FORMAT or header.get('version') != COLUMNAR_VERSION:
+                raise ValueError(f'[S3Lake.parse_block_columnar] unsupported header {header.get("format")} v{header.get("version")}')
+            names = [column['name'] for column in header.get('columns', [])]
+            while True:
+                # only one record batch is decoded at a time
+                line = text.readline(_MAX_FIELD_SIZE + 1)
+                if not line:
+                    break
+                if len(line) > _MAX_FIELD_SIZE and not line.endswith('\n'):
+                    raise ValueError(f'[S3Lake.parse_block_columnar] record batch larger than {_MAX_FIELD_SIZE} characters')
+                batch = json.loads(line)
+                columns = batch['columns']
+                for row in range(batch['rows']):
+                    yield {name: column[row] for name, column in zip(names, columns) if column[row] is not None}
+        finally:
+            text.close()
+
+    def get_block_rows(self, block_key: str) -> Generator[Dict, None, None]:
+        # values of columnar objects keep their types, csv values are all strings
+        if block_key.endswith(COLUMNAR_SUFFIX):
+            return self.parse_block_columnar(self.get_block_chunks(block_key))
+        return self.get_block_csv(block_key)
@@ -0,0 +1,174 @@
+import traceback
+from dataclasses import dataclass
+from logging import getLogger
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Generator, Iterable, List
+
+_logger = getLogger('Pipeline')
+
+_POLL_SECONDS = 0.5
+
+
+class _Done:
+    pass
+
+
+_DONE = _Done()
+
+
+@dataclass
+class Stage:
+    name: str
+    # takes one item, or a list of up to batch_size items when batch_size > 1, and returns
+    # the item(s) to pass downstream. fan_out stages return an iterable that is flattened.
+    function: Callable[[Any], Any]
+    workers: int = 1
+    queue_size: int = 100
+    batch_size: int = 1
+    fan_out: bool = False
+    # maps an input item whose call raised to the item passed downstream in its place, e.g. the item marked failed,
+    # so that consumers account for it. without one the item is dropped
+    on_error: Callable[[Any], Any] = None
+
+
+class Pipeline:
+    def __init__(self, stages: List[Stage], log_level: int) -> None:
+        if not stages:
+            raise ValueError('[Pipeline] stages must not be empty')
+        self._stages = stages
+        self._stop = Event()
+        self._source_error: Exception = None
+        self._dropped = 0
+        self._dropped_lock = Lock()
+
+        _logger.setLevel(log_level)
+
+    def _put(self, queue: Queue, item: Any) -> bool:
+        while not self._stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL_SECONDS)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue: Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return queue.get(timeout=_POLL_SECONDS)
+            except Empty:
+                continue
+        return _DONE
+
+    def _next_batch(self, stage: Stage, queue: Queue) -> List[Any]:
+        first = self._get(queue)
+        if first is _DONE:
+            return None
+        batch = [first]
+        while len(batch) < stage.batch_size:
+            try:
+                item = queue.get_nowait()
+            except Empty:
+                break
+            if item is _DONE:
+                # hand the sentinel back so that sibling workers see it too
+                self._put(queue, _DONE)
+                break
+            batch.append(item)
+        return batch
+
+    def _emit(self, stage: Stage, output: Any, out_queue: Queue) -> None:
+        if output is None:
+            return
+        if stage.fan_out or stage.batch_size > 1:
+            try:
+                for item in output:
+                    # once stopped, stop pulling from fan out generators instead of reading their source to the end
+                    if item is not None and not self._put(out_queue, item):
+                        return
+            finally:
+                close = getattr(output, 'close', None)
+                if close:
+                    close()
+        else:
+            self._put(out_queue, output)
+
+    def _worker(self, stage: Stage, in_queue: Queue, out_queue: Queue, remaining: List[int], lock: Lock) -> None:
+        while not self._stop.is_set():
+            batch = self._next_batch(stage, in_queue)
+            if batch is None:
+                self._put(in_queue, _DONE)
+                break
+            try:
+                output = stage.function(batch if stage.batch_size > 1 else batch[0])
+                self._emit(stage, output, out_queue)
+            except Exception as e:
+                _logger.error(f'[_worker] stage {stage.name} failed: {str(e)}')
+                _logger.error(traceback.format_exc())
+                self._fail(stage, batch, out_queue)
+
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                _logger.debug(f'[_worker] stage {stage.name} completed')
+                self._put(out_queue, _DONE)
+
+    def _fail(self, stage: Stage, batch: List[Any], out_queue: Queue) -> None:
+        dropped = 0
+        for item in batch:
+            failed = stage.on_error(item) if stage.on_error else None
+            if failed is None:
+                dropped += 1
+                continue
+            self._put(out_queue, failed)
+        if dropped:
+            with self._dropped_lock:
+                self._dropped += dropped
+            _logger.error(f'[_fail] stage {stage.name} dropped {dropped} items')
+
+    def _source(self, source: Iterable[Any], out_queue: Queue) -> None:
+        try:
+            for item in source:
+                if not self._put(out_queue, item):
+                    return
+        except Exception as e:
+            # raised from run once everything listed so far has drained, so a partial listing never looks complete
+            _logger.error(f'[_source] failed: {str(e)}')
+            _logger.error(traceback.format_exc())
+            self._source_error = e
+        finally:
+            self._put(out_queue, _DONE)
+
+    def run(self, source: Iterable[Any]) -> Generator[Any, None, None]:
+        queues = [Queue(maxsize=stage.queue_size) for stage in self._stages]
+        queues.append(Queue(maxsize=self._stages[-1].queue_size))
+
+        threads = [Thread(target=self._source, args=(source, queues[0]), name='pipeline-source', daemon=True)]
+        for index, stage in enumerate(self._stages):
+            remaining = [stage.workers]
+            lock = Lock()
+            for worker in range(stage.workers):
+                threads.append(Thread(
+                    target=self._worker,
+                    args=(stage, queues[index], queues[index + 1], remaining, lock),
+                    name=f'pipeline-{stage.name}-{worker}',
+                    daemon=True
+                ))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+            if self._dropped:
+                _logger.error(f'[run] {self._dropped} items dropped by failing stages')
+            if self._source_error:
+                raise Exception(f'[Pipeline.run] source failed: {str(self._source_error)}') from self._source_error
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join(timeout=_POLL_SECONDS * 2)
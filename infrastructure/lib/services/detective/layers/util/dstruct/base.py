@@ -1,50 +1,113 @@
+import asyncio
 from logging import getLogger
 from typing import Dict, List, Set
 
+from dstruct.cache import BlockCache
 from dstruct.dao import DStructDao
-from dstruct.graphdb import GraphDB
+from dstruct.graphdb import GraphDB, Node
 from dstruct.model import Block, BlockQuery, Entity
 from dstruct.vectordb import Row, VectorDB
 
 _logger = getLogger('DStruct')
 
 class DStruct:
-    def __init__(self, graphdb: GraphDB, vectordb: VectorDB, library: str, log_level: int):
+    def __init__(self, graphdb: GraphDB, vectordb: VectorDB, library: str, log_level: int, cache: BlockCache = None):
         self._graphdb = graphdb
         self._vectordb = vectordb
         self._library = library
+        self._cache = cache
         self._dao = DStructDao(library=library, log_level=log_level)
 
         _logger.setLevel(log_level)
 
     def merge(self, block: Block, entities: List[Entity] = None, adjacent_block_ids: Set[str] = None) -> None:
-        graph_node = self._dao.block_to_node(block, adjacent_block_ids)
-        block_row = self._dao.block_to_row(block)
-        entity_nodes = [self._dao.entity_to_node(entity, [block.id]) for entity in entities] if entities else []
+        self.merge_many(
+            blocks=[block],
+            entities_by_block={block.id: entities} if entities else None,
+            adjacency_by_block={block.id: adjacent_block_ids} if adjacent_block_ids else None
+        )
 
-        self._graphdb.add_blocks([graph_node])
-        self._vectordb.upsert([block_row])
+    def _entity_nodes(self, entities_by_block: Dict[str, List[Entity]]) -> List[Node]:
+        name_to_entity: Dict[str, Entity] = {}
+        name_to_block_ids: Dict[str, Set[str]] = {}
+        for block_id, entities in entities_by_block.items():
+            for entity in entities or []:
+                if not entity.name:
+                    continue
+                merged_entity = name_to_entity.get(entity.name, None)
+                if not merged_entity:
+                    merged_entity = Entity(identifiables=set(), name=entity.name)
+                    name_to_entity[entity.name] = merged_entity
+                    name_to_block_ids[entity.name] = set()
+                if entity.identifiables:
+                    merged_entity.identifiables.update(entity.identifiables)
+                name_to_block_ids[entity.name].add(block_id)
+        return [self._dao.entity_to_node(entity, name_to_block_ids[name]) for name, entity in name_to_entity.items()]
+
+    def merge_many(
+        self,
+        blocks: List[Block],
+        entities_by_block: Dict[str, List[Entity]] = None,
+        adjacency_by_block: Dict[str, Set[str]] = None
+    ) -> None:
+        if not blocks:
+            return
+
+        adjacency_by_block = adjacency_by_block if adjacency_by_block else {}
+        graph_nodes = [self._dao.block_to_node(block, adjacency_by_block.get(block.id, None)) for block in blocks]
+        block_rows = [self._dao.block_to_row(block) for block in blocks]
+        entity_nodes = self._entity_nodes(entities_by_block) if entities_by_block else []
+
+        if self._cache:
+            self._cache.invalidate(self._library, [block.id for block in blocks])
+        self._graphdb.add_blocks(graph_nodes)
+        self._vectordb.upsert(block_rows)
         if entity_nodes:
             self._graphdb.add_entities(entity_nodes)
-        _logger.debug(f'[merge] merged block {str(block.id)} with {len(block.properties)} properties entities {str(entities)} adjacent_block_ids {str(adjacent_block_ids)}')
+        _logger.debug(f'[merge_many] merged {len(blocks)} blocks with {len(entity_nodes)} entities')
     
     def clean_adjacent_blocks(self, connection: str) -> None:
         self._graphdb.clean_adjacent_blocks(self._library, connection)
+
+    def backfill_adjacency(self, connection: str) -> None:
+        self._graphdb.backfill_adjacency(self._library, connection)
+
+    def needs_adjacency_backfill(self, connection: str) -> bool:
+        return self._graphdb.needs_adjacency_backfill(self._library, connection)
     
-    def _blocks_with_embeddings(self, blocks: List[Block]) -> None:
+    def _node_to_block(self, node: Node) -> Block:
+        if self._cache:
+            block = self._cache.get(self._library, node.id, node.data.get('last_updated_timestamp', None))
+            if block:
+                return block
+        return self._dao.node_to_block(node)
+
+    def _with_row_embeddings(self, blocks: List[Block], rows: List[Row]) -> None:
+        id_to_embedding: Dict[str, List[float]] = {row.id: row.embedding for row in rows if row.embedding}
+        for block in blocks:
+            if not block.embedding:
+                block.embedding = id_to_embedding.get(block.id, None)
+
+    async def _blocks_with_embeddings(self, blocks: List[Block]) -> None:
         id_to_block: Dict[str, Block] = {}
         for block in blocks:
-            id_to_block[block.id] = block
+            if not block.embedding:
+                id_to_block[block.id] = block
+        if not id_to_block:
+            return
 
-        rows: List[Row] = self._vectordb.fetch(list(id_to_block.keys()), self._library)
+        rows: List[Row] = await self._vectordb.afetch(list(id_to_block.keys()), self._library)
         for row in rows:
             id_to_block[row.id].embedding = row.embedding
 
-    def _blocks_with_data(self, blocks: List[Block]) -> None:
+    async def _blocks_with_data(self, blocks: List[Block]) -> None:
         id_to_block: Dict[str, Block] = {}
         for block in blocks:
-            id_to_block[block.id] = block
-        nodes = self._graphdb.query_by_ids(list(id_to_block.keys()), self._library)
+            if block.properties is None:
+                id_to_block[block.id] = block
+        if not id_to_block:
+            return
+        nodes = await self._graphdb.aquery_by_ids(list(id_to_block.keys()), self._library)
         for node in nodes:
             node_block = self._dao.node_to_block(node)
             id_to_block[node_block.id].properties = node_block.properties
@@ -53,19 +116,22 @@ class DStruct:
         return block_query and block_query.search_method == 'exact' and block_query.entities
 
     def query(self, end: BlockQuery, start: BlockQuery = None, with_data = True, with_embeddings = True) -> List[Block]:
+        return asyncio.run(self.aquery(end, start, with_data=with_data, with_embeddings=with_embeddings))
+
+    async def aquery(self, end: BlockQuery, start: BlockQuery = None, with_data = True, with_embeddings = True) -> List[Block]:
         blocks: List[Block] = []
         if self._is_exact_query(end):
             if not start or self._is_exact_query:
                 _logger.debug(f'[query] exact query {start} -> {end}')
-                nodes = self._graphdb.query_blocks(end=end, library=self._library, start=start)
+                nodes = await self._graphdb.aquery_blocks(end=end, library=self._library, start=start)
                 _logger.debug(f'[query] found nodes in neo4j {str(nodes)}')
                 if not nodes:
                     return None
 
-                blocks = [self._dao.node_to_block(node) for node in nodes]
+                blocks = [self._node_to_block(node) for node in nodes]
             else:
                 _logger.debug(f'[query] relevant then exact query {start} -> {end}')
-                rows: List[Row] = self._vectordb.query(
+                rows: List[Row] = await self._vectordb.aquery(
                     block_query=start,
                     library=self._library,
                     top_k=1000,
@@ -77,39 +143,42 @@ class DStruct:
                 if not rows:
                     return None
                 start.ids = [row.id for row in rows]
-                nodes = self._graphdb.query_blocks(end=end, library=self._library, start=start)
+                nodes = await self._graphdb.aquery_blocks(end=end, library=self._library, start=start)
                 _logger.debug(f'[query] found nodes in neo4j {str(nodes)}')
                 if not nodes:
                     return None
                 
-                blocks = [self._dao.node_to_block(node) for node in nodes]
+                blocks = [self._node_to_block(node) for node in nodes]
         else:
             if not start:
                 _logger.debug(f'[query] relevant query {end}')
-                rows = self._vectordb.query(
+                rows = await self._vectordb.aquery(
                     block_query=end,
                     library=self._library,
                     top_k=end.limit if end.limit else 5,
                     include_values=True,
                     type='block'
                 )
+                if not rows:
+                    return None
                 row_ids = [row.id for row in rows]
                 _logger.debug(f'[query] found rows in pinecone {str(row_ids)}')
-                nodes = self._graphdb.query_by_ids(row_ids, self._library)
+                nodes = await self._graphdb.aquery_by_ids(row_ids, self._library)
                 _logger.debug(f'[query] found nodes in neo4j {str(nodes)}')
                 if not nodes:
                     return None
-                blocks = [self._dao.node_to_block(node) for node in nodes]
+                blocks = [self._node_to_block(node) for node in nodes]
+                self._with_row_embeddings(blocks, rows)
             elif self._is_exact_query(start):
                 _logger.debug(f'[query] exact then relevant query {start} -> {end}')
-                nodes = self._graphdb.query_blocks(end=end, library=self._library, start=start)
+                nodes = await self._graphdb.aquery_blocks(end=end, library=self._library, start=start)
                 if not nodes:
                     return None
-                blocks = [self._dao.node_to_block(node) for node in nodes]
+                blocks = [self._node_to_block(node) for node in nodes]
                 # TODO: rerank with cohere ai?
             else:
                 _logger.debug(f'[query] relevant then relevant query {start} -> {end}')
-                rows: Dict[str, List[float]] = self._vectordb.query(
+                rows: List[Row] = await self._vectordb.aquery(
                     block_query=start,
                     library=self._library,
                     top_k=1000,
@@ -118,21 +187,25 @@ class DStruct:
                 )
                 if not rows:
                     return None
-                start.ids = [block_id for block_id in rows.keys()]
+                start.ids = [row.id for row in rows]
                 end_limit = end.limit
                 end.limit = 1000
-                nodes = self._graphdb.query_blocks(end=end, library=self._library, start=start)
+                nodes = await self._graphdb.aquery_blocks(end=end, library=self._library, start=start)
+                end.limit = end_limit
                 if not nodes:
                     return None
-                blocks = [self._dao.node_to_block(node) for node in nodes]
-                end.limit = end_limit
+                blocks = [self._node_to_block(node) for node in nodes]
                 # TODO: rerank with cohere ai?
 
         if blocks:
-            if with_data and not blocks[0].properties:
-                self._blocks_with_data(blocks)
-            if with_embeddings and not blocks[0].embedding:
-                self._blocks_with_embeddings(blocks)
+            hydrations = []
+            if with_data:
+                hydrations.append(self._blocks_with_data(blocks))
+            if with_embeddings:
+                hydrations.append(self._blocks_with_embeddings(blocks))
+            await asyncio.gather(*hydrations)
+            if self._cache:
+                self._cache.put_many(self._library, blocks)
             _logger.debug(f'[query] found blocks {str([block.id for block in blocks])}')
             return blocks
         
@@ -140,4 +213,7 @@ class DStruct:
         return None
   
     def get_labels(self) -> List[str]:
-        return self._graphdb.get_labels(library=self._library)
\ No newline at end of file
+        return self._graphdb.get_labels(library=self._library)
+
+    async def aget_labels(self) -> List[str]:
+        return await self._graphdb.aget_labels(library=self._library)
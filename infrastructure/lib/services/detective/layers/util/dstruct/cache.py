@@ -0,0 +1,82 @@
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from logging import getLogger
+from threading import Lock
+from time import time
+from typing import Dict, List, Set
+
+from dstruct.codec import LazyUnstructuredProperty
+from dstruct.model import Block, Property, UnstructuredProperty
+
+_logger = getLogger('BlockCache')
+
+DEFAULT_MAX_ENTRIES_PER_LIBRARY = 2000
+DEFAULT_TTL_SECONDS = 600
+
+
+@dataclass
+class _Entry:
+    block: Block
+    stored_at: float
+
+
+def _copy_block(block: Block) -> Block:
+    # callers trim chunks in place (see Reranker.minify), so every block handed in or out gets its own chunk lists
+    properties: Set[Property] = None
+    if block.properties is not None:
+        properties = set()
+        for property in block.properties:
+            if isinstance(property, LazyUnstructuredProperty):
+                property = property.copy()
+            elif isinstance(property, UnstructuredProperty):
+                property = UnstructuredProperty(key=property.key, chunks=list(property.chunks))
+            properties.add(property)
+    return replace(block, properties=properties)
+
+
+class BlockCache:
+    # hydrated blocks (decoded properties and embedding) per library, keyed by (block id, last_updated_timestamp) so a
+    # re-merged block with a newer timestamp misses. each library has its own lru so one busy library cannot evict
+    # another's hot blocks
+    def __init__(self, log_level: int, max_entries_per_library: int = DEFAULT_MAX_ENTRIES_PER_LIBRARY, ttl_seconds: int = DEFAULT_TTL_SECONDS) -> None:
+        self._max_entries_per_library = max_entries_per_library
+        self._ttl_seconds = ttl_seconds
+        self._libraries: Dict[str, OrderedDict] = {}
+        self._lock = Lock()
+
+        _logger.setLevel(log_level)
+
+    def get(self, library: str, block_id: str, last_updated_timestamp: int) -> Block:
+        with self._lock:
+            entries = self._libraries.get(library, None)
+            entry: _Entry = entries.get(block_id, None) if entries is not None else None
+            if not entry:
+                return None
+            if entry.block.last_updated_timestamp != last_updated_timestamp or time() - entry.stored_at > self._ttl_seconds:
+                del entries[block_id]
+                return None
+            entries.move_to_end(block_id)
+            return _copy_block(entry.block)
+
+    def put_many(self, library: str, blocks: List[Block]) -> None:
+        now = time()
+        with self._lock:
+            entries = self._libraries.setdefault(library, OrderedDict())
+            for block in blocks:
+                if not (block and block.id and block.properties is not None):
+                    continue
+                entries[block.id] = _Entry(block=_copy_block(block), stored_at=now)
+                entries.move_to_end(block.id)
+            while len(entries) > self._max_entries_per_library:
+                entries.popitem(last=False)
+
+    def invalidate(self, library: str, block_ids: List[str] = None) -> None:
+        with self._lock:
+            if block_ids is None:
+                self._libraries.pop(library, None)
+                return
+            entries = self._libraries.get(library, None)
+            if entries is None:
+                return
+            for block_id in block_ids:
+                entries.pop(block_id, None)
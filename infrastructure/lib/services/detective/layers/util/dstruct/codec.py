@@ -0,0 +1,95 @@
+import json
+import struct
+import zlib
+from typing import Any, Dict, List, Set, Tuple, Union
+
+from dstruct.model import Chunk, Property, StructuredProperty, UnstructuredProperty
+
+# versioned binary encoding of a block's properties, stored as a single neo4j byte array:
+#   magic (4 bytes) | version (1 byte) | zlib(index length (uint32) | index json | chunk texts)
+# the index holds structured values inline and, for unstructured properties, an (order, offset, length) table into
+# the utf-8 chunk text section, so chunk texts are only decoded for properties that are actually read
+MAGIC = b'DSPB'
+VERSION = 1
+_HEADER = struct.Struct('>4sB')
+_INDEX_LENGTH = struct.Struct('>I')
+
+
+class LazyUnstructuredProperty(UnstructuredProperty):
+    def __init__(self, key: str, texts: memoryview, spans: List[Tuple[int, int, int]]) -> None:
+        if key is None or not spans:
+            raise ValueError('key and chunks are required')
+        self.key = key
+        self._texts = texts
+        self._spans = spans
+        self._chunks: List[Chunk] = None
+
+    @property
+    def chunks(self) -> List[Chunk]:
+        if self._chunks is None:
+            self._chunks = [Chunk(
+                order=order,
+                text=str(self._texts[offset:offset + length], 'utf-8'),
+                embedding=None
+            ) for order, offset, length in self._spans]
+            self._texts = None
+        return self._chunks
+
+    @chunks.setter
+    def chunks(self, chunks: List[Chunk]) -> None:
+        self._chunks = chunks
+        self._texts = None
+
+    def copy(self) -> UnstructuredProperty:
+        # an undecoded property only shares the read-only buffer, so copies stay lazy
+        if self._chunks is None:
+            return LazyUnstructuredProperty(key=self.key, texts=self._texts, spans=self._spans)
+        return UnstructuredProperty(key=self.key, chunks=list(self._chunks))
+
+
+def encode_properties(properties: Set[Property]) -> bytes:
+    index: List[Dict[str, Any]] = []
+    texts = bytearray()
+    for property in properties or []:
+        if isinstance(property, StructuredProperty):
+            index.append({'k': property.key, 'v': property.value})
+        elif isinstance(property, UnstructuredProperty):
+            spans: List[List[int]] = []
+            for chunk in property.chunks:
+                encoded = chunk.text.encode('utf-8') if chunk.text else b''
+                spans.append([chunk.order, len(texts), len(encoded)])
+                texts.extend(encoded)
+            index.append({'k': property.key, 'c': spans})
+        else:
+            raise ValueError(f'Unknown property type: {type(property)}')
+
+    encoded_index = json.dumps(index, separators=(',', ':')).encode('utf-8')
+    body = _INDEX_LENGTH.pack(len(encoded_index)) + encoded_index + bytes(texts)
+    return _HEADER.pack(MAGIC, VERSION) + zlib.compress(body)
+
+
+def is_encoded(raw: Any) -> bool:
+    return isinstance(raw, (bytes, bytearray)) and raw[:len(MAGIC)] == MAGIC
+
+
+def decode_properties(raw: Union[bytes, bytearray]) -> Set[Property]:
+    magic, version = _HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError('[decode_properties] not an encoded property blob')
+    if version != VERSION:
+        raise ValueError(f'[decode_properties] unsupported property encoding version {version}')
+
+    body = memoryview(zlib.decompress(memoryview(raw)[_HEADER.size:]))
+    (index_length,) = _INDEX_LENGTH.unpack_from(body)
+    index_end = _INDEX_LENGTH.size + index_length
+    index: List[Dict[str, Any]] = json.loads(str(body[_INDEX_LENGTH.size:index_end], 'utf-8'))
+    texts = body[index_end:]
+
+    properties: Set[Property] = set()
+    for entry in index:
+        if 'v' in entry:
+            if entry['v'] is not None:
+                properties.add(StructuredProperty(key=entry['k'], value=entry['v']))
+        elif entry.get('c'):
+            properties.add(LazyUnstructuredProperty(key=entry['k'], texts=texts, spans=[tuple(span) for span in entry['c']]))
+    return properties
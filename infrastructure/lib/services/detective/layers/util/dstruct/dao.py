@@ -1,8 +1,9 @@
 import json
 from datetime import datetime
 from logging import getLogger
-from typing import Any, Dict, List, Set
+from typing import Any, List, Set
 
+from dstruct.codec import decode_properties, encode_properties, is_encoded
 from dstruct.graphdb import Node, Relationship
 from dstruct.model import (Block, Chunk, Entity, Property, StructuredProperty,
                            UnstructuredProperty)
@@ -16,26 +17,8 @@ class DStructDao:
 
         _logger.setLevel(log_level)
 
-    def _properties_as_listed_dict(self, properties: Set[Property]) -> List[Dict[str, Any]]:
-        dictionary_properties = []
-        for property in properties:
-            dictionary = {
-                'key': property.key
-            }
-            if isinstance(property, StructuredProperty):
-                dictionary['value'] = property.value
-            elif isinstance(property, UnstructuredProperty):
-                dictionary['chunks'] = [{
-                    'order': chunk.order,
-                    'text': chunk.text,
-                } for chunk in property.chunks]
-            else:
-                raise ValueError(f'Unknown property type: {type(property)}')
-            dictionary_properties.append(json.dumps(dictionary))
-                
-        return dictionary_properties
-    
     def _listed_dict_as_properties(self, listed_dict: List[str]) -> Set[Property]:
+        # legacy form: one json string per property, still read until every block has been re-merged
         properties = set()
         for dictionary_property_str in listed_dict:
             try:
@@ -58,6 +41,17 @@ class DStructDao:
                 _logger.error(f'[_listed_dict_as_properties] failed to parse {dictionary_property_str} as JSON: {e}')
         return properties
 
+    def _decode_properties(self, raw: Any) -> Set[Property]:
+        if raw is None:
+            return set()
+        if is_encoded(raw):
+            try:
+                return decode_properties(raw)
+            except Exception as e:
+                _logger.error(f'[_decode_properties] failed to decode {len(raw)} byte property blob: {e}')
+                return set()
+        return self._listed_dict_as_properties(raw)
+
     def block_to_node(self, block: Block, has_block_ids: Set[str] = None) -> Node:
         return Node(
             library=self._library,
@@ -66,7 +60,7 @@ class DStructDao:
                 'label': block.label,
                 'integration': block.integration,
                 'connection': block.connection,
-                'properties': self._properties_as_listed_dict(block.properties),
+                'properties': encode_properties(block.properties),
                 'last_updated_timestamp': block.last_updated_timestamp,
             },
             relationships=[Relationship(
@@ -82,7 +76,7 @@ class DStructDao:
             label=node.data.get('label'),
             integration=node.data.get('integration'),
             connection=node.data.get('connection'),
-            properties=self._listed_dict_as_properties(node.data.get('properties')),
+            properties=self._decode_properties(node.data.get('properties')),
             last_updated_timestamp=node.data.get('last_updated_timestamp'),
             embedding=None
         )
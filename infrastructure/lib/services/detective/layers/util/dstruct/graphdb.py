@@ -1,9 +1,16 @@
+import asyncio
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Any, Dict, List, Literal, Set
+from logging import getLogger
+from typing import Any, Dict, List, Literal, Set, Tuple, get_args
 
 from dstruct.model import BlockQuery
-from external.neo4j_ import Neo4j
+from dstruct.schema import ENTITY_FULLTEXT_INDEX
+from external.neo4j_ import AsyncNeo4j, Neo4j
+
+_logger = getLogger('GraphDB')
+
+_ENTITY_MATCH_LIMIT = 100
 
 
 @dataclass
@@ -34,9 +41,40 @@ class Relationship(Identifiable):
     type: Literal['Mentioned', 'Has']
 
 
+# start -> end traversal. 'summary' walks the adjacent_out / adjacent_in id lists that add_blocks keeps on every
+# block, so each hop is an index seek instead of a path expansion. 'path' is a bounded variable-length match that
+# works on any graph. graph_plot backfills a connection's summaries on its next run, so 'path' stays the default
+# until every connection has been through one
+TraversalDirection = Literal['out', 'in', 'both']
+Traversal = Literal['summary', 'path']
+
+
 class GraphDB:
-    def __init__(self, db: Neo4j) -> None:
+    # cypher templates keyed by (end shape, start shape), shared by every GraphDB in the process
+    _query_blocks_templates: Dict[Tuple, str] = {}
+
+    def __init__(
+        self,
+        db: Neo4j = None,
+        async_db: AsyncNeo4j = None,
+        max_depth: int = 2,
+        direction: TraversalDirection = 'both',
+        traversal: Traversal = 'path'
+    ) -> None:
+        if max_depth < 1:
+            raise ValueError(f'[GraphDB] max_depth {max_depth} must be at least 1')
+        if direction not in get_args(TraversalDirection) or traversal not in get_args(Traversal):
+            raise ValueError(f'[GraphDB] unsupported direction {direction} or traversal {traversal}')
         self._db = db
+        self._async_db = async_db
+        self._max_depth = max_depth
+        self._direction = direction
+        self._traversal = traversal
+
+    async def _aread(self, query: str, **kwargs):
+        if self._async_db:
+            return await self._async_db.read(query, **kwargs)
+        return await asyncio.to_thread(self._db.read, query, **kwargs)
             
     def _node_to_dict(self, node: Node):
         return {
@@ -72,6 +110,15 @@ class GraphDB:
     def clean_adjacent_blocks(self, library: str, connection: str):
         return self._db.write(self._clean_adjacent_blocks_cypher(), library=library, connection=connection)
 
+    def backfill_adjacency(self, library: str, connection: str):
+        # rebuilds the adjacency summaries from the Has relationships, for blocks merged before they were maintained
+        return self._db.write(self._backfill_adjacency_cypher(), library=library, connection=connection)
+
+    def needs_adjacency_backfill(self, library: str, connection: str) -> bool:
+        # add_blocks and the backfill always leave both lists set, so a missing one marks a block merged before them
+        records = self._db.read(self._missing_adjacency_cypher(), library=library, connection=connection)
+        return bool(records)
+
     @property
     def _entity_data_keys(self) -> Set[str]:
         return set(['identifiables'])
@@ -106,7 +153,14 @@ class GraphDB:
         if not (end and library):
             raise ValueError(f'[GraphDB.query_blocks] end {end} and library {library} must not be empty')
 
-        records = self._db.read(query=self._query_blocks_cypher(end, start), library=library)
+        entity_ids = {
+            'end': self.resolve_entities(end.entities, library) if end.entities else None,
+            'start': self.resolve_entities(start.entities, library) if start and start.entities else None,
+        }
+        if any(ids is not None and not ids for ids in entity_ids.values()):
+            return []
+        query, parameters = self._query_blocks_cypher(end, start, entity_ids)
+        records = self._db.read(query=query, library=library, **parameters)
         return [self._record_to_node(record) for record in records] if records else []
     
     def query_by_ids(self, ids: List[str], library: str) -> List[Node]:
@@ -116,43 +170,163 @@ class GraphDB:
         records = self._db.read(query=self._query_ids_cypher(), ids=ids, library=library)
         return [self._record_to_node(record) for record in records] if records else []
     
-    def get_labels(self, library: str) -> List[str]:
-        if not library:
-            raise ValueError(f'[GraphDB.get_labels] library {library} must not be empty')
+    async def aquery_blocks(self, end: BlockQuery, library: str, start: BlockQuery = None) -> List[Node]:
+        if not (end and library):
+            raise ValueError(f'[GraphDB.aquery_blocks] end {end} and library {library} must not be empty')
+
+        end_ids, start_ids = await asyncio.gather(
+            self.aresolve_entities(end.entities, library),
+            self.aresolve_entities(start.entities if start else None, library)
+        )
+        entity_ids = {'end': end_ids if end.entities else None, 'start': start_ids if start and start.entities else None}
+        if any(ids is not None and not ids for ids in entity_ids.values()):
+            return []
+        query, parameters = self._query_blocks_cypher(end, start, entity_ids)
+        records = await self._aread(query, library=library, **parameters)
+        return [self._record_to_node(record) for record in records] if records else []
 
-        query = (
+    def _fulltext_phrase(self, name: str) -> str:
+        # a quoted lucene phrase, so only quotes and backslashes need escaping
+        escaped = name.replace('\\', '\\\\').replace('"', '\\"')
+        return f'"{escaped}"'
+
+    def _resolve_entities_cypher(self) -> str:
+        # the library clause scopes the lookup inside the index, so the limit only counts this library's hits. the
+        # where clause guards against a library id that tokenizes like another one
+        return (
+            'UNWIND $phrases AS phrase '
+            'CALL db.index.fulltext.queryNodes($index, phrase, {limit: $limit}) YIELD node, score '
+            'WHERE node.library = $library '
+            'RETURN phrase, collect(DISTINCT node.id) AS ids '
+        )
+
+    def _resolve_entities_parameters(self, names: List[str], library: str) -> Dict[str, Any]:
+        return {
+            'phrases': [f'library:{self._fulltext_phrase(library)} AND id:{self._fulltext_phrase(name)}' for name in names if name],
+            'index': ENTITY_FULLTEXT_INDEX,
+            'limit': _ENTITY_MATCH_LIMIT,
+        }
+
+    def _records_to_entity_ids(self, records) -> List[str]:
+        entity_ids: Dict[str, None] = {}
+        for record in records or []:
+            ids = record['ids'] or []
+            if len(ids) >= _ENTITY_MATCH_LIMIT:
+                _logger.warning(f'[_records_to_entity_ids] {record["phrase"]} matched at least {_ENTITY_MATCH_LIMIT} entities, the rest are ignored')
+            entity_ids.update(dict.fromkeys(ids))
+        return list(entity_ids)
+
+    def resolve_entities(self, names: List[str], library: str) -> List[str]:
+        '''Resolves entity names to entity ids through the fulltext index.
+
+        Returns:
+            `List[str]`: matching entity ids, or None when the index is unavailable and callers should fall back
+            to scanning entity names.
+        '''
+        if not (names and library):
+            return None
+        try:
+            records = self._db.read(self._resolve_entities_cypher(), library=library, **self._resolve_entities_parameters(names, library))
+        except Exception as e:
+            _logger.error(f'[resolve_entities] fulltext lookup failed, falling back to scan: {str(e)}')
+            return None
+        return self._records_to_entity_ids(records)
+
+    async def aresolve_entities(self, names: List[str], library: str) -> List[str]:
+        if not (names and library):
+            return None
+        try:
+            records = await self._aread(self._resolve_entities_cypher(), library=library, **self._resolve_entities_parameters(names, library))
+        except Exception as e:
+            _logger.error(f'[aresolve_entities] fulltext lookup failed, falling back to scan: {str(e)}')
+            return None
+        return self._records_to_entity_ids(records)
+
+    async def aquery_by_ids(self, ids: List[str], library: str) -> List[Node]:
+        if not (ids and library):
+            raise ValueError(f'[GraphDB.aquery_by_ids] ids {ids} and library {library} must not be empty')
+
+        records = await self._aread(self._query_ids_cypher(), ids=ids, library=library)
+        return [self._record_to_node(record) for record in records] if records else []
+
+    def _get_labels_cypher(self) -> str:
+        return (
             'MATCH (b: Block {library: $library}) '
             'RETURN DISTINCT b.label as label '
         )
 
-        records = self._db.read(query, library=library)
+    def _records_to_labels(self, records) -> List[str]:
         labels: List[str] = []
         for record in records:
             if record['label']:
                 labels.append(record['label'])
         return labels
 
+    def get_labels(self, library: str) -> List[str]:
+        if not library:
+            raise ValueError(f'[GraphDB.get_labels] library {library} must not be empty')
+
+        records = self._db.read(self._get_labels_cypher(), library=library)
+        return self._records_to_labels(records)
+
+    async def aget_labels(self, library: str) -> List[str]:
+        if not library:
+            raise ValueError(f'[GraphDB.aget_labels] library {library} must not be empty')
+
+        records = await self._aread(self._get_labels_cypher(), library=library)
+        return self._records_to_labels(records)
+
     def _node_index_match(self, name: str):
         return ', '.join([f'{key}: {name}.{key}' for key in Node.get_index_keys()])
 
     def _add_blocks_cypher(self, property_keys: Set[str]) -> str:
-        set_object = ', '.join([f'b.{key} = CASE WHEN block.{key} IS NOT NULL THEN block.{key} ELSE b.{key} END' for key in property_keys])
+        set_object = ', '.join([f'b.{key} = CASE WHEN block.{key} IS NOT NULL THEN block.{key} ELSE b.{key} END' for key in sorted(property_keys)])
         return (
             'UNWIND $blocks as block '
             f'MERGE (b: Block {{{self._node_index_match("block")}}}) '
             f'ON CREATE SET {set_object} '
             f'ON MATCH SET {set_object} '
+            'SET b.adjacent_out = coalesce(b.adjacent_out, []), b.adjacent_in = coalesce(b.adjacent_in, []) '
             'WITH b, block '
             'UNWIND block.relationships as adjacent_block '
-            f'MERGE (ab: Block {{{self._node_index_match("adjacent_block")}, connection: block.connection }}) '
+            f'MERGE (ab: Block {{{self._node_index_match("adjacent_block")}}}) '
+            'ON CREATE SET ab.connection = block.connection '
             'WITH b, ab '
             'MERGE (b)-[:Has]->(ab) '
+            'SET b.adjacent_out = apoc.coll.toSet(coalesce(b.adjacent_out, []) + ab.id), '
+            'ab.adjacent_in = apoc.coll.toSet(coalesce(ab.adjacent_in, []) + b.id) '
+        )
+
+    def _backfill_adjacency_cypher(self) -> str:
+        return (
+            'MATCH (b: Block {library: $library, connection: $connection}) '
+            'OPTIONAL MATCH (b)-[:Has]->(out: Block) '
+            'WITH b, collect(DISTINCT out.id) AS adjacent_out '
+            'OPTIONAL MATCH (b)<-[:Has]-(in: Block) '
+            'WITH b, adjacent_out, collect(DISTINCT in.id) AS adjacent_in '
+            'SET b.adjacent_out = adjacent_out, b.adjacent_in = adjacent_in '
         )
     
+    def _missing_adjacency_cypher(self) -> str:
+        return (
+            'MATCH (b: Block {library: $library, connection: $connection}) '
+            'WHERE b.adjacent_out IS NULL OR b.adjacent_in IS NULL '
+            'RETURN b.id AS id '
+            'LIMIT 1 '
+        )
+
     def _clean_adjacent_blocks_cypher(self) -> str:
+        # the deleted ids are dropped from their neighbours' adjacency summaries too. a neighbour that has no summary
+        # yet keeps none, so it is still picked up by the backfill
         return (
             'MATCH (block: Block {library: $library, connection: $connection}) '
             'WHERE block.label IS NULL OR block.properties IS NULL OR block.last_updated_timestamp IS NULL '
+            'OPTIONAL MATCH (block)-[:Has]-(neighbor: Block) '
+            'WITH block, collect(DISTINCT neighbor) AS neighbors '
+            'FOREACH (neighbor IN neighbors | '
+            'SET neighbor.adjacent_out = CASE WHEN neighbor.adjacent_out IS NULL THEN NULL ELSE [id IN neighbor.adjacent_out WHERE id <> block.id] END, '
+            'neighbor.adjacent_in = CASE WHEN neighbor.adjacent_in IS NULL THEN NULL ELSE [id IN neighbor.adjacent_in WHERE id <> block.id] END'
+            ') '
             'DETACH DELETE block '
         )
 
@@ -186,43 +360,93 @@ class GraphDB:
             'MERGE (e)-[:Mentioned]->(b)'
         )
     
-    # TODO: optimize by putting integrations, time, entities, and any params as injectable parameters in the driver
-    def _where_filters(self, block_query: BlockQuery, name: str) -> List[str]:
-        where_filters = [f'{name}.library = $library']
+    def _filter_shape(self, block_query: BlockQuery, entity_ids: List[str] = None) -> Tuple:
+        # everything that changes the cypher text. values travel as parameters, so queries with the same shape share
+        # one statement and one neo4j plan
+        relative_time = block_query.relative_time.upper() if block_query.relative_time else None
+        return (
+            bool(block_query.ids),
+            bool(block_query.integrations),
+            bool(block_query.absolute_time_start),
+            bool(block_query.absolute_time_end),
+            bool(block_query.labels),
+            ('ids' if entity_ids is not None else 'names') if block_query.entities else None,
+            relative_time if relative_time in ('ASC', 'DESC') else None,
+            bool(block_query.offset),
+        )
+
+    def _filter_parameters(self, block_query: BlockQuery, name: str, entity_ids: List[str] = None) -> Dict[str, Any]:
+        parameters: Dict[str, Any] = {}
         if block_query.ids:
-            where_filters.append(f'{name}.id IN {block_query.ids}')
+            parameters[f'{name}_ids'] = block_query.ids
         if block_query.integrations:
-            where_filters.append(f'{name}.integration IN {block_query.integrations}')
+            parameters[f'{name}_integrations'] = block_query.integrations
         if block_query.absolute_time_start:
-            start_timestamp = int(datetime.strptime(block_query.absolute_time_start, '%Y-%m-%d').timestamp())
-            where_filters.append(f'{name}.last_updated_timestamp >= {start_timestamp}')
+            parameters[f'{name}_time_start'] = int(datetime.strptime(block_query.absolute_time_start, '%Y-%m-%d').timestamp())
         if block_query.absolute_time_end:
-            end_timestamp = int(datetime.strptime(block_query.absolute_time_end, '%Y-%m-%d').timestamp())
-            where_filters.append(f'{name}.last_updated_timestamp <= {end_timestamp}')
+            parameters[f'{name}_time_end'] = int(datetime.strptime(block_query.absolute_time_end, '%Y-%m-%d').timestamp())
         if block_query.labels:
-            where_filters.append(f'{name}.label IN {block_query.labels}')
-        if block_query.entities:
-            contains_id = []
-            for entity in block_query.entities:
-                contains_id.append(f'toLower(entity.id) CONTAINS "{entity.lower()}"')
-            where_filters.append(f'({" OR ".join(contains_id)})')
+            parameters[f'{name}_labels'] = block_query.labels
+        if block_query.entities and entity_ids is not None:
+            parameters[f'{name}_entity_ids'] = entity_ids
+        elif block_query.entities:
+            parameters[f'{name}_entities'] = [entity.lower() for entity in block_query.entities]
+        if block_query.offset:
+            parameters[f'{name}_skip'] = block_query.offset
+        parameters[f'{name}_limit'] = block_query.limit if block_query.limit else 10
+        return parameters
+
+    def _where_filters(self, shape: Tuple, name: str) -> List[str]:
+        has_ids, has_integrations, has_time_start, has_time_end, has_labels, entities, _, _ = shape
+        where_filters = [f'{name}.library = $library']
+        if has_ids:
+            where_filters.append(f'{name}.id IN ${name}_ids')
+        if has_integrations:
+            where_filters.append(f'{name}.integration IN ${name}_integrations')
+        if has_time_start:
+            where_filters.append(f'{name}.last_updated_timestamp >= ${name}_time_start')
+        if has_time_end:
+            where_filters.append(f'{name}.last_updated_timestamp <= ${name}_time_end')
+        if has_labels:
+            where_filters.append(f'{name}.label IN ${name}_labels')
+        if entities == 'ids':
+            # resolved up front, so this is an index seek on (library, id) instead of a scan over every entity name
+            where_filters.append(f'entity.library = $library AND entity.id IN ${name}_entity_ids')
+        elif entities == 'names':
+            where_filters.append(f'ANY(entity_name IN ${name}_entities WHERE toLower(entity.id) CONTAINS entity_name)')
         return where_filters
     
-    def _post_filters(self, block_query: BlockQuery, name: str) -> List[str]:
+    def _post_filters(self, shape: Tuple, name: str) -> List[str]:
+        _, _, _, _, _, _, relative_time, has_offset = shape
         post_filters = []
-        if block_query.relative_time:
-            post_filters.append(f'ORDER BY {name}.last_updated_timestamp {block_query.relative_time.upper()}')
-        if block_query.offset:
-            post_filters.append(f'SKIP {block_query.offset}')
-        post_filters.append(f'LIMIT {block_query.limit if block_query.limit else 10}')
+        if relative_time:
+            post_filters.append(f'ORDER BY {name}.last_updated_timestamp {relative_time}')
+        if has_offset:
+            post_filters.append(f'SKIP ${name}_skip')
+        post_filters.append(f'LIMIT ${name}_limit')
 
         return post_filters
 
-    def _query_blocks_cypher(self, end: BlockQuery, start: BlockQuery = None) -> str:
-        start_query = ''
+    def _query_blocks_cypher(self, end: BlockQuery, start: BlockQuery = None, entity_ids: Dict[str, List[str]] = None) -> Tuple[str, Dict[str, Any]]:
+        entity_ids = entity_ids if entity_ids else {}
+        end_shape = self._filter_shape(end, entity_ids.get('end', None))
+        start_shape = self._filter_shape(start, entity_ids.get('start', None)) if start else None
+        parameters = self._filter_parameters(end, 'end', entity_ids.get('end', None))
         if start:
-            start_where = self._where_filters(start, 'start')
-            start_post = self._post_filters(start, 'start')
+            parameters.update(self._filter_parameters(start, 'start', entity_ids.get('start', None)))
+
+        key = (end_shape, start_shape, self._max_depth, self._direction, self._traversal)
+        template = self._query_blocks_templates.get(key, None)
+        if not template:
+            template = self._query_blocks_template(end_shape, start_shape)
+            self._query_blocks_templates[key] = template
+        return template, parameters
+
+    def _query_blocks_template(self, end_shape: Tuple, start_shape: Tuple = None) -> str:
+        start_query = ''
+        if start_shape:
+            start_where = self._where_filters(start_shape, 'start')
+            start_post = self._post_filters(start_shape, 'start')
             start_query = (
                 'MATCH (entity: Entity)-[:Mentioned]->(start: Block) '
                 f'WHERE {" AND ".join(start_where)} '
@@ -231,10 +455,16 @@ class GraphDB:
                 'WITH start '
             )
 
-        end_where = self._where_filters(end, 'end')
-        end_post = self._post_filters(end, 'end')
-        start_end_match = ', start MATCH (start)-[:Has*]-(end) WITH DISTINCT end' if start else ''
+        end_where = self._where_filters(end_shape, 'end')
+        end_post = self._post_filters(end_shape, 'end')
+        start_end_match = ''
+        if start_shape and self._traversal == 'summary':
+            start_query += self._reachable_cypher()
+            end_where.append('end.id IN reachable_ids')
+        elif start_shape:
+            start_end_match = f', start MATCH (start){self._path_pattern()}(end) WITH DISTINCT end'
 
+        # without an ORDER BY the LIMIT stops the match as soon as enough end blocks are found
         end_query = (
             'MATCH (entity: Entity)-[:Mentioned]->(end: Block) '
             f'WHERE {" AND ".join(end_where)} '
@@ -244,6 +474,39 @@ class GraphDB:
             f'{" ".join(end_post)}'
         )
         return start_query + end_query
+
+    def _path_pattern(self) -> str:
+        relationship = f'[:Has*1..{self._max_depth}]'
+        if self._direction == 'out':
+            return f'-{relationship}->'
+        if self._direction == 'in':
+            return f'<-{relationship}-'
+        return f'-{relationship}-'
+
+    def _adjacent_ids(self, name: str) -> str:
+        if self._direction == 'out':
+            return f'coalesce({name}.adjacent_out, [])'
+        if self._direction == 'in':
+            return f'coalesce({name}.adjacent_in, [])'
+        return f'coalesce({name}.adjacent_out, []) + coalesce({name}.adjacent_in, [])'
+
+    def _reachable_cypher(self) -> str:
+        # breadth first over the adjacency summaries, one index seek per hop, collapsing to reachable_ids
+        hops = (
+            f'WITH start, apoc.coll.toSet({self._adjacent_ids("start")}) AS frontier '
+            'WITH start, frontier, frontier AS reachable '
+        )
+        for depth in range(2, self._max_depth + 1):
+            hop = f'hop_{depth}'
+            hops += (
+                f'OPTIONAL MATCH ({hop}: Block) WHERE {hop}.library = $library AND {hop}.id IN frontier '
+                f'WITH start, reachable, apoc.coll.toSet(apoc.coll.flatten(collect({self._adjacent_ids(hop)}))) AS next '
+                'WITH start, [id IN next WHERE NOT id IN reachable] AS frontier, apoc.coll.toSet(reachable + next) AS reachable '
+            )
+        return hops + (
+            'UNWIND [id IN reachable WHERE id <> start.id] AS reachable_id '
+            'WITH collect(DISTINCT reachable_id) AS reachable_ids '
+        )
     
     def _query_ids_cypher(self) -> str:
         return (
@@ -0,0 +1,111 @@
+from dataclasses import dataclass
+from logging import getLogger
+from typing import List, Literal
+
+from external.neo4j_ import AsyncNeo4j, Neo4j
+
+_logger = getLogger('GraphSchema')
+
+# library is indexed next to id so lookups are scoped to one tenant inside the index, before any hit limit applies.
+# replaces entity_id_fulltext, which can be dropped once this one is online
+ENTITY_FULLTEXT_INDEX = 'entity_library_id_fulltext'
+
+
+@dataclass
+class SchemaItem:
+    kind: Literal['constraint', 'index']
+    name: str
+    cypher: str
+
+
+SCHEMA: List[SchemaItem] = [
+    SchemaItem(
+        kind='constraint',
+        name='block_library_id',
+        cypher='CREATE CONSTRAINT block_library_id IF NOT EXISTS FOR (b:Block) REQUIRE (b.library, b.id) IS UNIQUE'
+    ),
+    SchemaItem(
+        kind='constraint',
+        name='entity_library_id',
+        cypher='CREATE CONSTRAINT entity_library_id IF NOT EXISTS FOR (e:Entity) REQUIRE (e.library, e.id) IS UNIQUE'
+    ),
+    SchemaItem(
+        kind='index',
+        name='block_library_connection',
+        cypher='CREATE INDEX block_library_connection IF NOT EXISTS FOR (b:Block) ON (b.library, b.connection)'
+    ),
+    SchemaItem(
+        kind='index',
+        name='block_last_updated_timestamp',
+        cypher='CREATE INDEX block_last_updated_timestamp IF NOT EXISTS FOR (b:Block) ON (b.last_updated_timestamp)'
+    ),
+    SchemaItem(
+        kind='index',
+        name='block_label',
+        cypher='CREATE INDEX block_label IF NOT EXISTS FOR (b:Block) ON (b.label)'
+    ),
+    SchemaItem(
+        kind='index',
+        name=ENTITY_FULLTEXT_INDEX,
+        cypher=f'CREATE FULLTEXT INDEX {ENTITY_FULLTEXT_INDEX} IF NOT EXISTS FOR (e:Entity) ON EACH [e.library, e.id]'
+    ),
+]
+
+
+class GraphSchema:
+    # idempotently creates the constraints and indexes that the dstruct merges and lookups rely on
+    def __init__(self, log_level: int, db: Neo4j = None, async_db: AsyncNeo4j = None) -> None:
+        if not (db or async_db):
+            raise ValueError('[GraphSchema] db or async_db must be provided')
+        self._db = db
+        self._async_db = async_db
+
+        _logger.setLevel(log_level)
+
+    def _show_cypher(self, kind: str) -> str:
+        return 'SHOW CONSTRAINTS YIELD name RETURN name, "ONLINE" AS state' if kind == 'constraint' else 'SHOW INDEXES YIELD name, state RETURN name, state'
+
+    def _missing(self, constraint_records, index_records) -> List[str]:
+        states = {record['name']: record['state'] for record in list(constraint_records or []) + list(index_records or [])}
+        missing: List[str] = []
+        for item in SCHEMA:
+            state = states.get(item.name, None)
+            if state != 'ONLINE':
+                missing.append(f'{item.kind} {item.name} ({state if state else "missing"})')
+        return missing
+
+    def ensure(self) -> List[str]:
+        for item in SCHEMA:
+            try:
+                self._db.write(item.cypher)
+            except Exception as e:
+                # e.g. a uniqueness constraint over existing duplicates. verify reports it as missing
+                _logger.error(f'[ensure] failed to create {item.kind} {item.name}: {str(e)}')
+        return self.verify()
+
+    def verify(self) -> List[str]:
+        missing = self._missing(self._db.read(self._show_cypher('constraint')), self._db.read(self._show_cypher('index')))
+        self._report(missing)
+        return missing
+
+    async def aensure(self) -> List[str]:
+        for item in SCHEMA:
+            try:
+                await self._async_db.write(item.cypher)
+            except Exception as e:
+                _logger.error(f'[aensure] failed to create {item.kind} {item.name}: {str(e)}')
+        return await self.averify()
+
+    async def averify(self) -> List[str]:
+        constraint_records = await self._async_db.read(self._show_cypher('constraint'))
+        index_records = await self._async_db.read(self._show_cypher('index'))
+        missing = self._missing(constraint_records, index_records)
+        self._report(missing)
+        return missing
+
+    def _report(self, missing: List[str]) -> None:
+        if missing:
+            # indexes that are still populating show up here too; queries work but fall back to label scans until then
+            _logger.warning(f'[_report] schema items not online: {missing}')
+        else:
+            _logger.info(f'[_report] all {len(SCHEMA)} schema items online')
@@ -1,8 +1,10 @@
+import asyncio
 from dataclasses import dataclass
-from typing import Dict, List, Literal
+from typing import Any, Dict, List, Literal
 
 from dstruct.model import BlockQuery
-from external.pinecone_ import Pinecone
+from external.pinecone_ import AsyncPinecone
+from store.vector_index import VectorBackend
 
 RowType = Literal['block', 'chunk', 'cluster']
 
@@ -17,8 +19,9 @@ class Row:
 
 
 class VectorDB:
-    def __init__(self, db: Pinecone) -> None:
+    def __init__(self, db: VectorBackend, async_db: AsyncPinecone = None) -> None:
         self._db = db
+        self._async_db = async_db
         
     def _keyed_id(self, id: str, library: str):
         return f'{library}#{id}'
@@ -48,10 +51,9 @@ class VectorDB:
         
         return self._db.upsert(vectors=vectors)
 
-    def fetch(self, ids: List[str], library: str) -> List[Row]:
-        fetch_response = self._db.fetch([self._keyed_id(id, library) for id in ids])
+    def _fetch_response_to_rows(self, fetch_response: Dict[str, Any], library: str) -> List[Row]:
         rows: List[Row] = []
-        for id, vector in fetch_response.items():
+        for id, vector in (fetch_response or {}).items():
             metadata = vector.get('metadata', {})
             rows.append(Row(
                 id=self._unkeyed_id(id),
@@ -62,16 +64,20 @@ class VectorDB:
                 label=metadata.get('label', None)
             ))
         return rows
-    
-    def query(self,
-              block_query: BlockQuery,
-              library: str,
-              top_k: int = 5,
-              include_values: bool = False,
-              type: RowType = None) -> List[Row]:
-        if not (block_query and block_query.embedding and library):
-            return None
-        
+
+    def fetch(self, ids: List[str], library: str) -> List[Row]:
+        fetch_response = self._db.fetch([self._keyed_id(id, library) for id in ids])
+        return self._fetch_response_to_rows(fetch_response, library)
+
+    async def afetch(self, ids: List[str], library: str) -> List[Row]:
+        keyed_ids = [self._keyed_id(id, library) for id in ids]
+        if self._async_db:
+            fetch_response = await self._async_db.fetch(keyed_ids)
+        else:
+            fetch_response = await asyncio.to_thread(self._db.fetch, keyed_ids)
+        return self._fetch_response_to_rows(fetch_response, library)
+
+    def _query_filter(self, block_query: BlockQuery, library: str, type: RowType = None) -> Dict[str, Any]:
         filter = {
             'library': library
         }
@@ -93,16 +99,11 @@ class VectorDB:
                 filter['label'] = {
                     '$in': block_query.labels
                 }
+        return filter
 
-        query_response = self._db.query(
-            embedding=block_query.embedding,
-            filter=filter,
-            top_k=top_k,
-            include_metadata=True,
-            include_values=include_values
-        )
+    def _query_response_to_rows(self, query_response: List[Dict[str, Any]], library: str) -> List[Row]:
         rows: List[Row] = []
-        for raw_row in query_response:
+        for raw_row in query_response or []:
             metadata = raw_row.get('metadata', {})
             rows.append(Row(
                 id=self._unkeyed_id(raw_row['id']),
@@ -113,4 +114,43 @@ class VectorDB:
                 label=metadata.get('label', None)
             ))
         return rows
-    
\ No newline at end of file
+    
+    def query(self,
+              block_query: BlockQuery,
+              library: str,
+              top_k: int = 5,
+              include_values: bool = False,
+              type: RowType = None) -> List[Row]:
+        if not (block_query and block_query.embedding and library):
+            return None
+        
+        query_response = self._db.query(
+            embedding=block_query.embedding,
+            filter=self._query_filter(block_query, library, type),
+            top_k=top_k,
+            include_metadata=True,
+            include_values=include_values
+        )
+        return self._query_response_to_rows(query_response, library)
+
+    async def aquery(self,
+                     block_query: BlockQuery,
+                     library: str,
+                     top_k: int = 5,
+                     include_values: bool = False,
+                     type: RowType = None) -> List[Row]:
+        if not (block_query and block_query.embedding and library):
+            return None
+
+        kwargs = {
+            'embedding': block_query.embedding,
+            'filter': self._query_filter(block_query, library, type),
+            'top_k': top_k,
+            'include_metadata': True,
+            'include_values': include_values,
+        }
+        if self._async_db:
+            query_response = await self._async_db.query(**kwargs)
+        else:
+            query_response = await asyncio.to_thread(self._db.query, **kwargs)
+        return self._query_response_to_rows(query_response, library)
@@ -2,10 +2,11 @@ import logging
 from typing import List
 
 from cohere import Client
+from shared.rerank import RerankBackend
 
 _logger = logging.getLogger('Cohere')
 
-class Cohere:
+class Cohere(RerankBackend):
     def __init__(self, api_key: str, log_level: int) -> None:
         self._client = Client(api_key)
 
@@ -1,6 +1,6 @@
 from logging import getLogger
 
-from neo4j import GraphDatabase
+from neo4j import AsyncGraphDatabase, GraphDatabase
 
 _logger = getLogger('Neo4j')
 
@@ -38,4 +38,38 @@ class Neo4j:
     def close(self):
         _logger.debug('[close] closing driver')
         self.driver.close()
-    
\ No newline at end of file
+
+
+class AsyncNeo4j:
+    def __init__(self, uri: str, user: str, password: str, log_level: int):
+        _logger.setLevel(log_level)
+        self.driver = AsyncGraphDatabase.driver(uri, auth=(user, password))
+
+    async def verify_connectivity(self):
+        await self.driver.verify_connectivity()
+
+    async def write(self, query: str, **kwargs):
+        async with self.driver.session(database='neo4j') as session:
+            _logger.debug(f'[write] query: {query}, kwargs: {kwargs}')
+            result = await session.execute_write(self._call, query, **kwargs)
+            _logger.debug(f'[write] result: {str(result)}')
+            return result
+
+    async def read(self, query: str, **kwargs):
+        async with self.driver.session(database='neo4j') as session:
+            _logger.debug(f'[read] query: {query}, kwargs: {kwargs}')
+            result = await session.execute_read(self._call, query, **kwargs)
+            _logger.debug(f'[read] result: {str(result)}')
+            return result
+
+    @staticmethod
+    async def _call(tx, query, **kwargs):
+        if not query:
+            raise ValueError('query must not be empty')
+
+        result = await tx.run(query, **kwargs)
+        return [record async for record in result]
+
+    async def close(self):
+        _logger.debug('[close] closing driver')
+        await self.driver.close()
@@ -1,11 +1,15 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from logging import getLogger
 from typing import Any, Dict, List
 
 import pinecone
+from store.vector_index import VectorBackend
 
 _logger = getLogger('Pinecone')
 
-class Pinecone:
+class Pinecone(VectorBackend):
     def __init__(self, api_key: str, environment: str, index_name: str, log_level: int):
         _logger.setLevel(log_level)
 
@@ -63,3 +67,36 @@ class Pinecone:
         )
 
         return query_response.get('matches', None) if query_response else None
+
+
+class AsyncPinecone:
+    # pinecone-client has no asyncio api, so calls run on a small thread pool and share the sync index's connection pool
+    def __init__(self, pinecone: VectorBackend, max_workers: int = 8):
+        self._pinecone = pinecone
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pinecone')
+
+    async def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(function, *args, **kwargs))
+
+    async def delete(self, ids: List[str]) -> bool:
+        return await self._run(self._pinecone.delete, ids)
+
+    async def upsert(self, vectors: List[dict], batch_size: int = 100) -> bool:
+        return await self._run(self._pinecone.upsert, vectors, batch_size=batch_size)
+
+    async def fetch(self, ids: List[str]):
+        return await self._run(self._pinecone.fetch, ids)
+
+    async def query(self, embedding: List[float], filter: Dict[str, Any], top_k: int, include_metadata: bool = True, include_values: bool = True):
+        return await self._run(
+            self._pinecone.query,
+            embedding=embedding,
+            filter=filter,
+            top_k=top_k,
+            include_metadata=include_metadata,
+            include_values=include_values
+        )
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,59 @@
+from enum import Enum
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+
+class Metric(Enum):
+    L2 = 'l2'
+    COSINE = 'cosine'
+
+
+def _matrix(embeddings: List[Optional[List[float]]], dimension: int) -> Tuple[np.ndarray, np.ndarray]:
+    valid = np.fromiter(
+        (embedding is not None and len(embedding) == dimension for embedding in embeddings),
+        dtype=bool,
+        count=len(embeddings)
+    )
+    matrix = np.zeros((len(embeddings), dimension), dtype=np.float32)
+    for index in np.flatnonzero(valid):
+        matrix[index] = embeddings[index]
+    return matrix, valid
+
+
+def distances(focal_embedding: List[float], embeddings: List[Optional[List[float]]], metric: Metric = Metric.L2) -> np.ndarray:
+    # lower is closer for both metrics (cosine is returned as 1 - similarity). rows with a missing or mismatched
+    # embedding get an infinite distance so that they always rank last
+    if not embeddings:
+        return np.empty(0, dtype=np.float32)
+    if not focal_embedding:
+        return np.full(len(embeddings), np.inf, dtype=np.float32)
+
+    focal = np.asarray(focal_embedding, dtype=np.float32)
+    matrix, valid = _matrix(embeddings, focal.shape[0])
+    if metric == Metric.COSINE:
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(focal)
+        norms[norms == 0] = 1.
+        scores = 1. - (matrix @ focal) / norms
+    else:
+        scores = np.linalg.norm(matrix - focal, axis=1)
+    scores[~valid] = np.inf
+    return scores
+
+
+def rank(focal_embedding: List[float], embeddings: List[Optional[List[float]]], top_k: int = None, metric: Metric = Metric.L2) -> List[int]:
+    # returns the indices of the top_k closest embeddings, closest first. without a focal embedding the original
+    # order is kept
+    count = len(embeddings) if embeddings else 0
+    top_k = count if top_k is None else max(0, min(top_k, count))
+    if not focal_embedding:
+        return list(range(top_k))
+    if top_k == 0:
+        return []
+
+    scores = distances(focal_embedding, embeddings, metric)
+    if top_k < count:
+        candidates = np.argpartition(scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(count)
+    return candidates[np.argsort(scores[candidates], kind='stable')].tolist()
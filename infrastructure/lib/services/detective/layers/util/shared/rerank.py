@@ -0,0 +1,115 @@
+import re
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from hashlib import sha256
+from logging import getLogger
+from math import log
+from threading import Lock
+from typing import Dict, List, Tuple
+
+_logger = getLogger('Rerank')
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+
+
+class RerankBackend(ABC):
+    @abstractmethod
+    def rank(self, query: str, documents: List[str], top_n: int = None) -> List[float]:
+        '''Scores documents against a query.
+
+        Returns:
+            `List[float]`: relevance scores in document order, higher is more relevant.
+        '''
+        pass
+
+
+class BM25(RerankBackend):
+    # lexical okapi bm25 over the candidate documents themselves, so it needs no index, model or network.
+    # scores are scaled into [0, 1] to stay comparable with cohere relevance scores
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self._k1 = k1
+        self._b = b
+
+    @staticmethod
+    def _tokenize(text: str) -> List[str]:
+        return _TOKEN_PATTERN.findall(text.lower()) if text else []
+
+    def rank(self, query: str, documents: List[str], top_n: int = None) -> List[float]:
+        if not documents:
+            return []
+
+        query_terms = set(self._tokenize(query))
+        term_frequencies: List[Counter] = []
+        lengths: List[int] = []
+        for document in documents:
+            tokens = self._tokenize(document)
+            # only query terms contribute to the score, so only those are counted
+            term_frequencies.append(Counter(token for token in tokens if token in query_terms))
+            lengths.append(len(tokens))
+        average_length = (sum(lengths) / len(lengths)) or 1.
+        document_count = len(documents)
+        idf: Dict[str, float] = {}
+        for term in query_terms:
+            containing = sum(1 for frequencies in term_frequencies if term in frequencies)
+            idf[term] = log(1 + (document_count - containing + 0.5) / (containing + 0.5))
+
+        scores: List[float] = []
+        for frequencies, length in zip(term_frequencies, lengths):
+            score = 0.
+            normalizer = self._k1 * (1 - self._b + self._b * length / average_length)
+            for term in query_terms:
+                frequency = frequencies.get(term, 0)
+                if frequency:
+                    score += idf[term] * frequency * (self._k1 + 1) / (frequency + normalizer)
+            scores.append(score)
+
+        maximum = max(scores)
+        return [score / maximum for score in scores] if maximum > 0 else scores
+
+
+class CachedRerankBackend(RerankBackend):
+    # caches scores per (query, chunk hash) so repeated chunks only go to the backend once. only valid for backends
+    # that score each document independently of the others in the call, e.g. cohere
+    def __init__(self, backend: RerankBackend, log_level: int, max_entries: int = 50000) -> None:
+        self._backend = backend
+        self._max_entries = max_entries
+        self._scores: OrderedDict[Tuple[str, str], float] = OrderedDict()
+        self._lock = Lock()
+
+        _logger.setLevel(log_level)
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return sha256(text.encode('utf-8')).hexdigest()
+
+    def rank(self, query: str, documents: List[str], top_n: int = None) -> List[float]:
+        if not documents:
+            return []
+
+        query_hash = self._hash(query)
+        keys = [(query_hash, self._hash(document)) for document in documents]
+        scores: Dict[Tuple[str, str], float] = {}
+        with self._lock:
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    scores[key] = self._scores[key]
+
+        misses: Dict[Tuple[str, str], str] = {}
+        for key, document in zip(keys, documents):
+            if key not in scores:
+                misses[key] = document
+        _logger.debug(f'[rank] {len(documents) - len(misses)} cache hits, {len(misses)} misses')
+        if misses:
+            miss_scores = self._backend.rank(query, list(misses.values()))
+            if len(miss_scores) != len(misses):
+                _logger.error(f'[rank] backend returned {len(miss_scores)} scores for {len(misses)} documents')
+                return []
+            with self._lock:
+                for key, score in zip(misses.keys(), miss_scores):
+                    scores[key] = score
+                    self._scores[key] = score
+                while len(self._scores) > self._max_entries:
+                    self._scores.popitem(last=False)
+
+        return [scores[key] for key in keys]
@@ -0,0 +1,46 @@
+from functools import lru_cache
+from typing import Dict, List
+
+import tiktoken
+
+DEFAULT_ENCODING_NAME = 'cl100k_base'
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING_NAME) -> int:
+    if not text:
+        return 0
+    return len(get_encoding(encoding_name).encode(text))
+
+
+def count_tokens_batch(texts: List[str], encoding_name: str = DEFAULT_ENCODING_NAME) -> List[int]:
+    if not texts:
+        return []
+    encoded = get_encoding(encoding_name).encode_batch(texts)
+    return [len(tokens) for tokens in encoded]
+
+
+class TokenCounter:
+    # memoizes counts for the lifetime of a single request, so text that is counted repeatedly (the same chunk
+    # during block sizing and again during chunk pruning) is only encoded once
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING_NAME) -> None:
+        self._encoding_name = encoding_name
+        self._memo: Dict[str, int] = {}
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if text not in self._memo:
+            self._memo[text] = count_tokens(text, self._encoding_name)
+        return self._memo[text]
+
+    def count_many(self, texts: List[str]) -> List[int]:
+        misses = list({text for text in texts if text and text not in self._memo})
+        if misses:
+            for text, count in zip(misses, count_tokens_batch(misses, self._encoding_name)):
+                self._memo[text] = count
+        return [self._memo[text] if text else 0 for text in texts]
@@ -0,0 +1,138 @@
+import os
+import sqlite3
+from array import array
+from hashlib import sha256
+from logging import getLogger
+from threading import Lock
+from time import time
+from typing import Dict, List
+
+from store.s3_state import S3State
+
+_logger = getLogger('EmbeddingCache')
+
+DEFAULT_CACHE_PATH = '/tmp/embedding_cache.db'
+# ~6KB per ada-002 embedding as float32, so 40k entries stays under ~250MB
+DEFAULT_MAX_ENTRIES = 40000
+_SQLITE_MAX_PARAMS = 500
+
+
+class EmbeddingCache:
+    # a local sqlite file, which lasts as long as a warm v1 lambda. batch tasks pass a state_key to pull the cache from
+    # STATE_BUCKET_NAME on open and push it back on close, since their disk goes away with the task
+    def __init__(self,
+                 model: str,
+                 log_level: int,
+                 path: str = None,
+                 max_entries: int = DEFAULT_MAX_ENTRIES,
+                 state_key: str = None,
+                 state_bucket_name: str = None) -> None:
+        self._model = model
+        self._path = path if path else os.getenv('EMBEDDING_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self._max_entries = max_entries
+        self._lock = Lock()
+        self._state: S3State = None
+
+        _logger.setLevel(log_level)
+
+        state_bucket_name = state_bucket_name if state_bucket_name else os.getenv('STATE_BUCKET_NAME', None)
+        if state_key and state_bucket_name:
+            self._state = S3State(state_bucket_name, state_key, self._path, log_level)
+            self._state.pull()
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(self._path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS embeddings ('
+            'key TEXT PRIMARY KEY, '
+            'embedding BLOB NOT NULL, '
+            'accessed_at INTEGER NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)')
+        self._connection.commit()
+        self._count = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        _logger.debug(f'[__init__] opened {self._path} with {self._count} entries')
+
+    def _key(self, text: str) -> str:
+        return sha256(f'{self._model}\0{text}'.encode('utf-8')).hexdigest()
+
+    def _to_blob(self, embedding: List[float]) -> bytes:
+        return array('f', embedding).tobytes()
+
+    def _from_blob(self, blob: bytes) -> List[float]:
+        embedding = array('f')
+        embedding.frombytes(blob)
+        return embedding.tolist()
+
+    def get_many(self, texts: List[str]) -> Dict[str, List[float]]:
+        if not texts:
+            return {}
+
+        key_to_text: Dict[str, str] = {self._key(text): text for text in texts if text}
+        keys = list(key_to_text.keys())
+        text_to_embedding: Dict[str, List[float]] = {}
+        now = int(time())
+        with self._lock:
+            for start in range(0, len(keys), _SQLITE_MAX_PARAMS):
+                batch = keys[start:start + _SQLITE_MAX_PARAMS]
+                placeholders = ', '.join(['?'] * len(batch))
+                rows = self._connection.execute(
+                    f'SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})', batch
+                ).fetchall()
+                for key, blob in rows:
+                    text_to_embedding[key_to_text[key]] = self._from_blob(blob)
+                if rows:
+                    hit_keys = [key for key, _ in rows]
+                    self._connection.execute(
+                        f'UPDATE embeddings SET accessed_at = ? WHERE key IN ({", ".join(["?"] * len(hit_keys))})',
+                        [now, *hit_keys]
+                    )
+            self._connection.commit()
+        _logger.debug(f'[get_many] {len(text_to_embedding)} hits out of {len(key_to_text)} texts')
+        return text_to_embedding
+
+    def put_many(self, text_to_embedding: Dict[str, List[float]]) -> None:
+        rows = [
+            (self._key(text), self._to_blob(embedding), int(time()))
+            for text, embedding in text_to_embedding.items() if text and embedding
+        ] if text_to_embedding else []
+        if not rows:
+            return
+
+        with self._lock:
+            before = self._connection.total_changes
+            self._connection.executemany('INSERT OR IGNORE INTO embeddings (key, embedding, accessed_at) VALUES (?, ?, ?)', rows)
+            self._count += self._connection.total_changes - before
+            if self._count > self._max_entries:
+                self._evict()
+            self._connection.commit()
+        _logger.debug(f'[put_many] stored {len(rows)} embeddings, {self._count} entries cached')
+
+    def _evict(self) -> None:
+        # evict down to 90% so that a full cache doesn't evict on every put
+        target = int(self._max_entries * 0.9)
+        to_evict = self._count - target
+        self._connection.execute(
+            'DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY accessed_at ASC LIMIT ?)',
+            (to_evict,)
+        )
+        self._count = self._connection.execute('SELECT COUNT(*) FROM embeddings').fetchone()[0]
+        _logger.info(f'[_evict] evicted least recently used embeddings down to {self._count} entries')
+
+    def get(self, text: str) -> List[float]:
+        return self.get_many([text]).get(text, None)
+
+    def put(self, text: str, embedding: List[float]) -> None:
+        self.put_many({text: embedding})
+
+    def close(self) -> None:
+        with self._lock:
+            # fold the wal into the database file so that the pushed copy is complete
+            self._connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._connection.close()
+        if self._state:
+            self._state.push()
@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+from hashlib import sha256
+from logging import getLogger
+from threading import Lock
+from time import time
+from typing import Any, Dict, List
+
+from store.s3_state import S3State
+
+_logger = getLogger('Fingerprints')
+
+DEFAULT_FINGERPRINTS_PATH = '/tmp/fingerprints.db'
+# with a state bucket, each library and connection's fingerprints live in their own s3 object, pulled on open and
+# pushed on close. without one they only last as long as the local disk
+STATE_KEY_PREFIX = 'state/fingerprints'
+_SQLITE_MAX_PARAMS = 500
+
+
+def content_fingerprint(label: str, dictionary: Dict[str, Any]) -> str:
+    return sha256(f'{label}\0{json.dumps(dictionary, sort_keys=True, default=str)}'.encode('utf-8')).hexdigest()
+
+
+class Fingerprints:
+    def __init__(self, library: str, connection: str, log_level: int, path: str = None, state_bucket_name: str = None) -> None:
+        self._library = library
+        self._connection = connection
+        self._path = path if path else os.getenv('FINGERPRINTS_PATH', DEFAULT_FINGERPRINTS_PATH)
+        self._lock = Lock()
+        self._state: S3State = None
+
+        _logger.setLevel(log_level)
+
+        state_bucket_name = state_bucket_name if state_bucket_name else os.getenv('STATE_BUCKET_NAME', None)
+        if state_bucket_name:
+            self._path = os.path.join(os.path.dirname(self._path), 'fingerprints', library, f'{connection}.db')
+            self._state = S3State(state_bucket_name, f'{STATE_KEY_PREFIX}/{library}/{connection}.db', self._path, log_level)
+            self._state.pull()
+
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprints ('
+            'library TEXT NOT NULL, '
+            'connection TEXT NOT NULL, '
+            'id TEXT NOT NULL, '
+            'fingerprint TEXT NOT NULL, '
+            'updated_at INTEGER NOT NULL, '
+            'PRIMARY KEY (library, connection, id))'
+        )
+        self._db.commit()
+
+    def _keyed_id(self, id: str, namespace: str) -> str:
+        return f'{namespace}#{id}'
+
+    def get_many(self, ids: List[str], namespace: str = 'block') -> Dict[str, str]:
+        if not ids:
+            return {}
+
+        keyed_to_id: Dict[str, str] = {self._keyed_id(id, namespace): id for id in ids}
+        keyed_ids = list(keyed_to_id.keys())
+        id_to_fingerprint: Dict[str, str] = {}
+        with self._lock:
+            for start in range(0, len(keyed_ids), _SQLITE_MAX_PARAMS):
+                batch = keyed_ids[start:start + _SQLITE_MAX_PARAMS]
+                placeholders = ', '.join(['?'] * len(batch))
+                rows = self._db.execute(
+                    f'SELECT id, fingerprint FROM fingerprints WHERE library = ? AND connection = ? AND id IN ({placeholders})',
+                    [self._library, self._connection, *batch]
+                ).fetchall()
+                for keyed_id, fingerprint in rows:
+                    id_to_fingerprint[keyed_to_id[keyed_id]] = fingerprint
+        return id_to_fingerprint
+
+    def get(self, id: str, namespace: str = 'block') -> str:
+        return self.get_many([id], namespace).get(id, None)
+
+    def put_many(self, id_to_fingerprint: Dict[str, str], namespace: str = 'block') -> None:
+        if not id_to_fingerprint:
+            return
+
+        now = int(time())
+        rows = [
+            (self._library, self._connection, self._keyed_id(id, namespace), fingerprint, now)
+            for id, fingerprint in id_to_fingerprint.items() if id and fingerprint
+        ]
+        with self._lock:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO fingerprints (library, connection, id, fingerprint, updated_at) VALUES (?, ?, ?, ?, ?)',
+                rows
+            )
+            self._db.commit()
+        _logger.debug(f'[put_many] stored {len(rows)} {namespace} fingerprints')
+
+    def put(self, id: str, fingerprint: str, namespace: str = 'block') -> None:
+        self.put_many({id: fingerprint}, namespace)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._db.execute('DELETE FROM fingerprints WHERE library = ? AND connection = ?', (self._library, self._connection))
+            self._db.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            # fold the wal into the database file so that the pushed copy is complete
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            self._db.close()
+        if self._state:
+            self._state.push()
@@ -0,0 +1,41 @@
+import os
+from logging import getLogger
+
+import boto3
+from botocore.exceptions import ClientError
+
+_logger = getLogger('S3State')
+
+
+class S3State:
+    # mirrors a local file to an s3 object, for stores that have to outlive the task's ephemeral disk. pull before
+    # opening the file, push once it is closed. the last push wins, so one key must only be written by one task at once
+    def __init__(self, bucket_name: str, key: str, path: str, log_level: int) -> None:
+        if not (bucket_name and key and path):
+            raise ValueError(f'[S3State] bucket_name {bucket_name}, key {key} and path {path} must not be empty')
+        self._bucket_name = bucket_name
+        self._key = key
+        self._path = path
+        self._s3_client = boto3.client('s3')
+
+        _logger.setLevel(log_level)
+
+    def pull(self) -> bool:
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            self._s3_client.download_file(self._bucket_name, self._key, self._path)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code', None) not in ('404', 'NoSuchKey'):
+                raise
+            _logger.info(f'[pull] no state at s3://{self._bucket_name}/{self._key}, starting empty')
+            return False
+        _logger.debug(f'[pull] pulled s3://{self._bucket_name}/{self._key} to {self._path}')
+        return True
+
+    def push(self) -> None:
+        if not os.path.exists(self._path):
+            return
+        self._s3_client.upload_file(self._path, self._bucket_name, self._key)
+        _logger.debug(f'[push] pushed {self._path} to s3://{self._bucket_name}/{self._key}')
@@ -0,0 +1,311 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from logging import getLogger
+from threading import Lock
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+_logger = getLogger('VectorIndex')
+
+DEFAULT_VECTOR_INDEX_PATH = '/tmp/vector_index'
+_INITIAL_CAPACITY = 1024
+_MATRIX_FILE = 'vectors.f32'
+_STATE_FILE = 'index.json'
+_JOURNAL_FILE = 'journal.jsonl'
+
+
+class VectorBackend(ABC):
+    '''The pinecone-shaped interface that VectorDB is written against.'''
+
+    @abstractmethod
+    def delete(self, ids: List[str]) -> bool:
+        pass
+
+    @abstractmethod
+    def upsert(self, vectors: List[dict], batch_size: int = 100) -> bool:
+        pass
+
+    @abstractmethod
+    def fetch(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        pass
+
+    @abstractmethod
+    def query(self, embedding: List[float], filter: Dict[str, Any], top_k: int, include_metadata: bool = True, include_values: bool = True) -> List[Dict[str, Any]]:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+def _comparable(value: Any) -> Any:
+    # date_day is stored as YYYYMMDD while queries filter with YYYY-MM-DD, so numeric-looking strings compare as ints.
+    # only applied to range operators: ids and labels that happen to be digits must still match exactly
+    if isinstance(value, str):
+        digits = value.replace('-', '')
+        if digits.isdigit():
+            return int(digits)
+    return value
+
+
+class LocalVectorIndex(VectorBackend):
+    # exact cosine search over a memory-mapped float32 matrix, with pinecone metadata filters evaluated as numpy masks.
+    # slots of deleted vectors are reused. every upsert and delete is appended to a journal once its rows are flushed,
+    # so a crashed run reloads consistent ids and metadata. save() (or close()) compacts the journal into the snapshot.
+    # the index lives on the local disk of one process: graph_plot and v1 each open their own and do not see each
+    # other's writes, so VECTOR_BACKEND=local is for single process runs and tests, not a shared store
+    def __init__(self, dimension: int, log_level: int, path: str = None) -> None:
+        self._dimension = dimension
+        self._path = path if path else os.getenv('VECTOR_INDEX_PATH', DEFAULT_VECTOR_INDEX_PATH)
+        self._lock = Lock()
+        self._ids: List[str] = []
+        self._metadata: List[Dict[str, Any]] = []
+        self._id_to_slot: Dict[str, int] = {}
+        self._free_slots: List[int] = []
+        self._columns: Dict[Tuple[str, bool], np.ndarray] = {}
+
+        _logger.setLevel(log_level)
+
+        os.makedirs(self._path, exist_ok=True)
+        self._load()
+
+    @property
+    def _matrix_path(self) -> str:
+        return os.path.join(self._path, _MATRIX_FILE)
+
+    @property
+    def _state_path(self) -> str:
+        return os.path.join(self._path, _STATE_FILE)
+
+    @property
+    def _journal_path(self) -> str:
+        return os.path.join(self._path, _JOURNAL_FILE)
+
+    def _load(self) -> None:
+        if not (os.path.exists(self._state_path) or os.path.exists(self._journal_path)):
+            self._matrix = self._open_matrix(_INITIAL_CAPACITY, create=True)
+            self._journal = open(self._journal_path, 'a')
+            return
+
+        capacity = _INITIAL_CAPACITY
+        if os.path.exists(self._state_path):
+            with open(self._state_path, 'r') as state_file:
+                state = json.load(state_file)
+            if state.get('dimension') != self._dimension:
+                raise ValueError(f'[LocalVectorIndex._load] index at {self._path} has dimension {state.get("dimension")}, expected {self._dimension}')
+            self._ids = state.get('ids', [])
+            self._metadata = state.get('metadata', [])
+            capacity = state.get('capacity', _INITIAL_CAPACITY)
+        replayed = self._replay()
+        self._id_to_slot = {id: slot for slot, id in enumerate(self._ids) if id is not None}
+        self._free_slots = [slot for slot, id in enumerate(self._ids) if id is None]
+        # the matrix may have grown after the last snapshot
+        row_size = self._dimension * np.dtype(np.float32).itemsize
+        stored = os.path.getsize(self._matrix_path) // row_size if os.path.exists(self._matrix_path) else 0
+        self._matrix = self._open_matrix(max(capacity, stored, len(self._ids)), create=not stored)
+        self._journal = open(self._journal_path, 'a')
+        _logger.debug(f'[_load] loaded {len(self._id_to_slot)} vectors from {self._path}, replayed {replayed} journal entries')
+
+    def _replay(self) -> int:
+        if not os.path.exists(self._journal_path):
+            return 0
+        replayed = 0
+        with open(self._journal_path, 'r') as journal_file:
+            for line in journal_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a write cut short by the crash, every entry before it is complete
+                    _logger.error(f'[_replay] skipping truncated journal entry in {self._journal_path}')
+                    break
+                slot = entry['slot']
+                while len(self._ids) <= slot:
+                    self._ids.append(None)
+                    self._metadata.append(None)
+                self._ids[slot] = entry['id'] if entry['op'] == 'upsert' else None
+                self._metadata[slot] = (entry.get('metadata', None) or {}) if entry['op'] == 'upsert' else None
+                replayed += 1
+        return replayed
+
+    def _append_journal(self, entries: List[Dict[str, Any]]) -> None:
+        # rows are flushed first, so every journaled slot has its values on disk
+        if not entries:
+            return
+        self._matrix.flush()
+        self._journal.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def _open_matrix(self, capacity: int, create: bool = False) -> np.memmap:
+        return np.memmap(self._matrix_path, dtype=np.float32, mode='w+' if create else 'r+', shape=(capacity, self._dimension))
+
+    def _grow(self, required: int) -> None:
+        capacity = self._matrix.shape[0]
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        self._matrix.flush()
+        del self._matrix
+        with open(self._matrix_path, 'r+b') as matrix_file:
+            matrix_file.truncate(capacity * self._dimension * np.dtype(np.float32).itemsize)
+        self._matrix = self._open_matrix(capacity)
+
+    def _column(self, key: str, comparable: bool = False) -> np.ndarray:
+        column = self._columns.get((key, comparable), None)
+        if column is None:
+            column = np.empty(len(self._metadata), dtype=object)
+            values = [metadata.get(key, None) if metadata else None for metadata in self._metadata]
+            column[:] = [_comparable(value) for value in values] if comparable else values
+            self._columns[(key, comparable)] = column
+        return column
+
+    def _mask(self, filter: Dict[str, Any]) -> np.ndarray:
+        mask = np.fromiter((id is not None for id in self._ids), dtype=bool, count=len(self._ids))
+        for key, condition in (filter or {}).items():
+            conditions = condition if isinstance(condition, dict) else {'$eq': condition}
+            for operator, value in conditions.items():
+                if operator in ('$in', '$nin'):
+                    column = self._column(key)
+                    values = set(value)
+                    matches = np.fromiter((item in values for item in column), dtype=bool, count=len(column))
+                    mask &= matches if operator == '$in' else ~matches
+                    continue
+
+                if operator == '$eq':
+                    mask &= self._column(key) == value
+                elif operator == '$ne':
+                    mask &= self._column(key) != value
+                elif operator in ('$gt', '$gte', '$lt', '$lte'):
+                    column = self._column(key, comparable=True)
+                    value = _comparable(value)
+                    comparable = np.fromiter(
+                        (item is not None and type(item) == type(value) for item in column), dtype=bool, count=len(column)
+                    )
+                    mask &= comparable
+                    indices = np.flatnonzero(mask)
+                    selected = column[indices]
+                    if operator == '$gt':
+                        keep = selected > value
+                    elif operator == '$gte':
+                        keep = selected >= value
+                    elif operator == '$lt':
+                        keep = selected < value
+                    else:
+                        keep = selected <= value
+                    mask[indices[~keep.astype(bool)]] = False
+                else:
+                    raise ValueError(f'[LocalVectorIndex._mask] unsupported filter operator {operator}')
+        return mask
+
+    def _to_vector(self, slot: int, include_metadata: bool, include_values: bool) -> Dict[str, Any]:
+        vector: Dict[str, Any] = {'id': self._ids[slot]}
+        if include_values:
+            vector['values'] = self._matrix[slot].tolist()
+        if include_metadata:
+            vector['metadata'] = self._metadata[slot]
+        return vector
+
+    def upsert(self, vectors: List[dict], batch_size: int = 100) -> bool:
+        if not vectors:
+            return False
+
+        with self._lock:
+            entries: List[Dict[str, Any]] = []
+            for vector in vectors:
+                values = vector.get('values', None)
+                if not (vector.get('id', None) and values and len(values) == self._dimension):
+                    _logger.error(f'[upsert] skipping invalid vector {vector.get("id", None)}')
+                    continue
+
+                slot = self._id_to_slot.get(vector['id'], None)
+                if slot is None:
+                    slot = self._free_slots.pop() if self._free_slots else len(self._ids)
+                    if slot == len(self._ids):
+                        self._grow(slot + 1)
+                        self._ids.append(None)
+                        self._metadata.append(None)
+                    self._ids[slot] = vector['id']
+                    self._id_to_slot[vector['id']] = slot
+                self._matrix[slot] = values
+                self._metadata[slot] = vector.get('metadata', None) or {}
+                entries.append({'op': 'upsert', 'slot': slot, 'id': vector['id'], 'metadata': self._metadata[slot]})
+            self._columns = {}
+            self._append_journal(entries)
+        return True
+
+    def delete(self, ids: List[str]) -> bool:
+        if not ids:
+            return False
+
+        with self._lock:
+            entries: List[Dict[str, Any]] = []
+            for id in ids:
+                slot = self._id_to_slot.pop(id, None)
+                if slot is None:
+                    continue
+                self._ids[slot] = None
+                self._metadata[slot] = None
+                self._matrix[slot] = 0.
+                self._free_slots.append(slot)
+                entries.append({'op': 'delete', 'slot': slot, 'id': id})
+            self._columns = {}
+            self._append_journal(entries)
+        return True
+
+    def fetch(self, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        if not ids:
+            return None
+
+        with self._lock:
+            slots = [self._id_to_slot[id] for id in ids if id in self._id_to_slot]
+            return {self._ids[slot]: self._to_vector(slot, True, True) for slot in slots}
+
+    def query(self, embedding: List[float], filter: Dict[str, Any], top_k: int, include_metadata: bool = True, include_values: bool = True) -> List[Dict[str, Any]]:
+        if not (embedding and top_k):
+            return []
+
+        focal = np.asarray(embedding, dtype=np.float32)
+        focal_norm = np.linalg.norm(focal)
+        with self._lock:
+            candidates = np.flatnonzero(self._mask(filter))
+            if candidates.size == 0 or not focal_norm:
+                return []
+
+            matrix = self._matrix[candidates]
+            norms = np.linalg.norm(matrix, axis=1) * focal_norm
+            norms[norms == 0] = 1.
+            scores = (matrix @ focal) / norms
+            top_k = min(top_k, candidates.size)
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+            best = best[np.argsort(-scores[best], kind='stable')]
+
+            matches: List[Dict[str, Any]] = []
+            for index in best:
+                match = self._to_vector(int(candidates[index]), include_metadata, include_values)
+                match['score'] = float(scores[index])
+                matches.append(match)
+            return matches
+
+    def save(self) -> None:
+        with self._lock:
+            self._matrix.flush()
+            state = {
+                'dimension': self._dimension,
+                'capacity': self._matrix.shape[0],
+                'ids': self._ids,
+                'metadata': self._metadata,
+            }
+            temporary_path = f'{self._state_path}.tmp'
+            with open(temporary_path, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(temporary_path, self._state_path)
+            # the snapshot covers everything journaled so far
+            self._journal.truncate(0)
+            self._journal.flush()
+        _logger.debug(f'[save] saved {len(self._id_to_slot)} vectors to {self._path}')
+
+    def close(self) -> None:
+        self.save()
+        self._journal.close()
@@ -1,11 +1,11 @@
 import json
-from math import sqrt
 from typing import Any, List
 
 from graph.blocks import BlockStream
 from graph.neo4j_ import Block, Document
 from graph.translator import Translator
 from mystery.util import count_tokens
+from shared.ranking import rank
 
 from .model import Context, ContextBasket, Request, Source
 
@@ -70,12 +70,13 @@ class BasketWeaver:
         context_counter = 0
         contexts_len = len(context_basket.contexts)
         while remaining_tokens > 0 and context_counter < contexts_len - 1:
-            context = context_basket.contexts[0]
+            # least relevant contexts are at the end
+            context = context_basket.contexts[-1]
             context_tokens = count_tokens(context.translated, encoding_name)
             remaining_tokens -= context_tokens
             if remaining_tokens < 0:
                 break
-            context = context_basket.pop(0)
+            context = context_basket.pop()
             context_counter += 1
         
         print(f'[Weaver] Minified context basket contexts with {len(context_basket.contexts)} contexts and {context_basket.tokens} tokens. Limit: {limit_tokens} tokens.')
@@ -92,7 +93,8 @@ class BasketWeaver:
         blocks_len = len(blocks)
         block_counter = 0
         while remaining_tokens > 0 and block_counter < blocks_len - 1:
-            block = blocks[block_counter]
+            # least relevant blocks are at the end
+            block = blocks[blocks_len - 1 - block_counter]
             translated = self.translate_graph_blocks([block])
             block_tokens = count_tokens(translated, encoding_name)
             remaining_tokens -= block_tokens
@@ -110,25 +112,13 @@ class BasketWeaver:
         print(f'[DataAgent] Context generated! Minified: ')
         print(str(context_basket).replace('\n', '||'))
 
-def euclidean_distance(row1, row2) -> float:
-    distance = 0.0
-    for i in range(len(row1)-1):
-        distance += (row1[i] - row2[i])**2
-    return sqrt(distance)
-
-
 def sort_list_embeddings(focal_embedding: List[float], _list: List[Any], embeddings: List[List[float]]) -> List[Any]:
+    '''Sorts a list by the distance of its embeddings to a focal embedding, closest first.'''
     if not (focal_embedding and _list and embeddings and len(_list) == len(embeddings)):
         print('[Weaver] Invalid input in sort list embeddings!')
         return
 
-    element_distance_tuples: List[tuple[Any, float]] = []
-    for element, embedding in zip(_list, embeddings):
-        distance: float = euclidean_distance(focal_embedding, embedding)
-        element_distance_tuples.append((element, distance))
-
-    element_distance_tuples.sort(key=lambda x: x[1], reverse=True)
-    return [tuple[0] for tuple in element_distance_tuples]
+    return [_list[index] for index in rank(focal_embedding, embeddings)]
 
 
 def sort_contexts(focal_embedding: List[float], contexts: List[Context]) -> List[Context]:
@@ -136,5 +126,5 @@ def sort_contexts(focal_embedding: List[float], contexts: List[Context]) -> List
     for context in contexts:
         context.blocks = sort_list_embeddings(focal_embedding, context.blocks, [
                              block.embedding for block in context.blocks])
-        context_embeddings.append(context.blocks[-1].embedding)
+        context_embeddings.append(context.blocks[0].embedding)
     return sort_list_embeddings(focal_embedding, contexts, context_embeddings)
@@ -1,6 +1,6 @@
 import datetime
 
-import tiktoken
+from shared.tokens import count_tokens as _count_tokens
 
 
 def count_tokens(text: str, encoding_name: str) -> int:
@@ -13,10 +13,7 @@ def count_tokens(text: str, encoding_name: str) -> int:
     Returns:
         The number of tokens in the string.
     '''
-    encoding = tiktoken.get_encoding(encoding_name)
-    tokens = encoding.encode(text)
-    count = len(tokens)
-    return count
+    return _count_tokens(text, encoding_name)
 
 
 def date_day_to_timestamp(date_day: int) -> int:
@@ -0,0 +1,209 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from logging import getLogger
+from time import time
+from typing import Any, Callable, Dict, Tuple
+
+from dstruct.cache import BlockCache
+from external.cohere_ import Cohere
+from external.neo4j_ import AsyncNeo4j
+from external.openai_ import EMBEDDING_DIMENSION, EMBEDDING_MODEL, AsyncOpenAI
+from external.pinecone_ import AsyncPinecone, Pinecone
+from shared.rerank import BM25, CachedRerankBackend, RerankBackend
+from store.embedding_cache import EmbeddingCache
+from store.params import SSM
+from store.vector_index import LocalVectorIndex, VectorBackend
+
+_logger = getLogger('ClientRegistry')
+
+DEFAULT_SECRETS_TTL_SECONDS = 300
+REQUIRED_SECRETS = ['openai_api_key', 'neo4j_user', 'neo4j_password']
+RERANK_BACKENDS = ['cohere', 'bm25']
+VECTOR_BACKENDS = ['pinecone', 'local']
+# (module prefix, exception class names, client) for errors that mean a cached client's connection or credentials are
+# broken. matched by name so that the registry does not pin sdk versions
+_CLIENT_ERRORS = [
+    ('neo4j', {'ServiceUnavailable', 'SessionExpired', 'AuthError', 'TokenExpired'}, 'neo4j'),
+    ('openai', {'APIConnectionError', 'AuthenticationError'}, 'openai'),
+    ('aiohttp', {'ClientConnectionError', 'ServerDisconnectedError'}, 'openai'),
+    ('cohere', {'CohereConnectionError'}, 'cohere'),
+    ('pinecone', {'UnauthorizedException', 'ForbiddenException'}, 'pinecone'),
+    ('urllib3', {'MaxRetryError', 'ProtocolError', 'NewConnectionError'}, 'pinecone'),
+]
+
+
+@dataclass
+class _Entry:
+    credentials: Tuple[str, ...]
+    client: Any
+    close: Callable[[Any], Any] = None
+
+
+class ClientRegistry:
+    # lives for the lifetime of the lambda container so that warm invocations reuse drivers, http sessions and
+    # the pinecone index handle. async clients are bound to the loop they were created on, so the registry owns
+    # one event loop and every invocation runs on it.
+    def __init__(self, app_secrets_path: str, neo4j_uri: str, log_level: int, secrets_ttl: int = DEFAULT_SECRETS_TTL_SECONDS) -> None:
+        self._app_secrets_path = app_secrets_path
+        self._neo4j_uri = neo4j_uri
+        self._log_level = log_level
+        self._secrets_ttl = secrets_ttl
+        self._secrets: Dict[str, Any] = None
+        self._secrets_loaded_at: float = 0
+        self._entries: Dict[str, _Entry] = {}
+        self._loop = asyncio.new_event_loop()
+        self._embedding_cache: EmbeddingCache = None
+        self._block_cache: BlockCache = None
+        self._rerank_backend = os.getenv('RERANK_BACKEND', 'cohere')
+        if self._rerank_backend not in RERANK_BACKENDS:
+            raise ValueError(f'[ClientRegistry] unsupported rerank backend: {self._rerank_backend}')
+        self._vector_backend = os.getenv('VECTOR_BACKEND', 'pinecone')
+        if self._vector_backend not in VECTOR_BACKENDS:
+            raise ValueError(f'[ClientRegistry] unsupported vector backend: {self._vector_backend}')
+
+        _logger.setLevel(log_level)
+
+    def run(self, coroutine) -> Any:
+        return self._loop.run_until_complete(coroutine)
+
+    def secrets(self) -> Dict[str, Any]:
+        if self._secrets is None or time() - self._secrets_loaded_at > self._secrets_ttl:
+            _logger.debug('[secrets] refreshing secrets')
+            self._secrets = SSM().load_params(self._app_secrets_path)
+            self._secrets_loaded_at = time()
+        return self._secrets
+
+    def has_secrets(self) -> bool:
+        secrets = self.secrets()
+        required = REQUIRED_SECRETS + (['cohere_api_key'] if self._rerank_backend == 'cohere' else [])
+        required += ['pinecone_api_key'] if self._vector_backend == 'pinecone' else []
+        return all(secrets.get(name, None) for name in required)
+
+    def _client(self, name: str, credentials: Tuple[str, ...], create: Callable[[], Any], close: Callable[[Any], Any] = None) -> Any:
+        entry = self._entries.get(name, None)
+        if entry and entry.credentials == credentials:
+            return entry.client
+
+        if entry:
+            _logger.info(f'[_client] credentials changed, rebuilding {name}')
+            self._close_entry(name, entry)
+        _logger.debug(f'[_client] creating {name}')
+        client = create()
+        self._entries[name] = _Entry(credentials=credentials, client=client, close=close)
+        return client
+
+    def _close_entry(self, name: str, entry: _Entry) -> None:
+        if not entry.close:
+            return
+        try:
+            result = entry.close(entry.client)
+            if asyncio.iscoroutine(result):
+                self.run(result)
+        except Exception as e:
+            _logger.error(f'[_close_entry] error closing {name}: {str(e)}')
+
+    def neo4j(self) -> AsyncNeo4j:
+        secrets = self.secrets()
+        credentials = (self._neo4j_uri, secrets.get('neo4j_user', None), secrets.get('neo4j_password', None))
+
+        def create() -> AsyncNeo4j:
+            neo4j = AsyncNeo4j(uri=credentials[0], user=credentials[1], password=credentials[2], log_level=self._log_level)
+            # schema bootstrap runs with every graph_plot ingestion, not on the request path
+            self.run(neo4j.verify_connectivity())
+            return neo4j
+
+        return self._client('neo4j', credentials, create, lambda neo4j: neo4j.close())
+
+    def openai(self) -> AsyncOpenAI:
+        credentials = (self.secrets().get('openai_api_key', None),)
+        return self._client(
+            'openai',
+            credentials,
+            lambda: AsyncOpenAI(api_key=credentials[0], log_level=self._log_level),
+            lambda openai: openai.close()
+        )
+
+    def vectors(self) -> VectorBackend:
+        if self._vector_backend == 'local':
+            return self._client(
+                'local_vectors',
+                (),
+                lambda: LocalVectorIndex(dimension=EMBEDDING_DIMENSION, log_level=self._log_level),
+                lambda index: index.close()
+            )
+
+        credentials = (self.secrets().get('pinecone_api_key', None),)
+        return self._client(
+            'pinecone',
+            credentials,
+            lambda: Pinecone(api_key=credentials[0], environment='us-east1-gcp', index_name='beta', log_level=self._log_level)
+        )
+
+    def async_vectors(self) -> AsyncPinecone:
+        vectors = self.vectors()
+        return self._client(
+            'async_vectors',
+            (vectors,),
+            lambda: AsyncPinecone(pinecone=vectors),
+            lambda async_vectors: async_vectors.close()
+        )
+
+    def cohere(self) -> Cohere:
+        credentials = (self.secrets().get('cohere_api_key', None),)
+        return self._client(
+            'cohere',
+            credentials,
+            lambda: Cohere(api_key=credentials[0], log_level=self._log_level)
+        )
+
+    def ranker(self) -> RerankBackend:
+        if self._rerank_backend == 'bm25':
+            return self._client('bm25', (), BM25)
+
+        cohere = self.cohere()
+        return self._client(
+            'cached_cohere',
+            (cohere,),
+            lambda: CachedRerankBackend(backend=cohere, log_level=self._log_level)
+        )
+
+    def embedding_cache(self) -> EmbeddingCache:
+        if not self._embedding_cache:
+            self._embedding_cache = EmbeddingCache(model=EMBEDDING_MODEL, log_level=self._log_level)
+        return self._embedding_cache
+
+    def block_cache(self) -> BlockCache:
+        # outlives invalidate() on purpose: cached blocks are keyed by last_updated_timestamp, not by connection state
+        if not self._block_cache:
+            self._block_cache = BlockCache(log_level=self._log_level)
+        return self._block_cache
+
+    def _failed_client(self, error: Exception) -> str:
+        for error_type in type(error).__mro__:
+            for module, names, client in _CLIENT_ERRORS:
+                if error_type.__module__.startswith(module) and error_type.__name__ in names:
+                    return client
+        return None
+
+    def invalidate_failed(self, error: Exception) -> str:
+        # drops only the client that a connection or auth error came from, following the exception's causes. bad
+        # requests and other errors leave every client cached
+        seen = set()
+        while error is not None and id(error) not in seen:
+            seen.add(id(error))
+            name = self._failed_client(error)
+            if name:
+                _logger.info(f'[invalidate_failed] {type(error).__name__} from {name}, dropping it')
+                self.invalidate(name)
+                return name
+            error = error.__cause__ or error.__context__
+        return None
+
+    def invalidate(self, name: str = None) -> None:
+        # drops cached clients (all of them when name is None) so that the next invocation reconnects
+        names = [name] if name else list(self._entries.keys())
+        for client_name in names:
+            entry = self._entries.pop(client_name, None)
+            if entry:
+                self._close_entry(client_name, entry)
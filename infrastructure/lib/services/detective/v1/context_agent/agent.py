@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from typing import Dict, List
 
@@ -5,8 +6,10 @@ from context_agent.model import Request
 from context_agent.reranker import Reranker
 from dstruct.base import DStruct
 from dstruct.model import Block, BlockQuery
-from external.openai_ import OpenAI
+from external.openai_ import AsyncOpenAI
+from shared.tokens import DEFAULT_ENCODING_NAME
 from store.block_state import SUPPORTED_BLOCK_LABELS
+from store.embedding_cache import EmbeddingCache
 
 _logger = logging.getLogger('ContextAgent')
 
@@ -14,30 +17,46 @@ class ContextAgent:
     def __init__(
         self,
         dstruct: DStruct,
-        openai: OpenAI,
+        openai: AsyncOpenAI,
         reranker: Reranker,
-        log_level: int
+        log_level: int,
+        embedding_cache: EmbeddingCache = None
     ) -> None:
         _logger.setLevel(log_level)
         self._dstruct = dstruct
         self._llm = openai
         self._reranker = reranker
-
-    def _with_embedding(self, block_query: BlockQuery, raw_query: str) -> None:
-        block_query.embedding = self._llm.embed(block_query.concepts if block_query.concepts else raw_query)
+        self._embedding_cache = embedding_cache
+
+    async def _embed(self, text: str) -> List[float]:
+        if not self._embedding_cache:
+            return await self._llm.embed(text)
+
+        embedding = self._embedding_cache.get(text)
+        if embedding:
+            _logger.debug('[_embed] embedding cache hit')
+            return embedding
+        embedding = await self._llm.embed(text)
+        if embedding:
+            self._embedding_cache.put(text, embedding)
+        return embedding
+
+    async def _with_embedding(self, block_query: BlockQuery, raw_query: str) -> None:
+        block_query.embedding = await self._embed(block_query.concepts if block_query.concepts else raw_query)
     
-    def fetch(self, request: Request) -> List[Block]:
+    async def fetch(self, request: Request) -> List[Block]:
         _logger.debug('[fetch] Generating context...')
 
         if request.end and request.end.search_method:
             _logger.debug(f'[fetch] search method specified {request.end.search_method}. skipping llm reasoning...')
         else:
-            self._with_llm_reasoning(request)
+            await self._with_llm_reasoning(request)
+        embeddings = [self._with_embedding(request.end, request.raw)]
         if request.start:
-            self._with_embedding(request.start, request.raw)
-        self._with_embedding(request.end, request.raw)
+            embeddings.append(self._with_embedding(request.start, request.raw))
+        await asyncio.gather(*embeddings)
 
-        blocks: List[Block] = self._dstruct.query(request.end, request.start, with_embeddings=True, with_data=True)
+        blocks: List[Block] = await self._dstruct.aquery(request.end, request.start, with_embeddings=True, with_data=True)
 
         if not blocks:
             _logger.debug(f'[fetch] No results for raw query {request.end} -> {request.start}')
@@ -46,7 +65,7 @@ class ContextAgent:
             embedding = request.end.embedding
             if not embedding:
                 _logger.debug(f'[fetch] no embedding found in end. embedding now...')
-                embedding = self._llm.embed(request.end.concepts if request.end.concepts else request.raw)
+                embedding = await self._embed(request.end.concepts if request.end.concepts else request.raw)
 
             fallback_query = BlockQuery(
                 search_method='relevant',
@@ -63,13 +82,12 @@ class ContextAgent:
                 embedding=embedding,
             )
 
-            blocks = self._dstruct.query(fallback_query)
+            blocks = await self._dstruct.aquery(fallback_query)
             _logger.debug(f'[fetch] Fallback query {fallback_query} yielded {len(blocks)} results')
         
-        self._reranker.minify(request, blocks, 'cl100k_base')
-        return blocks
+        return self._reranker.minify(request, blocks, DEFAULT_ENCODING_NAME)
 
-    def _with_llm_reasoning(self, request: Request) -> None:
+    async def _with_llm_reasoning(self, request: Request) -> None:
         _logger.debug(f'[_with_llm_reasoning] decorating with language reasoning for request: {request}')
 
         block_query_properties: Dict[str, Dict] = BlockQuery.schema().get('properties')
@@ -78,7 +96,7 @@ class ContextAgent:
         block_query_properties.pop('embedding', {})
 
         # get list of supported labels from neo4j
-        labels: List[str] = self._dstruct.get_labels()
+        labels: List[str] = await self._dstruct.aget_labels()
         _logger.debug(f'[_with_llm_reasoning] labels = {labels}')
 
         block_query_properties['labels']['items']['enum'] = labels
@@ -95,7 +113,7 @@ class ContextAgent:
             f'{str(specified_end_properties)}'
         ) if specified_end_properties else ""
 
-        response = self._llm.function_call(
+        response = await self._llm.function_call(
             messages=[{
                 'role': 'system',
                 'content': (
@@ -12,6 +12,7 @@ class Request:
     next_token: str = None
     start: BlockQuery = None
     end: BlockQuery = None
+    token_count: int = None
 
 class ContextQuery(BaseModel):
     lingua: str
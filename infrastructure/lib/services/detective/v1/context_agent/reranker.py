@@ -1,50 +1,44 @@
 import logging
-from math import sqrt
 from typing import Dict, List
 
-import tiktoken
 from context_agent.model import Request
 from dstruct.model import (Block, Chunk, StructuredProperty,
                            UnstructuredProperty)
-from external.cohere_ import Cohere
+from shared.ranking import rank
+from shared.rerank import RerankBackend
+from shared.tokens import TokenCounter
 
 _logger = logging.getLogger('Reranker')
 
 
 class Reranker:
-    def __init__(self, cohere: Cohere, log_level: int) -> None:
-        self._cohere = cohere
+    def __init__(self, ranker: RerankBackend, log_level: int) -> None:
+        self._ranker = ranker
         _logger.setLevel(log_level)
 
-    def _count_tokens(self, string: str, encoding_name: str) -> int:
-        encoding = tiktoken.get_encoding(encoding_name)
-        tokens = encoding.encode(string)
-        return len(tokens)
-
-    def _count_tokens_chunk(self, chunk: Chunk, encoding_name: str) -> int:
-        return self._count_tokens(chunk.text, encoding_name)
-
-    def _count_tokens_block(self, block: Block, encoding_name: str) -> int:
-        total_tokens = 0
+    def _block_texts(self, block: Block) -> List[str]:
+        texts: List[str] = []
         for property in block.properties:
             if isinstance(property, UnstructuredProperty):
-                for chunk in property.chunks:
-                    total_tokens += self._count_tokens_chunk(chunk, encoding_name)
+                texts.extend([chunk.text for chunk in property.chunks])
             elif isinstance(property, StructuredProperty):
-                total_tokens += self._count_tokens(f'{property.key}: {property.value}', encoding_name)
-        return total_tokens
+                texts.append(f'{property.key}: {property.value}')
+        return texts
 
-    def _euclidean_distance(self, x, y):
-        if not (x and y):
-            return 1.
-
-        return sqrt(sum([(x[i] - y[i]) ** 2 for i in range(len(x))]))
+    def _count_tokens_blocks(self, blocks: List[Block], counter: TokenCounter) -> Dict[str, int]:
+        # one batched encode over every block instead of an encode per string
+        block_texts: Dict[str, List[str]] = {block.id: self._block_texts(block) for block in blocks}
+        counts = counter.count_many([text for texts in block_texts.values() for text in texts])
+        block_to_tokens_map: Dict[str, int] = {}
+        offset = 0
+        for block_id, texts in block_texts.items():
+            block_to_tokens_map[block_id] = sum(counts[offset:offset + len(texts)])
+            offset += len(texts)
+        return block_to_tokens_map
 
-    def _rank_blocks(self, focal_embedding: List[float], blocks: List[Block]) -> Dict[str, float]:
-        block_to_rank_map: Dict[str, float] = {}
-        for block in blocks:
-            block_to_rank_map[block.id] = self._euclidean_distance(block.embedding, focal_embedding)
-        return block_to_rank_map
+    def _rank_blocks(self, focal_embedding: List[float], blocks: List[Block], top_k: int = None) -> List[Block]:
+        order = rank(focal_embedding, [block.embedding for block in blocks], top_k=top_k)
+        return [blocks[index] for index in order]
 
     def _rank_chunks(self, raw_request: str, blocks: List[Block]) -> Dict[str, float]:
         _logger.debug(f'[rank] ranking {len(blocks)} blocks')
@@ -60,9 +54,9 @@ class Reranker:
             return {}
         
         _logger.debug(f'[rank] ranking {len(chunks)} chunks')
-        ranks = self._cohere.rank(raw_request, [chunk.text for chunk in chunks])
+        ranks = self._ranker.rank(raw_request, [chunk.text for chunk in chunks])
         if not ranks:
-            _logger.error(f'[rank] no ranks returned from cohere')
+            _logger.error(f'[rank] no ranks returned from ranker')
             return {}
 
         chunk_to_rank_map: Dict[str, float] = {}
@@ -71,31 +65,28 @@ class Reranker:
         
         return chunk_to_rank_map
 
-    def minify(self, request: Request, blocks: List[Block], encoding_name: str) -> None:
-        _logger.debug(f'[minify] {len(blocks)} blocks with token_limit {request.token_limit} and block_limit {request.end.limit}')
+    def minify(self, request: Request, blocks: List[Block], encoding_name: str) -> List[Block]:
         if not (request and blocks and encoding_name):
             _logger.error(f'[minify] missing required arguments (request: {request}, blocks: {blocks}, encoding_name: {encoding_name})')
-            return
-
-        blocks_to_rank_map: Dict[str, float] = self._rank_blocks(request.end.embedding, blocks)
-        blocks = sorted(blocks, key=lambda block: blocks_to_rank_map[block.id])
+            return blocks
+        _logger.debug(f'[minify] {len(blocks)} blocks with token_limit {request.token_limit} and block_limit {request.end.limit}')
 
-        if request.end.limit:
-            blocks = blocks[:request.end.limit]
+        counter = TokenCounter(encoding_name)
+        top_k = request.end.limit if request.end.limit else None
         if not request.token_limit:
-            blocks = blocks[:10]
-            return
+            top_k = min(top_k, 10) if top_k else 10
+        blocks = self._rank_blocks(request.end.embedding, blocks, top_k)
+        if not request.token_limit:
+            request.token_count = sum(self._count_tokens_blocks(blocks, counter).values())
+            return blocks
         
         # count tokens
-        block_to_tokens_map: Dict[str, int] = {}
-        total_token_count = 0
-        for block in blocks:
-            token_count = self._count_tokens_block(block, encoding_name)
-            block_to_tokens_map[block.id] = token_count
-            total_token_count += token_count
+        block_to_tokens_map: Dict[str, int] = self._count_tokens_blocks(blocks, counter)
+        total_token_count = sum(block_to_tokens_map.values())
         
         if total_token_count < request.token_limit:
-            return
+            request.token_count = total_token_count
+            return blocks
         
         # pop blocks until total token count is below limit besides the last block
         while len(blocks) > 1:
@@ -116,7 +107,6 @@ class Reranker:
             # first pop least relevant chunks from properties with #chunks > 1
             all_chunks: List[Chunk] = []
             chunk_to_property: Dict[str, UnstructuredProperty] = {}
-            chunk_to_tokens: Dict[str, int] = {}
             property_to_chunks_count: Dict[UnstructuredProperty, int] = {}
             for property in blocks[-1].properties:
                 if not (isinstance(property, UnstructuredProperty) and len(property.chunks) > 1):
@@ -125,17 +115,20 @@ class Reranker:
                 for chunk in property.chunks:
                     chunk_to_property[chunk.text] = property
                 property_to_chunks_count[property] = len(property.chunks)
-                chunk_to_tokens[chunk.text] = self._count_tokens_chunk(chunk, encoding_name)
 
-            all_chunks.sort(key=lambda chunk: chunks_to_rank_map[chunk.text])
+            # most relevant first so that pop() drops the least relevant chunk
+            all_chunks.sort(key=lambda chunk: chunks_to_rank_map.get(chunk.text, 0.), reverse=True)
             while all_chunks:
                 chunk = all_chunks.pop()
                 property = chunk_to_property[chunk.text]
                 if not property_to_chunks_count[property]:
                     continue
                 property_to_chunks_count[property] -= 1
-                total_token_count -= chunk_to_tokens[chunk.text]
+                # counts were memoized while sizing the blocks above, so this does not re-encode
+                total_token_count -= counter.count(chunk.text)
                 chunk_to_property[chunk.text].chunks.remove(chunk)
                 if total_token_count < request.token_limit:
                     break
-        _logger.debug(f'[minify] minified to {len(blocks)} blocks with {total_token_count} tokens')
\ No newline at end of file
+        request.token_count = total_token_count
+        _logger.debug(f'[minify] minified to {len(blocks)} blocks with {total_token_count} tokens')
+        return blocks
@@ -3,6 +3,7 @@ import logging
 import os
 from typing import Dict, List
 
+from clients import ClientRegistry
 from context_agent.agent import ContextAgent
 from context_agent.model import ContextQuery, Request
 from context_agent.reranker import Reranker
@@ -11,12 +12,7 @@ from dstruct.graphdb import GraphDB
 from dstruct.model import (Block, BlockQuery, StructuredProperty,
                            UnstructuredProperty)
 from dstruct.vectordb import VectorDB
-from external.cohere_ import Cohere
-from external.neo4j_ import Neo4j
-from external.openai_ import OpenAI
-from external.pinecone_ import Pinecone
 from shared.response import Errors, to_response_error, to_response_success
-from store.params import SSM
 
 _logger = logging.getLogger('ContextRetriever')
 logging.basicConfig(level=logging.INFO)
@@ -24,8 +20,10 @@ log_level = os.getenv('LOG_LEVEL')
 log_level = logging.getLevelName(log_level) if log_level else logging.DEBUG
 _logger.setLevel(log_level)
 
+clients: ClientRegistry = None
+
 def handler(event: dict, context):
-    global dstruct, _logger
+    global clients, _logger
 
     stage: str = os.getenv('STAGE')
     neo4j_uri: str = os.getenv('NEO4J_URI')
@@ -51,26 +49,13 @@ def handler(event: dict, context):
         _logger.exception(e)
         return to_response_error(Errors.INVALID_QUERY_PARAMS)
     
-    secrets = SSM().load_params(app_secrets_path)
-    openai_api_key = secrets.get('openai_api_key', None)
-    cohere_api_key = secrets.get('cohere_api_key', None)
-    neo4j_user = secrets.get('neo4j_user', None)
-    neo4j_password = secrets.get('neo4j_password', None)
-    pinecone_api_key = secrets.get('pinecone_api_key', None)
-    if not (openai_api_key and cohere_api_key and neo4j_user and neo4j_password and pinecone_api_key):
+    if not clients:
+        clients = ClientRegistry(app_secrets_path=app_secrets_path, neo4j_uri=neo4j_uri, log_level=log_level)
+    if not clients.has_secrets():
         _logger.exception(Errors.MISSING_SECRETS.value)
         return to_response_error(Errors.MISSING_SECRETS)
-    pinecone = Pinecone(api_key=pinecone_api_key, environment='us-east1-gcp', index_name='beta', log_level=log_level)
-    vectordb = VectorDB(db=pinecone)
-    neo4j = Neo4j(uri=neo4j_uri, user=neo4j_user, password=neo4j_password, log_level=log_level)
-    graphdb = GraphDB(db=neo4j)
-    dstruct = DStruct(graphdb=graphdb, vectordb=vectordb, library=library, log_level=log_level)
-    openai = OpenAI(api_key=openai_api_key, log_level=log_level)
-    cohere = Cohere(api_key=cohere_api_key, log_level=log_level)
-    reranker = Reranker(cohere=cohere, log_level=log_level)
-    context_agent = ContextAgent(dstruct=dstruct, openai=openai, reranker=reranker, log_level=log_level)
 
-    blocks: List[Block] = context_agent.fetch(Request(
+    request = Request(
         raw=context_query.lingua,
         token_limit=token_limit,
         next_token=next_token,
@@ -85,9 +70,27 @@ def handler(event: dict, context):
             offset=context_query.offset,
             integrations=context_query.integrations,
         )
-    ))
-    _logger.debug(f'[main] blocks fetched: {str([block.id for block in blocks])}')
-    response = { 'next_token': None }
+    )
+
+    try:
+        vectordb = VectorDB(db=clients.vectors(), async_db=clients.async_vectors())
+        graphdb = GraphDB(async_db=clients.neo4j())
+        dstruct = DStruct(graphdb=graphdb, vectordb=vectordb, library=library, log_level=log_level, cache=clients.block_cache())
+        reranker = Reranker(ranker=clients.ranker(), log_level=log_level)
+        context_agent = ContextAgent(
+            dstruct=dstruct,
+            openai=clients.openai(),
+            reranker=reranker,
+            log_level=log_level,
+            embedding_cache=clients.embedding_cache()
+        )
+        blocks: List[Block] = clients.run(context_agent.fetch(request))
+    except Exception as e:
+        # a broken driver or session would otherwise be reused by every warm invocation after this one
+        clients.invalidate_failed(e)
+        raise
+    _logger.debug(f'[main] blocks fetched: {str([block.id for block in blocks]) if blocks else []}')
+    response = { 'next_token': None, 'token_count': request.token_count }
     response_blocks: List[Dict] = []
     if blocks:
         for block in blocks:
@@ -121,6 +124,5 @@ def handler(event: dict, context):
             block_dict['properties'] = properties
             response_blocks.append(block_dict)
     response['blocks'] = response_blocks
-    neo4j.close()
     return to_response_success(response)
 